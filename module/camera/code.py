@@ -1,80 +1,99 @@
-import os
-import board
-import busio
-import storage
-import sdcardio
-import digitalio
-import time
-import espidf
-import espcamera
-
-
-spi = board.SPI()
-cs = board.SDCS
-sdcard = sdcardio.SDCard(spi, cs)
-vfs = storage.VfsFat(sdcard)
-storage.mount(vfs, "/sd")
-
-
-cam = espcamera.Camera(
-    data_pins=board.CAM_DATA,
-    external_clock_pin=board.CAM_XCLK,
-    pixel_clock_pin=board.CAM_PCLK,
-    vsync_pin=board.CAM_VSYNC,
-    href_pin=board.CAM_HREF,
-    pixel_format=espcamera.PixelFormat.JPEG,
-    frame_size=espcamera.FrameSize.SVGA,
-    i2c=busio.I2C(board.CAM_SCL, board.CAM_SDA),
-    external_clock_frequency=20_000_000,
-    framebuffer_count=2,
-    grab_mode=espcamera.GrabMode.WHEN_EMPTY)
-
-cam.vflip = True
-
-
-def print_directory(path, tabs=0):
-    for file in os.listdir(path):
-        if file == "?":
-            continue  # Issue noted in Learn
-        stats = os.stat(path + "/" + file)
-        filesize = stats[6]
-        isdir = stats[0] & 0x4000
-
-        if filesize < 1000:
-            sizestr = str(filesize) + " by"
-        elif filesize < 1000000:
-            sizestr = "%0.1f KB" % (filesize / 1000)
-        else:
-            sizestr = "%0.1f MB" % (filesize / 1000000)
-
-        prettyprintname = ""
-        for _ in range(tabs):
-            prettyprintname += "   "
-        prettyprintname += file
-        if isdir:
-            prettyprintname += "/"
-        print('{0:<40} Size: {1:>10}'.format(prettyprintname, sizestr))
-
-        # recursively print directory contents
-        if isdir:
-            print_directory(path + "/" + file, tabs + 1)
-
-
-# print("Files on filesystem:")
-# print("====================")
-# print_directory("/sd")
-
-try:
-    os.mkdir("/sd/pic")
-except:
-    pass
-
-for i in range(60):
-    frame = cam.take(1)
-    print(f"/sd/pic/{i}_{time.time()}.jpg")
-    with open(f"/sd/pic/{i}_{time.time()}.jpg", "wb") as f:
-        f.write(frame)
-
-# print(frame)
-
-
+import os
+import digitalio
+import time
+import espidf
+
+from lib.avi import MjpegAviWriter
+from lib.camera_service import open_camera
+
+clip_frames = 60
+clip_fps = 10  # frames are taken on this schedule; slots missed while the card is busy count as dropped
+clip_dir = "/sd/video"
+
+
+cam = open_camera("/sd")
+
+
+def print_directory(path, tabs=0):
+    for file in os.listdir(path):
+        if file == "?":
+            continue  # Issue noted in Learn
+        stats = os.stat(path + "/" + file)
+        filesize = stats[6]
+        isdir = stats[0] & 0x4000
+
+        if filesize < 1000:
+            sizestr = str(filesize) + " by"
+        elif filesize < 1000000:
+            sizestr = "%0.1f KB" % (filesize / 1000)
+        else:
+            sizestr = "%0.1f MB" % (filesize / 1000000)
+
+        prettyprintname = ""
+        for _ in range(tabs):
+            prettyprintname += "   "
+        prettyprintname += file
+        if isdir:
+            prettyprintname += "/"
+        print('{0:<40} Size: {1:>10}'.format(prettyprintname, sizestr))
+
+        # recursively print directory contents
+        if isdir:
+            print_directory(path + "/" + file, tabs + 1)
+
+
+# print("Files on filesystem:")
+# print("====================")
+# print_directory("/sd")
+
+def record_clip(path, frame_count, fps):
+    """Record frame_count frame slots at fps into one MJPEG AVI; returns (frames, dropped, failed, achieved fps).
+
+    With two framebuffers the driver fills one while the frame taken from
+    the other is written, so capture and the SD write overlap. take() hands
+    the previous buffer back to the driver, which is why each frame is
+    written before the next one is taken.
+    """
+    writer = MjpegAviWriter(path, fps, frame_count)
+    interval_ns = 1000000000 // fps
+    dropped = 0
+    failed = 0
+    slot = 0  # frame slots used up, dropped ones included, so the clip lasts frame_count / fps
+    start_ns = time.monotonic_ns()
+    next_ns = start_ns
+    while slot < frame_count:
+        now_ns = time.monotonic_ns()
+        if now_ns < next_ns:
+            time.sleep((next_ns - now_ns) / 1000000000)
+            continue
+        late_ns = now_ns - next_ns
+        if late_ns >= interval_ns:
+            missed = min(late_ns // interval_ns, frame_count - slot)
+            dropped += missed
+            slot += missed
+            if slot == frame_count:
+                break
+            next_ns = now_ns + interval_ns
+        else:
+            next_ns += interval_ns
+        slot += 1
+        frame = cam.take(1)
+        if frame is None:
+            failed += 1
+            continue
+        writer.write_frame(frame)
+    elapsed_s = (time.monotonic_ns() - start_ns) / 1000000000
+    achieved_fps = writer.frames / elapsed_s if elapsed_s else 0
+    writer.close(achieved_fps)
+    return writer.frames, dropped, failed + writer.skipped, achieved_fps
+
+
+try:
+    os.mkdir(clip_dir)
+except OSError:
+    pass
+
+clip_path = f"{clip_dir}/{int(time.time())}.avi"
+print(f"recording {clip_path}")
+frames, dropped, failed, achieved_fps = record_clip(clip_path, clip_frames, clip_fps)
+print(f"{frames} frames at {achieved_fps:.1f} fps, {dropped} dropped, {failed} failed")
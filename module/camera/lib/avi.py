@@ -0,0 +1,158 @@
+import struct
+from array import array
+
+AVIF_HASINDEX = 0x10
+AVIIF_KEYFRAME = 0x10
+MAX_FRAMES = 3600  # index entries preallocated per clip
+
+# byte offsets of the fields patched when the clip is closed
+RIFF_SIZE = 4
+AVIH_MICROSEC_PER_FRAME = 32
+AVIH_MAX_BYTES_PER_SEC = 36
+AVIH_TOTAL_FRAMES = 48
+AVIH_SUGGESTED_BUFFER_SIZE = 60
+STRH_SCALE = 128
+STRH_RATE = 132
+STRH_LENGTH = 140
+STRH_SUGGESTED_BUFFER_SIZE = 144
+MOVI_SIZE = 216
+MOVI_START = 220  # the 'movi' fourcc; idx1 offsets count from here
+HEADER_SIZE = 224
+
+
+def jpeg_size(frame):
+    """(width, height) from the SOF marker of a JPEG, None when there is none."""
+    position = 2
+    end = len(frame) - 9
+    while position < end:
+        if frame[position] != 0xFF:
+            return None
+        marker = frame[position + 1]
+        if marker in (0xC0, 0xC1, 0xC2):
+            return frame[position + 7] << 8 | frame[position + 8], frame[position + 5] << 8 | frame[position + 6]
+        position += 2 + (frame[position + 2] << 8 | frame[position + 3])
+    return None
+
+
+def _header(width: int, height: int, fps: int) -> bytearray:
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into("<4sI4s", header, 0, b"RIFF", 0, b"AVI ")
+    struct.pack_into("<4sI4s", header, 12, b"LIST", 192, b"hdrl")
+    struct.pack_into("<4sI", header, 24, b"avih", 56)
+    struct.pack_into("<10I", header, 32, 1000000 // fps, 0, 0, AVIF_HASINDEX, 0, 0, 1, 0, width, height)
+    struct.pack_into("<4sI4s", header, 88, b"LIST", 116, b"strl")
+    struct.pack_into("<4sI", header, 100, b"strh", 56)
+    struct.pack_into("<4s4sIHHIIIIIIIIhhhh", header, 108, b"vids", b"MJPG", 0, 0, 0, 0, 1, fps, 0, 0, 0, 0xFFFFFFFF, 0, 0, 0, width, height)
+    struct.pack_into("<4sI", header, 164, b"strf", 40)
+    struct.pack_into("<IiiHH4sIiiII", header, 172, 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0)
+    struct.pack_into("<4sI4s", header, 212, b"LIST", 4, b"movi")
+    return header
+
+
+class MjpegAviWriter:
+    """Motion JPEG AVI written as one append-only file.
+
+    The header goes out with the first frame, whose size it takes from the
+    JPEG itself. Frames are appended as they come; the offsets and sizes the
+    idx1 index needs are kept in preallocated arrays, so writing a frame
+    allocates nothing. close() appends the index and patches the frame count,
+    frame rate and sizes in the header.
+    """
+
+    def __init__(self, path: str, fps: int = 10, max_frames: int = MAX_FRAMES) -> None:
+        self.path = path
+        self.fps = fps
+        self.max_frames = max_frames
+        self.offsets = array("I", (0 for _ in range(max_frames)))
+        self.sizes = array("I", (0 for _ in range(max_frames)))
+        self.frames = 0
+        self.skipped = 0  # frames past max_frames or without a readable size
+        self.size = 0
+        self.largest = 0
+        self.chunk_header = bytearray(8)
+        self.file = None
+
+    def write_frame(self, frame) -> bool:
+        if not self.begin_frame(frame):
+            return False
+        self.file.write(frame)
+        self.end_frame()
+        return True
+
+    def begin_frame(self, frame) -> bool:
+        """Start a frame whose data follows through write_data(); frame only needs its length and JPEG header here."""
+        if self.frames >= self.max_frames:
+            self.skipped += 1
+            return False
+        if self.file is None:
+            size = jpeg_size(frame)
+            if size is None:
+                self.skipped += 1
+                return False
+            self.file = open(self.path, "wb")
+            self.file.write(_header(size[0], size[1], self.fps))
+            self.size = HEADER_SIZE
+        length = len(frame)
+        struct.pack_into("<4sI", self.chunk_header, 0, b"00dc", length)
+        self.file.write(self.chunk_header)
+        self.offsets[self.frames] = self.size - MOVI_START
+        self.sizes[self.frames] = length
+        return True
+
+    def write_data(self, data):
+        self.file.write(data)
+
+    def end_frame(self):
+        length = self.sizes[self.frames]
+        if length & 1:
+            self.file.write(b"\0")
+        self.frames += 1
+        self.size += 8 + length + (length & 1)
+        if length > self.largest:
+            self.largest = length
+
+    @property
+    def full(self) -> bool:
+        return self.frames >= self.max_frames
+
+    def close(self, fps: float = None):
+        """Append the index and fix up the header; fps is the rate the clip should play back at."""
+        for _ in self.close_steps(fps):
+            pass
+
+    def close_steps(self, fps: float = None, entries_per_step: int = 64):
+        """Generator form of close(): yields after every few index entries."""
+        if self.file is None:
+            return
+        f = self.file
+        self.file = None
+        movi_size = self.size - MOVI_START
+        entry = bytearray(16)
+        struct.pack_into("<4sI", entry, 0, b"idx1", 16 * self.frames)
+        f.write(memoryview(entry)[:8])
+        for index in range(self.frames):
+            struct.pack_into("<4sIII", entry, 0, b"00dc", AVIIF_KEYFRAME, self.offsets[index], self.sizes[index])
+            f.write(entry)
+            if index % entries_per_step == entries_per_step - 1:
+                yield
+        riff_size = self.size + 8 + 16 * self.frames - 8
+
+        # rate / scale frames per second, in thousandths so a measured rate survives
+        scale = 1000
+        rate = int((fps or self.fps) * scale + 0.5) or scale
+        average = movi_size // self.frames if self.frames else 0
+        for offset, value in (
+            (RIFF_SIZE, riff_size),
+            (AVIH_MICROSEC_PER_FRAME, 1000000 * scale // rate),
+            (AVIH_MAX_BYTES_PER_SEC, average * rate // scale),
+            (AVIH_TOTAL_FRAMES, self.frames),
+            (AVIH_SUGGESTED_BUFFER_SIZE, self.largest + 8),
+            (STRH_SCALE, scale),
+            (STRH_RATE, rate),
+            (STRH_LENGTH, self.frames),
+            (STRH_SUGGESTED_BUFFER_SIZE, self.largest + 8),
+            (MOVI_SIZE, movi_size),
+        ):
+            f.seek(offset)
+            f.write(struct.pack("<I", value))
+        f.close()
@@ -0,0 +1,271 @@
+import os
+import time
+
+from lib.avi import MjpegAviWriter
+
+CLIP_DIR = "/sd/video"
+CAPTURE_FPS = 10
+MAX_QUEUED = 3  # frames copied out of the driver and waiting for the card
+MAX_FRAME_BYTES = 96 * 1024  # an SVGA JPEG is 30-60 KB
+STEP_BUDGET_US = 1000  # time step() may take before it hands back to the scan loop
+CHUNK_BYTES = 2048  # written per SD call; step() writes chunks until the budget is spent
+
+
+def mount_sd(sd_path: str = "/sd"):
+    """Mount the module's SD card at sd_path."""
+    import board
+    import sdcardio
+    import storage
+
+    sdcard = sdcardio.SDCard(board.SPI(), board.SDCS)
+    storage.mount(storage.VfsFat(sdcard), sd_path)
+
+
+def start_camera():
+    """Start the camera with the module's wiring."""
+    import board
+    import busio
+    import espcamera
+
+    cam = espcamera.Camera(
+        data_pins=board.CAM_DATA,
+        external_clock_pin=board.CAM_XCLK,
+        pixel_clock_pin=board.CAM_PCLK,
+        vsync_pin=board.CAM_VSYNC,
+        href_pin=board.CAM_HREF,
+        pixel_format=espcamera.PixelFormat.JPEG,
+        frame_size=espcamera.FrameSize.SVGA,
+        i2c=busio.I2C(board.CAM_SCL, board.CAM_SDA),
+        external_clock_frequency=20_000_000,
+        framebuffer_count=2,
+        grab_mode=espcamera.GrabMode.WHEN_EMPTY)
+    cam.vflip = True
+    return cam
+
+
+def open_camera(sd_path: str = "/sd"):
+    """Mount the SD card and start the camera (the standalone code.py uses the same wiring)."""
+    mount_sd(sd_path)
+    return start_camera()
+
+
+class CameraService:
+    """Records MJPEG clips in small slices driven by another loop, such as the keyboard scheduler.
+
+    step() takes a frame when one is due (copying it out of the driver into
+    one of max_queued preallocated buffers), then writes queued frames to the
+    card a chunk at a time until budget_us is spent. When the queue is full
+    the oldest frame not yet started is dropped, so a slow card costs frames,
+    never scan time. stats() reports queue depth, drops and step times.
+
+    start() only asks for a clip. Mounting the card, starting the camera and
+    allocating the buffers are each one step() slice, done the first time,
+    so a key handler that calls start() or toggle() returns at once.
+    """
+
+    def __init__(self, mount_sd=mount_sd, start_camera=start_camera, sd_path: str = "/sd", clip_dir: str = CLIP_DIR, fps: int = CAPTURE_FPS, max_queued: int = MAX_QUEUED, max_frame_bytes: int = MAX_FRAME_BYTES, budget_us: int = STEP_BUDGET_US, chunk_bytes: int = CHUNK_BYTES) -> None:
+        self.mount_sd = mount_sd
+        self.start_camera = start_camera
+        self.sd_path = sd_path
+        self.clip_dir = clip_dir
+        self.fps = fps
+        self.max_queued = max_queued
+        self.max_frame_bytes = max_frame_bytes
+        self.budget_us = budget_us
+        self.chunk_bytes = chunk_bytes
+        self.mounted = False
+        self.camera = None
+        self.free = []  # preallocated while the first clip opens
+        self.queue = []  # [buffer, length] oldest first
+        self.written = 0  # bytes of queue[0] already on the card
+        self.writer = None
+        self._opening = None
+        self._closing = None
+        self.recording = False
+        self.path = None
+        self._next_capture_ms = 0
+        self._start_ms = 0
+        self._stop_ms = None
+        self.unit_ns = 0  # how long one chunk write or index slice has been taking
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.captured = 0
+        self.frames_written = 0
+        self.dropped = 0  # pushed out of a full queue
+        self.failed = 0  # larger than a buffer, or not a JPEG
+        self.steps = 0
+        self.max_step_us = 0
+        self.over_budget = 0  # steps longer than budget_us, e.g. a FAT cluster allocation
+
+    @property
+    def busy(self) -> bool:
+        """Opening, recording, or still draining the queue and closing the clip."""
+        return self._opening is not None or self.recording or self.writer is not None
+
+    def start(self, now_ms: int = None) -> bool:
+        """Ask for a clip; step() opens what is not open yet, then starts recording."""
+        if self.busy:
+            return False
+        self._opening = self._open_steps()
+        return True
+
+    def _open_steps(self):
+        # whatever an earlier, stopped or failed, open got done is kept
+        if not self.mounted:
+            self.mount_sd(self.sd_path)
+            self.mounted = True
+            yield
+        if self.camera is None:
+            self.camera = self.start_camera()
+            yield
+        while len(self.free) < self.max_queued:
+            self.free.append(bytearray(self.max_frame_bytes))
+            yield
+        try:
+            os.mkdir(self.clip_dir)
+        except OSError:
+            pass
+        yield
+
+    def _open_step(self, now_ms: int):
+        try:
+            next(self._opening)
+            return
+        except StopIteration:
+            self._opening = None
+        except Exception as error:
+            self._opening = None
+            print("camera unavailable:", repr(error))
+            return
+        self.path = f"{self.clip_dir}/{int(time.time())}.avi"
+        self.writer = MjpegAviWriter(self.path, self.fps)
+        self.reset_stats()
+        self.recording = True
+        self._start_ms = now_ms
+        self._stop_ms = None
+        self._next_capture_ms = now_ms
+        print("camera recording", self.path)
+
+    def stop(self, now_ms: int = None):
+        """Stop taking frames; the queued ones are still written before the clip is closed."""
+        if self._opening is not None:
+            self._opening = None
+            print("camera stopped before recording")
+        if self.recording:
+            self.recording = False
+            self._stop_ms = now_ms if now_ms is not None else time.monotonic_ns() // 1000000
+
+    def toggle(self, now_ms: int = None):
+        if now_ms is None:
+            now_ms = time.monotonic_ns() // 1000000
+        if self.recording or self._opening is not None:
+            self.stop(now_ms)
+        else:
+            self.start(now_ms)
+
+    def stats(self) -> dict:
+        return {
+            "recording": self.recording,
+            "queued": len(self.queue),
+            "max_queued": self.max_queued,
+            "captured": self.captured,
+            "written": self.frames_written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "steps": self.steps,
+            "max_step_us": self.max_step_us,
+            "over_budget": self.over_budget,
+        }
+
+    def step(self, now_ms: int):
+        if self._opening is not None:
+            self._open_step(now_ms)
+            return
+        if self.writer is None:
+            return
+        start_ns = time.monotonic_ns()
+        budget_ns = self.budget_us * 1000
+        if self.recording and now_ms >= self._next_capture_ms:
+            self._capture(now_ms)
+        # one unit of work per step at least, then stop before one that would likely run past the budget
+        unit_start_ns = time.monotonic_ns()
+        first = True
+        while first or unit_start_ns - start_ns + self.unit_ns <= budget_ns:
+            first = False
+            if self._closing is not None:
+                try:
+                    next(self._closing)
+                except StopIteration:
+                    self._closed()
+                    break
+            elif self.queue:
+                self._write_chunk()
+            elif not self.recording:
+                elapsed_ms = self._stop_ms - self._start_ms
+                self._closing = self.writer.close_steps(self.writer.frames * 1000 / elapsed_ms if elapsed_ms > 0 else None)
+            else:
+                break
+            now_ns = time.monotonic_ns()
+            # slowest recent unit, decaying so one slow FAT allocation does not stall writing for long
+            unit_ns = now_ns - unit_start_ns
+            self.unit_ns = unit_ns if unit_ns > self.unit_ns else self.unit_ns - (self.unit_ns >> 4)
+            unit_start_ns = now_ns
+        step_us = (time.monotonic_ns() - start_ns) // 1000
+        self.steps += 1
+        if step_us > self.max_step_us:
+            self.max_step_us = step_us
+        if step_us > self.budget_us:
+            self.over_budget += 1
+
+    def _capture(self, now_ms: int):
+        if self.frames_written + len(self.queue) >= self.writer.max_frames:
+            self.stop(now_ms)
+            return
+        frame = self.camera.take(0)
+        if frame is None:
+            return  # nothing ready yet, try again next step
+        self._next_capture_ms += 1000 // self.fps
+        if self._next_capture_ms <= now_ms:
+            self._next_capture_ms = now_ms + 1000 // self.fps
+        length = len(frame)
+        if length > self.max_frame_bytes:
+            self.failed += 1
+            return
+        if not self.free:
+            # drop the oldest frame that is not half way onto the card
+            index = 1 if self.written else 0
+            if index >= len(self.queue):
+                self.dropped += 1
+                return
+            self.free.append(self.queue.pop(index)[0])
+            self.dropped += 1
+        buffer = self.free.pop()
+        buffer[:length] = frame
+        self.queue.append([buffer, length])
+        self.captured += 1
+
+    def _write_chunk(self):
+        buffer, length = self.queue[0]
+        frame = memoryview(buffer)[:length]
+        if not self.written and not self.writer.begin_frame(frame):
+            self.failed += 1
+            self._pop_frame()
+            return
+        end = min(self.written + self.chunk_bytes, length)
+        self.writer.write_data(frame[self.written:end])
+        self.written = end
+        if end == length:
+            self.writer.end_frame()
+            self.frames_written += 1
+            self._pop_frame()
+
+    def _pop_frame(self):
+        self.free.append(self.queue.pop(0)[0])
+        self.written = 0
+
+    def _closed(self):
+        self._closing = None
+        stats = self.stats()
+        print(f"camera saved {self.path}: {self.writer.frames} frames, {stats['dropped']} dropped, {stats['failed']} failed, max step {stats['max_step_us']}us")
+        self.writer = None
@@ -0,0 +1,63 @@
+import json
+import time
+
+import board
+import busio
+import digitalio
+import storage
+import usb_hid
+
+from lib.nkro import create_nkro_device
+
+# hold this key while resetting to let code.py write CIRCUITPY (key log, keymap cache);
+# the host then sees the drive read-only until the next reset without it
+WRITABLE_KEY = "ESCAPE"
+PHYSICAL_KEY_CONFIG_PATH = "config/physical_key_name_map.json"
+SCAN_BYTES = 9
+
+
+def key_held(key_name):
+    """Read the shift registers once, with the same wiring as code.py, and free the pins again."""
+    try:
+        key_id = json.load(open(PHYSICAL_KEY_CONFIG_PATH))[key_name]
+    except (OSError, ValueError, KeyError):
+        return False
+    pl = digitalio.DigitalInOut(board.GPIO12)
+    pl.direction = digitalio.Direction.OUTPUT
+    ce = digitalio.DigitalInOut(board.GPIO13)
+    ce.direction = digitalio.Direction.OUTPUT
+    ce.value = False
+    spi = busio.SPI(board.GPIO11, MOSI=None, MISO=board.GPIO14)
+    registers = bytearray(SCAN_BYTES)
+    try:
+        pl.value = False
+        time.sleep(1e-6)
+        pl.value = True
+        while not spi.try_lock():
+            pass
+        try:
+            spi.readinto(registers)
+        finally:
+            spi.unlock()
+    finally:
+        spi.deinit()
+        ce.deinit()
+        pl.deinit()
+    # pressed keys read as 0
+    return not registers[key_id >> 3] & (0x80 >> (key_id & 7))
+
+
+if key_held(WRITABLE_KEY):
+    storage.remount("/", readonly=False)
+    print("CIRCUITPY writable by code.py, read-only to the host")
+
+# keep the boot-protocol keyboard first: adafruit_hid Keyboard ("usb_hid" mode) picks the first match
+usb_hid.enable(
+    (
+        usb_hid.Device.KEYBOARD,
+        create_nkro_device(usb_hid),
+        usb_hid.Device.MOUSE,
+        usb_hid.Device.CONSUMER_CONTROL,
+    ),
+    boot_device=1,
+)
@@ -3,31 +3,73 @@ import board
 import busio
 import digitalio
 import usb_hid
-import random
-import json
 import _bleio
+import supervisor
 
 import neopixel
 
-from adafruit_ble import BLERadio
-from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
-from adafruit_ble.services.standard.hid import HIDService
 from adafruit_hid.keyboard import Keyboard
 from adafruit_hid.keycode import Keycode
 
 from lib.ch9329 import CH9329
+from lib.nkro import NKROKeyboard
+from lib.hid_batch import BatchedKeyboard
+from lib.key_buffer import KeyBuffer
+from lib.fanout import SendQueue
+from lib.debounce import load_debouncer
+from lib.key_health import KeyHealthMonitor
+from lib.keymap_cache import load_keymap, default_layers_config, FN_LAYER
+from lib.keymap_reload import KeymapReloader, SerialConsole
+from lib.macros import MacroEngine, load_macros, parse_macro_action
+from lib.combos import load_combo_engine
+from lib.analytics import KeyEventRecorder
+from lib.lighting import LightRenderer
+from lib.effects import EffectEngine, EFFECTS
+from lib.scheduler import Scheduler, PRIORITY_REALTIME, PRIORITY_BACKGROUND, run_to_completion
+from lib.layers import LayerStack, parse_layer_action, LAYER_MOMENTARY, LAYER_TOGGLE, LAYER_ONESHOT, LAYER_TAP_HOLD
+from lib.power import PowerManager, POWER_ACTIVE, POWER_IDLE, POWER_SLEEP
+from lib.profiler import LatencyProfiler, STAGE_SPI, STAGE_DECODE, STAGE_LAYER, STAGE_HID, STAGE_LIGHT, STAGE_SCAN
 
 
 scan_interval = 0.001
+power_management = True  # slow the scan and turn the lights off while the keys are untouched
+idle_after_ms = 30000
+sleep_after_ms = 300000
+idle_scan_interval = 0.01
+sleep_scan_interval = 0.02  # keep below the shortest tap (about 30 ms) so no press is missed
+idle_lights_off = True
+sleep_mos_value = None  # MOS_PIN level while asleep; None leaves the pin alone
 min_light_level_step = 4
 light_level = 4
 max_light_level = 255
-light_mode = "random_static"  # "on_press", "random_static"
+light_mode = "random_static"  # "on_press", "random_static", "fade", "ripple", "heatmap"
+light_fps = 30
 light_keys_on_start = ["W", "A", "S", "D"]
-on_start_keyboard_mode = "usb_hid"
+ch9329_baudrate = 115200  # negotiated with the chip between scans the first time "ch9329" mode is selected
+ch9329_ack = True  # resend key frames the chip does not acknowledge
+key_overflow_policy = "newest_wins"  # 6-key reports: "newest_wins" or "oldest_first"
+ble_connection_interval_ms = 7.5  # requested from the host, which may grant a longer one
+on_start_keyboard_mode = "usb_nkro"  # "usb_nkro", "usb_hid" (boot protocol, 6 keys), "ch9329", "bluetooth", "fanout"
+fanout_modes = ["usb_nkro", "ch9329", "bluetooth"]  # transports "fanout" mode sends every report to
 physical_key_config_path = "config/physical_key_name_map.json"
 mapping_config_path = "config/mapping.json"
 fn_mapping_config_path = "config/fn_mapping.json"
+layers_config_path = "config/layers.json"
+keymap_cache_path = "config/keymap.bin"  # compiled from the json keymaps, rebuilt when one of them changes
+hot_reload_keymap = True  # reload keymap edits and console keymaps without restarting; turns off CircuitPython autoreload
+keymap_check_interval_ms = 1000
+tap_hold_ms = 200
+debounce_config_path = "config/debounce.json"
+key_health_monitor = True  # mask register glitches, stuck and chattering keys until they recover
+stuck_key_ms = None  # mask a key held this long, None: never; modifiers and layer keys are never masked
+macros_config_path = "config/macros.json"
+combos_config_path = "config/combos.json"  # keys pressed together within term_ms act as one
+record_key_events = True  # keep a press/release log for tools/decode_keylog.py
+analytics_log_path = "analytics.bin"
+camera_clip_dir = "/sd/video"  # Fn+C records with the camera module, when its lib files are installed
+camera_fps = 10
+camera_max_queued = 3
+camera_step_budget_us = 1000  # longest the camera may hold up a scan
 
 CE_PIN = board.GPIO13  # Chip Enable pin
 PL_PIN = board.GPIO12  # Parallel Load pin
@@ -41,6 +83,7 @@ TX_PIN = board.GPIO47
 RX_PIN = board.GPIO48
 
 num_pixels = 68
+SCAN_BYTES = 9  # 9 cascaded shift registers, 72 bits
 ORDER = neopixel.GRB
 
 pixels = neopixel.NeoPixel(pixel_pin, num_pixels, brightness=1, auto_write=False, pixel_order=ORDER)
@@ -66,35 +109,41 @@ mos_io.value = False
 
 uart = busio.UART(TX_PIN, RX_PIN, baudrate=9600)
 
+scan_buffer = bytearray(SCAN_BYTES)
+NO_KEY_IDS = ()
+
 light_2_key = [66, 65, 64, 63, 70, 69, 68, 50, 49, 48, 47, 54, 46, 39, 38, 31, 30, 23, 22, 18, 14, 7, 67, 55, 62, 8, 13, 17, 21, 24, 29, 32, 37, 40, 45, 53, 52, 44, 41, 36, 33, 28, 25, 20, 16, 12, 9, 61, 58, 56, 51, 43, 42, 35, 34, 27, 26, 19, 15, 11, 10, 60, 59, 57, 6, 5, 4, 3]
+light_renderer = LightRenderer(pixels, light_2_key, max_light_level)
+# key rows front to back, for effects that need to know where keys are; widths in quarter keys
+light_key_rows = [
+    ["ESCAPE", "ONE", "TWO", "THREE", "FOUR", "FIVE", "SIX", "SEVEN", "EIGHT", "NINE", "ZERO", "MINUS", "EQUALS", "BACKSPACE", "INSERT"],
+    ["TAB", "Q", "W", "E", "R", "T", "Y", "U", "I", "O", "P", "LEFT_BRACKET", "RIGHT_BRACKET", "BACKSLASH", "DELETE"],
+    ["CAPS_LOCK", "A", "S", "D", "F", "G", "H", "J", "K", "L", "SEMICOLON", "QUOTE", "ENTER", "PAGE_UP"],
+    ["LEFT_SHIFT", "Z", "X", "C", "V", "B", "N", "M", "COMMA", "PERIOD", "FORWARD_SLASH", "RIGHT_SHIFT", "UP_ARROW", "PAGE_DOWN"],
+    ["LEFT_CONTROL", "LEFT_GUI", "LEFT_ALT", "SPACEBAR", "RIGHT_ALT", "Fn", "RIGHT_CONTROL", "LEFT_ARROW", "DOWN_ARROW", "RIGHT_ARROW"],
+]
+light_key_widths = {"BACKSPACE": 8, "TAB": 6, "BACKSLASH": 6, "CAPS_LOCK": 7, "ENTER": 9, "LEFT_SHIFT": 9, "RIGHT_SHIFT": 7, "LEFT_CONTROL": 5, "LEFT_GUI": 5, "LEFT_ALT": 5, "SPACEBAR": 25}
+latency_profiler = LatencyProfiler()
 
 
 class PhysicalKey:
-    def __init__(self, key_id: int, key_name: str, max_light_level: int = max_light_level) -> None:
+    def __init__(self, key_id: int, key_name: str) -> None:
         self.physical_id = key_id
         self.key_name = key_name
         self.pressed = False
-        self.color = (max_light_level, max_light_level, max_light_level)
-        self.random_color(max_light_level)
         # TODO: add used mark to avoid conflict
-    
-    def random_color(self, max_light_level):
-        self.color = (
-            random.randint(0, max_light_level),
-            random.randint(0, max_light_level),
-            random.randint(0, max_light_level)
-        )
 
 
 class VirtualKey:
-    def __init__(self, key_name: str, keycode: int, bind_physical_key: PhysicalKey, pressed_function=None) -> None:
+    def __init__(self, key_name: str, keycode: int, bind_physical_key: PhysicalKey, pressed_function=None, released_function=None) -> None:
         self.keycode = keycode
         self.key_name = key_name
         self.pressed_function = pressed_function  # TODO: rename
+        self.released_function = released_function
         # TODO: press condition function
         self.bind_physical_key = bind_physical_key
         self.pressed = False
-        self.update_time = time.time()
+        self.update_time = 0  # scan clock ms of the last press or release
 
     # TODO: @property
     def is_pressed(self):
@@ -112,75 +161,274 @@ class VirtualKey:
         
     def release(self):
         self.pressed = False
+        if self.released_function:
+            self.released_function()
         return None
 
 
 class VirtualKeyBoard:
     def __init__(self, mode=on_start_keyboard_mode, usb_timeout=1):
-        self.mode = mode
-        
-        # print("init ble_keyboard")
-        self.adapter = _bleio.adapter
-        if not self.adapter.enabled:
-            self.adapter.enabled = True
-
-        # 获取并打印蓝牙MAC地址
-        self.mac_address = self.adapter.address
-        print("Bluetooth MAC Address:", self.mac_address)
-        self.ble = BLERadio()
-        self.ble_hid = HIDService()
-        self.advertisement = ProvideServicesAdvertisement(self.ble_hid)
-        self.advertisement.appearance = 961
-        self.advertisement.short_name = "s68k"
-        self.advertisement.complete_name = "s68k esp32s3 keyboard"
-        self.ble_keyboard = Keyboard(self.ble_hid.devices)
-        # self.ble_keyboard = None
-
-        # print("init usb_hid_keyboard")
-        try:
-            self.usb_hid_keyboard = Keyboard(usb_hid.devices, timeout=usb_timeout)
-        except:
-            # print("failed to init usb_hid_keyboard")
-            self.usb_hid_keyboard = None
-
-        # print("init ch9329_keyboard")
-        self.ch9329_keyboard = CH9329(uart)
+        # transports are created the first time set_mode() selects them
+        self.mode = None
+        self.adapter = None
+        self.ble_transport = None
+        self.usb_hid_keyboard = None
+        self.usb_nkro_keyboard = None
+        self.ch9329_keyboard = None
+        self.ch9329_baudrate = None
+        self._ch9329_negotiation = None  # negotiate_baudrate_steps() while it runs
+        self.fanout_queues = []  # a SendQueue per transport in "fanout" mode
+
+        self._batch_keycodes = []  # keycodes staged since the last commit
+        self.held_keys = KeyBuffer()  # what the host should see held, carried over when the mode changes
     
-        self.set_mode(self.mode)
+        self.set_mode(mode, usb_timeout)
         self.reset()
 
-    def erase_bonding(self):
-        self.adapter.erase_bonding()
+    def enable_adapter(self):
+        if self.adapter is None:
+            self.adapter = _bleio.adapter
+            if not self.adapter.enabled:
+                self.adapter.enabled = True
 
-    def set_mode(self, mode, usb_timeout=1):
-        # print(f"set mode to: {mode}")
-        if mode == "bluetooth" and self.mode != "bluetooth":
-            if not self.ble.advertising:
-                self.ble.start_advertising(self.advertisement)
-        elif self.mode == "bluetooth" and mode != "bluetooth":
-            if self.ble.advertising:
-                self.ble.stop_advertising()
+            # 获取并打印蓝牙MAC地址
+            self.mac_address = self.adapter.address
+            print("Bluetooth MAC Address:", self.mac_address)
+        return self.adapter
 
-        self.mode = mode
+    def erase_bonding(self):
+        self.enable_adapter().erase_bonding()
+
+    def open_transport(self, mode, usb_timeout=1):
+        """Create the transport for mode if needed; returns the mode that ends up usable."""
+        if mode == "usb_nkro" and self.usb_nkro_keyboard is None:
+            try:
+                self.usb_nkro_keyboard = NKROKeyboard(usb_hid.devices)
+            except ValueError:
+                # boot.py did not register the NKRO descriptor, fall back to the boot-protocol keyboard
+                mode = "usb_hid"
 
         if mode == "usb_hid" and self.usb_hid_keyboard is None:
             try:
-                self.usb_hid_keyboard = Keyboard(usb_hid.devices, timeout=usb_timeout)
+                self.usb_hid_keyboard = BatchedKeyboard(Keyboard(usb_hid.devices, timeout=usb_timeout), key_overflow_policy)
             except:
                 # print("failed to init usb_hid_keyboard")
                 self.usb_hid_keyboard = None
-                self.mode = "dummy"
+                mode = "dummy"
+
+        if mode == "ch9329" and self.ch9329_keyboard is None:
+            self.ch9329_keyboard = CH9329(uart, ack=ch9329_ack, overflow_policy=key_overflow_policy)
+            # stepped from poll(), a silent chip would otherwise hold up the key press that selected it
+            self._ch9329_negotiation = self.ch9329_keyboard.negotiate_baudrate_steps(ch9329_baudrate)
+
+        if mode == "bluetooth" and self.ble_transport is None:
+            # adafruit_ble takes a while to import, only pay for it when bluetooth is used
+            from lib.ble_transport import BLETransport
+            self.enable_adapter()
+            self.ble_transport = BLETransport(connection_interval_ms=ble_connection_interval_ms, overflow_policy=key_overflow_policy)
+
+        if mode == "fanout":
+            if not self.fanout_queues:
+                for fanout_mode in fanout_modes:
+                    fanout_mode = self.open_transport(fanout_mode, usb_timeout)
+                    if fanout_mode != "dummy" and fanout_mode not in self.transport_modes("fanout"):
+                        self.fanout_queues.append(self._send_queue(fanout_mode))
+            if not self.fanout_queues:
+                mode = "dummy"
+
+        return mode
+
+    def _send_queue(self, mode):
+        if mode == "usb_nkro":
+            keyboard = self.usb_nkro_keyboard
+            return SendQueue(mode, keyboard.press, keyboard.release, keyboard.commit)
+        if mode == "usb_hid":
+            keyboard = self.usb_hid_keyboard
+            return SendQueue(mode, keyboard.press, keyboard.release, keyboard.commit)
+        if mode == "ch9329":
+            ch9329_keyboard = self.ch9329_keyboard
+            return SendQueue(mode, ch9329_keyboard.keyboard_press_many, ch9329_keyboard.keyboard_release_many, ch9329_keyboard.keyboard_commit, lambda: ch9329_keyboard.ready)
+        if mode == "bluetooth":
+            ble_transport = self.ble_transport
+            # while disconnected the transport keeps the final state itself, nothing to wait for
+            return SendQueue(mode, ble_transport.press, ble_transport.release, ble_transport.commit, lambda: not ble_transport.connected or ble_transport.ready())
+        raise NotImplementedError(f"fanout mode: {mode}")
+
+    def transport_modes(self, mode):
+        """The transports a mode sends to."""
+        if mode == "fanout":
+            return [queue.name for queue in self.fanout_queues]
+        if mode is None or mode == "dummy":
+            return []
+        return [mode]
+
+    def set_mode(self, mode, usb_timeout=1):
+        # print(f"set mode to: {mode}")
+        mode = self.open_transport(mode, usb_timeout)
+        old_modes = self.transport_modes(self.mode)
+        new_modes = self.transport_modes(mode)
+
+        # hand held keys over in one go: released where reports stop going, pressed again where they start
+        try:
+            if self.mode == "fanout":
+                for queue in self.fanout_queues:
+                    queue.flush()
+            for old_mode in old_modes:
+                if old_mode not in new_modes:
+                    self._release_all_on(old_mode)
+        except OSError:
+            pass  # switching away from a transport that failed, it cannot take the releases either
+
+        if "bluetooth" in new_modes and "bluetooth" not in old_modes:
+            self.ble_transport.start()
+        elif "bluetooth" in old_modes and "bluetooth" not in new_modes:
+            self.ble_transport.stop()
+
+        self.mode = mode
+        if self.held_keys.count:
+            held_keycodes = self.held_keys.keycodes()
+            for new_mode in new_modes:
+                if new_mode not in old_modes:
+                    self._press_on(new_mode, held_keycodes)
+
+    def _press_on(self, mode, keycodes):
+        # sent straight away, around any fanout queue, so the switch lands in one report
+        if mode == "usb_nkro":
+            self.usb_nkro_keyboard.press(*keycodes)
+            self.usb_nkro_keyboard.commit()
+        elif mode == "usb_hid":
+            self.usb_hid_keyboard.press(*keycodes)
+            self.usb_hid_keyboard.commit()
+        elif mode == "ch9329":
+            self.ch9329_keyboard.keyboard_press_many(*keycodes)
+            self.ch9329_keyboard.keyboard_commit()
+        elif mode == "bluetooth":
+            self.ble_transport.press(*keycodes)
+            self.ble_transport.commit()
+
+    def _release_all_on(self, mode):
+        if mode == "usb_nkro":
+            self.usb_nkro_keyboard.release_all()
+            self.usb_nkro_keyboard.commit()
+        elif mode == "usb_hid":
+            self.usb_hid_keyboard.release_all()
+        elif mode == "ch9329":
+            self.ch9329_keyboard.keyboard_release_all()
+        elif mode == "bluetooth":
+            self.ble_transport.release_all()
     
     def reset(self):
+        for queue in self.fanout_queues:
+            queue.clear()
+        if self.usb_nkro_keyboard is not None:
+            self.usb_nkro_keyboard.release_all()
+            self.usb_nkro_keyboard.commit()
         if self.usb_hid_keyboard is not None:
             self.usb_hid_keyboard.release_all()
         if self.ch9329_keyboard is not None:
             self.ch9329_keyboard.keyboard_release_all()
-        if self.ble_keyboard is not None:
-            self.ble_keyboard.release_all()
+        if self.ble_transport is not None:
+            self.ble_transport.release_all()
+        self.held_keys.clear()
+
+    def _stage(self, keycodes):
+        # a key changing twice in one batch (a tap) needs its first edge sent on its own
+        for keycode in keycodes:
+            if keycode in self._batch_keycodes:
+                self.commit()
+                break
+        for keycode in keycodes:
+            self._batch_keycodes.append(keycode)
+
+    def commit(self) -> None:
+        """Send everything staged by press_many() and release_many() as one report."""
+        if not self._batch_keycodes:
+            return
+        self._batch_keycodes.clear()
+        try:
+            if self.mode == "usb_nkro":
+                self.usb_nkro_keyboard.commit()
+            elif self.mode == "usb_hid":
+                self.usb_hid_keyboard.commit()
+            elif self.mode == "ch9329":
+                self.ch9329_keyboard.keyboard_commit()
+            elif self.mode == "bluetooth":
+                self.ble_transport.commit()
+            elif self.mode == "fanout":
+                for queue in self.fanout_queues:
+                    queue.end_report()
+                self._pump()
+        except OSError:
+            self.set_mode("dummy")
+
+    def _pump(self):
+        # each transport takes what it can; a failing one is dropped, the others still get their turn
+        queues = self.fanout_queues
+        index = 0
+        while index < len(queues):
+            queue = queues[index]
+            try:
+                queue.pump()
+            except OSError as error:
+                print(f"fanout: {queue.name} failed, dropped:", repr(error))
+                del queues[index]
+                if not queues:
+                    self.mode = "dummy"
+                continue
+            index += 1
+
+    def ready(self) -> bool:
+        """Whether the active transport can take another report right away."""
+        if self.mode == "ch9329":
+            return self.ch9329_keyboard.ready
+        if self.mode == "bluetooth":
+            return self.ble_transport.ready()
+        if self.mode == "fanout":
+            # paced by the slowest transport once its queue is nearly full, so macros are not merged away
+            for queue in self.fanout_queues:
+                if not queue.ready():
+                    return False
+        return True
+
+    def poll(self) -> None:
+        """Non-blocking transport housekeeping, once per scan."""
+        if self._ch9329_negotiation is not None:
+            try:
+                next(self._ch9329_negotiation)
+            except StopIteration as stop:
+                self._ch9329_negotiation = None
+                self.ch9329_baudrate = stop.value
+                print("ch9329: link at", self.ch9329_baudrate, "baud")
+        if self.mode == "ch9329":
+            self.ch9329_keyboard.poll()
+        elif self.mode == "bluetooth":
+            self.ble_transport.poll()
+        elif self.mode == "fanout":
+            if self.ch9329_keyboard is not None:
+                self.ch9329_keyboard.poll()
+            if self.ble_transport is not None:
+                self.ble_transport.poll()
+            self._pump()
+
+    def fanout_stats(self) -> dict:
+        return {queue.name: queue.stats() for queue in self.fanout_queues}
 
     def press(self, *keycodes: int) -> None:
-        if self.mode == "usb_hid":
+        self.press_many(*keycodes)
+        self.commit()
+
+    def release(self, *keycodes: int) -> None:
+        self.release_many(*keycodes)
+        self.commit()
+
+    def press_many(self, *keycodes: int) -> None:
+        """Stage key presses; they are sent by the next commit()."""
+        self._stage(keycodes)
+        for keycode in keycodes:
+            self.held_keys.press(keycode, 0)
+        if self.mode == "usb_nkro":
+            self.usb_nkro_keyboard.press(*keycodes)
+        elif self.mode == "usb_hid":
             if self.usb_hid_keyboard is not None:
                 try:
                     self.usb_hid_keyboard.press(*keycodes)
@@ -190,22 +438,30 @@ class VirtualKeyBoard:
                 raise ValueError(f"self.usb_hid_keyboard is None")
         elif self.mode == "ch9329":
             if self.ch9329_keyboard is not None:
-                # TODO: add warning or sort by time
-                self.ch9329_keyboard.keyboard_press(*keycodes[:6])
+                self.ch9329_keyboard.keyboard_press_many(*keycodes)
             else:
                 print(f"self.ch9329_keyboard is None")
         elif self.mode == "bluetooth":
-            if self.ble_keyboard is not None:
-                self.ble_keyboard.press(*keycodes)
+            if self.ble_transport is not None:
+                self.ble_transport.press(*keycodes)
             else:
-                raise ValueError(f"self.ble_keyboard is None")
+                raise ValueError(f"self.ble_transport is None")
+        elif self.mode == "fanout":
+            for queue in self.fanout_queues:
+                queue.press(*keycodes)
         elif self.mode == "dummy":
             pass
         else:
             raise NotImplementedError(f"self.mode: {self.mode}")
 
-    def release(self, *keycodes: int) -> None:
-        if self.mode == "usb_hid":
+    def release_many(self, *keycodes: int) -> None:
+        """Stage key releases; they are sent by the next commit()."""
+        self._stage(keycodes)
+        for keycode in keycodes:
+            self.held_keys.release(keycode)
+        if self.mode == "usb_nkro":
+            self.usb_nkro_keyboard.release(*keycodes)
+        elif self.mode == "usb_hid":
             if self.usb_hid_keyboard is not None:
                 try:
                     self.usb_hid_keyboard.release(*keycodes)
@@ -215,14 +471,17 @@ class VirtualKeyBoard:
                 print(f"self.usb_hid_keyboard is None")
         elif self.mode == "ch9329":
             if self.ch9329_keyboard is not None:
-                self.ch9329_keyboard.keyboard_release(*keycodes)
+                self.ch9329_keyboard.keyboard_release_many(*keycodes)
             else:
                 raise ValueError(f"self.ch9329_keyboard is None")
         elif self.mode == "bluetooth":
-            if self.ble_keyboard is not None:
-                self.ble_keyboard.release(*keycodes)
+            if self.ble_transport is not None:
+                self.ble_transport.release(*keycodes)
             else:
-                raise ValueError(f"self.ble_keyboard is None")
+                raise ValueError(f"self.ble_transport is None")
+        elif self.mode == "fanout":
+            for queue in self.fanout_queues:
+                queue.release(*keycodes)
         elif self.mode == "dummy":
             pass
         else:
@@ -235,30 +494,84 @@ def partial(func, *args):
     return wrapper
 
 
-def generate_standard_layer():
-    standard_layer = {
-        physical_key.physical_id: VirtualKey(physical_key.key_name, getattr(Keycode, physical_key.key_name), bind_physical_key=physical_key) for physical_key in physical_keys if physical_key.key_name in dir(Keycode)
-    }
-    return standard_layer
+def generate_layer_action_key(key_name, physical_key, action, layer_stack, layer_names):
+    kind, layer_name, tap_key_name = action
+    layer = layer_names.index(layer_name)
+    if kind == LAYER_MOMENTARY:
+        return VirtualKey(key_name, 0, physical_key, partial(layer_stack.momentary_on, layer), partial(layer_stack.momentary_off, layer))
+    if kind == LAYER_TOGGLE:
+        return VirtualKey(key_name, 0, physical_key, partial(layer_stack.toggle, layer))
+    if kind == LAYER_ONESHOT:
+        return VirtualKey(key_name, 0, physical_key, partial(layer_stack.oneshot_press, layer), partial(layer_stack.oneshot_release, layer))
+    if kind == LAYER_TAP_HOLD:
+        args = (physical_key.physical_id, layer, getattr(Keycode, tap_key_name))
+        return VirtualKey(key_name, 0, physical_key, partial(layer_stack.tap_hold_press, *args), partial(layer_stack.tap_hold_release, *args))
+    raise NotImplementedError(f"layer action: {kind}")
+
+
+def generate_macro_key(key_name, physical_key, macro_name, macro_engine):
+    if macro_engine is None or macro_name not in macro_engine.macros:
+        raise ValueError(f"unknown macro: {key_name}")
+    return VirtualKey(key_name, 0, physical_key, partial(macro_engine.play, macro_name))
+
+
+def generate_compiled_layer(entries, layer_stack, layer_names, macro_engine=None):
+    """Build a VirtualKey layer from one CompiledKeymap layer; every Keycode lookup was done when it was compiled."""
+    layer = {}
+    for physical_id, keycode, value in entries:
+        physical_key = physical_key_id_map[physical_id]
+        macro_name = parse_macro_action(value)
+        if keycode:
+            layer[physical_id] = VirtualKey(value, keycode, physical_key)
+        elif macro_name is not None:
+            layer[physical_id] = generate_macro_key(value, physical_key, macro_name, macro_engine)
+        else:
+            layer[physical_id] = generate_layer_action_key(value, physical_key, parse_layer_action(value), layer_stack, layer_names)
+    return layer
+
+
+class LayerTable:
+    """A layer compiled into flat tables indexed by physical id."""
 
+    def __init__(self, layer: dict, key_count: int = SCAN_BYTES * 8) -> None:
+        self.keycodes = bytearray(key_count)
+        self.virtual_keys = [None] * key_count
+        for physical_id, virtual_key in layer.items():
+            self.keycodes[physical_id] = virtual_key.keycode
+            self.virtual_keys[physical_id] = virtual_key
 
-def generate_custom_layer():
-    layer = generate_standard_layer()
-    mapping = json.load(open(mapping_config_path))  # TODO: debug light
-    for k, v in mapping.items():
-        layer[physical_key_map[k].physical_id] = VirtualKey(v, getattr(Keycode, v), physical_key_map[k])
-    return layer
 
+def compile_layers(layers):
+    return [LayerTable(layer) for layer in layers]
 
-def generate_fn_layer():
-    layer = generate_standard_layer()
-    mapping = json.load(open(fn_mapping_config_path))  # TODO: debug light
-    for k, v in mapping.items():
-        layer[physical_key_map[k].physical_id] = VirtualKey(v, getattr(Keycode, v), physical_key_map[k])
-    return layer
+
+def build_layer_masks(layer_tables, key_count=SCAN_BYTES * 8):
+    # bit n of layer_masks[physical_id] is set when layer n defines that key
+    layer_masks = bytearray(key_count)
+    for layer_id, layer_table in enumerate(layer_tables):
+        for physical_id in range(key_count):
+            if layer_table.virtual_keys[physical_id] is not None:
+                layer_masks[physical_id] |= 1 << layer_id
+    return layer_masks
 
 
-def read_shift_registers(delay=1e-6):
+def build_hold_key_ids(layer_tables, key_count=SCAN_BYTES * 8):
+    # keys held for long on purpose on some layer: modifiers and layer keys
+    key_ids = []
+    for physical_id in range(key_count):
+        for layer_table in layer_tables:
+            keycode = layer_table.keycodes[physical_id]
+            virtual_key = layer_table.virtual_keys[physical_id]
+            if Keycode.LEFT_CONTROL <= keycode <= Keycode.RIGHT_GUI or virtual_key is not None and not keycode and parse_layer_action(virtual_key.key_name) is not None:
+                key_ids.append(physical_id)
+                break
+    return key_ids
+
+
+def read_shift_registers(delay=1e-6, result=None):
+    if result is None:
+        result = scan_buffer
+
     pl.value = False
     time.sleep(delay)
     pl.value = True
@@ -267,33 +580,79 @@ def read_shift_registers(delay=1e-6):
         pass
 
     try:
-        result = bytearray(9)
         spi.readinto(result)
     finally:
         spi.unlock()
 
-    bits = []
-    for byte in result:
-        for i in range(8):
-            bits.append((byte >> (7 - i)) & 1)
-    return bits
+    return result
+
 
+def build_key_mask(key_ids):
+    key_mask = bytearray(SCAN_BYTES)
+    for key_id in key_ids:
+        key_mask[key_id >> 3] |= 0x80 >> (key_id & 7)
+    return key_mask
 
-def get_pressed_key_ids(register_bits):
-    pressed_key_ids = [physical_key_id for physical_key_id in physical_key_ids if not register_bits[physical_key_id]]
+
+def decode_pressed(register_bytes, key_mask, pressed_bytes):
+    # pressed keys read as 0, unused bits are dropped by key_mask
+    for i in range(SCAN_BYTES):
+        pressed_bytes[i] = ~register_bytes[i] & key_mask[i]
+    return pressed_bytes
+
+
+def is_key_pressed(pressed_bytes, key_id):
+    return bool(pressed_bytes[key_id >> 3] & (0x80 >> (key_id & 7)))
+
+
+def get_changed_key_ids(previous_bytes, current_bytes):
+    changed_key_ids = None
+    for i in range(SCAN_BYTES):
+        changed = previous_bytes[i] ^ current_bytes[i]
+        if changed:
+            if changed_key_ids is None:
+                changed_key_ids = []
+            base = i << 3
+            for bit in range(8):
+                if changed & (0x80 >> bit):
+                    changed_key_ids.append(base + bit)
+    if changed_key_ids is None:
+        return NO_KEY_IDS
+    return changed_key_ids
+
+
+def get_pressed_key_ids(pressed_bytes):
+    pressed_key_ids = []
+    for i in range(SCAN_BYTES):
+        byte = pressed_bytes[i]
+        if byte:
+            base = i << 3
+            for bit in range(8):
+                if byte & (0x80 >> bit):
+                    pressed_key_ids.append(base + bit)
     return pressed_key_ids
 
 
-def light_keys(keys, refresh=True, colors=[], color=(16, 16, 16)):
+def build_key_positions(physical_key_name_map):
+    # key centre per physical id, in quarter keys
+    key_positions = {}
+    for row, key_names in enumerate(light_key_rows):
+        x = 0
+        for key_name in key_names:
+            width = light_key_widths.get(key_name, 4)
+            if key_name in physical_key_name_map:
+                key_positions[physical_key_name_map[key_name]] = (x + width // 2, row * 4)
+            x += width
+    return key_positions
+
+
+def light_keys(keys, refresh=True, colors=(), color=(16, 16, 16)):
+    light_renderer.set_light_level(light_level)
     if refresh:
-        for i in range(num_pixels):
-            pixels[i] = (0, 0, 0)
-    while len(colors) < len(keys):
-        colors.append(color)
-    for key_id, key_color in zip(keys, colors):
-        scaled_key_color = (int(key_color[0] * light_level / max_light_level), int(key_color[1] * light_level / max_light_level), int(key_color[2] * light_level / max_light_level))
-        pixels[light_2_key.index(key_id)] = scaled_key_color
-    pixels.show()
+        light_renderer.clear()
+    for i, key_id in enumerate(keys):
+        light_renderer.set_key(key_id, colors[i] if i < len(colors) else color)
+    light_renderer.show()
 
 
 def change_light_level(number, set_mode=False):
@@ -306,34 +665,31 @@ def change_light_level(number, set_mode=False):
     return None
 
 
-def change_light_mode(target_mode=None):  # TODO: refactor
+def change_light_mode(target_mode=None):
     global light_mode, light_level
     if target_mode is None:
-        if light_mode == "on_press":
-            light_mode = "random_static"
-            light_level = min(min_light_level_step, light_level)
-        elif light_mode == "random_static":
-            light_mode = "on_press"
-            light_level = max(max_light_level, light_level)
-        else:
-            light_mode = "on_press"
-    elif target_mode == "on_press":
-        light_mode = "on_press"
-        light_level = max(max_light_level, light_level)
-    elif target_mode == "random_static":
-        light_mode = "random_static"
+        # cycle through the effects
+        index = EFFECTS.index(light_mode) + 1 if light_mode in EFFECTS else 0
+        target_mode = EFFECTS[index % len(EFFECTS)]
+    elif target_mode not in EFFECTS:
+        target_mode = "on_press"
+    light_mode = target_mode
+    if light_mode == "random_static":
         light_level = min(min_light_level_step, light_level)
     else:
-        light_mode = "on_press"
+        light_level = max(max_light_level, light_level)
     return None
 
 
 def main():
-    global physical_key_ids, physical_key_map, fn_key, physical_keys
+    global physical_key_id_map
 
     running = True
 
-    physical_key_name_map = json.load(open(physical_key_config_path))
+    fallback_layers_config = default_layers_config(mapping_config_path, fn_mapping_config_path)
+    macros = load_macros(macros_config_path)
+    keymap = load_keymap(keymap_cache_path, physical_key_config_path, layers_config_path, fallback_layers_config, macros)
+    physical_key_name_map = keymap.physical_key_name_map
     id_key_map = {}
     for k, v in physical_key_name_map.items():
         id_key_map[v] = k
@@ -348,69 +704,258 @@ def main():
     kbd = VirtualKeyBoard()
 
     physical_key_map = {key_name: PhysicalKey(key_id, key_name) for key_name, key_id in physical_key_name_map.items()}
-    fn_key = physical_key_map["Fn"]
     physical_keys = list(physical_key_map.values())
 
     physical_key_ids= list(physical_key_name_map.values())
     physical_key_id_map = {key.physical_id: key for key in physical_keys}
 
-    virtual_key_layers = [
-        generate_custom_layer(),
-        generate_fn_layer(),
-    ]
-    fn_key_layer_id = 1
-    # set fn layer key function
-    virtual_key_layers[fn_key_layer_id][physical_key_map["Q"].physical_id].pressed_function = partial(kbd.set_mode, "usb_hid")  # TODO: getkey function
-    virtual_key_layers[fn_key_layer_id][physical_key_map["W"].physical_id].pressed_function = partial(kbd.set_mode, "ch9329")
-    virtual_key_layers[fn_key_layer_id][physical_key_map["E"].physical_id].pressed_function = partial(kbd.set_mode, "bluetooth")
-    virtual_key_layers[fn_key_layer_id][physical_key_map["R"].physical_id].pressed_function = partial(kbd.set_mode, "dummy")
-    virtual_key_layers[fn_key_layer_id][physical_key_map["BACKSPACE"].physical_id].pressed_function = kbd.erase_bonding
-    virtual_key_layers[fn_key_layer_id][physical_key_map["UP_ARROW"].physical_id].pressed_function = partial(change_light_level, min_light_level_step)
-    virtual_key_layers[fn_key_layer_id][physical_key_map["DOWN_ARROW"].physical_id].pressed_function = partial(change_light_level, -min_light_level_step)
-    virtual_key_layers[fn_key_layer_id][physical_key_map["TAB"].physical_id].pressed_function = change_light_mode
-    
+    layer_stack = LayerStack(kbd, tap_hold_ms=tap_hold_ms)
+    macro_engine = MacroEngine(kbd, macros)
+
+    camera_service = None
+    key_recorder = KeyEventRecorder(analytics_log_path) if record_key_events else None
+
+    def dump_stats():
+        latency_profiler.dump()
+        if kbd.fanout_queues:
+            print("fanout:", kbd.fanout_stats())
+        if kbd.ble_transport is not None:
+            print("bluetooth:", kbd.ble_transport.stats())
+        if key_health is not None:
+            print("key health:", key_health.stats())
+        if key_recorder is not None:
+            print("key log:", key_recorder.stats())
+
+    def toggle_camera():
+        nonlocal camera_service
+        if camera_service is None:
+            try:
+                from lib.camera_service import CameraService
+            except ImportError:
+                print("camera service not installed, copy module/camera/lib into lib")
+                return
+            camera_service = CameraService(clip_dir=camera_clip_dir, fps=camera_fps, max_queued=camera_max_queued, budget_us=camera_step_budget_us)
+            scheduler.add("camera", camera_service.step, priority=PRIORITY_BACKGROUND)
+        camera_service.toggle()
+
+    # fn layer key functions
+    fn_bindings = (
+        ("Q", partial(kbd.set_mode, "usb_nkro")),  # TODO: getkey function
+        ("T", partial(kbd.set_mode, "usb_hid")),
+        ("W", partial(kbd.set_mode, "ch9329")),
+        ("E", partial(kbd.set_mode, "bluetooth")),
+        ("R", partial(kbd.set_mode, "dummy")),
+        ("F", partial(kbd.set_mode, "fanout")),
+        ("BACKSPACE", kbd.erase_bonding),
+        ("UP_ARROW", partial(change_light_level, min_light_level_step)),
+        ("DOWN_ARROW", partial(change_light_level, -min_light_level_step)),
+        ("TAB", change_light_mode),
+        ("P", dump_stats),
+        ("C", toggle_camera),
+    )
+
+    def build_layer_tables(keymap):
+        # generator: one layer per step, returns (layer_tables, layer_masks)
+        virtual_key_layers = []
+        for entries in keymap.layers:
+            virtual_key_layers.append(generate_compiled_layer(entries, layer_stack, keymap.layer_names, macro_engine))
+            yield
+        fn_layer = virtual_key_layers[keymap.layer_names.index(FN_LAYER)]
+        for key_name, function in fn_bindings:
+            physical_key = physical_key_map[key_name]
+            if physical_key.physical_id not in fn_layer:
+                fn_layer[physical_key.physical_id] = VirtualKey(key_name, 0, physical_key)
+            fn_layer[physical_key.physical_id].pressed_function = function
+        layer_tables = compile_layers(virtual_key_layers)
+        yield
+        return layer_tables, build_layer_masks(layer_tables)
+
     virtual_key_layer_id = 0
+    layer_tables, layer_masks = run_to_completion(build_layer_tables(keymap))
+    held_virtual_keys = [None] * (SCAN_BYTES * 8)  # the VirtualKey each held physical id pressed
     light_keys([], colors=[], refresh=True)
     change_light_mode(light_mode)
-
-    while running:
-        register_bits = read_shift_registers()
-        pressed_key_ids = get_pressed_key_ids(register_bits)
-        for key in physical_keys:
-            if key.physical_id in pressed_key_ids:
-                if key.pressed == False:
-                    # kbd.press(key.keycode)
-                    # print(f"Pressed PhysicalKey: {key.key_name}")
-                    key.random_color(max_light_level)
-                    pass
+    effect_engine = EffectEngine(light_renderer, build_key_positions(physical_key_name_map), max_light_level)
+
+    key_mask = build_key_mask(physical_key_ids)
+    debouncer = load_debouncer(debounce_config_path, physical_key_name_map)
+    key_health = KeyHealthMonitor(key_mask, id_key_map, stuck_key_ms, stuck_exempt=build_key_mask(build_hold_key_ids(layer_tables))) if key_health_monitor else None
+    raw_pressed = bytearray(SCAN_BYTES)
+    previous_pressed = bytearray(SCAN_BYTES)
+    current_pressed = bytearray(SCAN_BYTES)
+
+    def set_power_state(state):
+        lights_on = state == POWER_ACTIVE or not idle_lights_off
+        if rgb_io.value != lights_on:
+            rgb_io.value = lights_on
+            if lights_on:
+                # the strip lost its colors with the rail, push the whole frame again
+                light_renderer.show(force=True)
+        if sleep_mos_value is not None:
+            mos_io.value = sleep_mos_value if state == POWER_SLEEP else not sleep_mos_value
+        print("power:", state)
+
+    power_manager = None
+    if power_management:
+        power_manager = PowerManager(set_power_state, idle_after_ms, sleep_after_ms, {POWER_ACTIVE: scan_interval, POWER_IDLE: idle_scan_interval, POWER_SLEEP: sleep_scan_interval})
+
+    hid_ns = 0  # time spent handing reports to the transport in the current scan
+
+    def press_key(key_id, now_ms):
+        nonlocal virtual_key_layer_id, hid_ns
+        layer_stack.before_press(key_id)
+        virtual_key_layer_id = layer_stack.resolve(layer_masks[key_id])  # TODO: light conifg as well
+        layer_table = layer_tables[virtual_key_layer_id]
+        key = layer_table.virtual_keys[key_id]
+        if key is None:
+            return
+        layer_stack.after_press()
+        held_virtual_keys[key_id] = key
+        key.press()
+        key.update_time = now_ms
+        if key.pressed_function is None:  # TODO: refactor
+            send_start_ns = time.monotonic_ns()
+            kbd.press_many(layer_table.keycodes[key_id])
+            hid_ns += time.monotonic_ns() - send_start_ns
+
+    def release_key(key_id, now_ms):
+        nonlocal hid_ns
+        # release what was pressed, even if the layer changed since
+        key = held_virtual_keys[key_id]
+        if key is None:
+            return
+        held_virtual_keys[key_id] = None
+        key.release()
+        key.update_time = now_ms
+        if key.pressed_function is None:
+            send_start_ns = time.monotonic_ns()
+            kbd.release_many(key.keycode)
+            hid_ns += time.monotonic_ns() - send_start_ns
+
+    def combo_action(action, pressed):
+        nonlocal hid_ns
+        keycodes, macro_name = action
+        send_start_ns = time.monotonic_ns()
+        if not pressed:
+            if keycodes:
+                kbd.release_many(*keycodes)
+        else:
+            # a combo counts as a key press for tap-hold and one-shot layers
+            layer_stack.before_press(None)
+            layer_stack.after_press()
+            if macro_name is not None:
+                macro_engine.play(macro_name)
+            else:
+                kbd.press_many(*keycodes)
+        hid_ns += time.monotonic_ns() - send_start_ns
+
+    combo_engine = load_combo_engine(combos_config_path, physical_key_name_map, press_key, combo_action, macro_engine.macros)
+
+    def scan_keys(now_ms):
+        nonlocal previous_pressed, current_pressed, hid_ns
+
+        scan_start_ns = time.monotonic_ns()
+        register_bytes = read_shift_registers()
+        decode_start_ns = time.monotonic_ns()
+        decode_pressed(register_bytes, key_mask, raw_pressed)
+        if key_health is not None:
+            key_health.filter(register_bytes, raw_pressed, now_ms)
+        if power_manager is not None:
+            power_manager.scan(raw_pressed, now_ms)
+        debouncer.update(raw_pressed, current_pressed, now_ms)
+        changed_key_ids = get_changed_key_ids(previous_pressed, current_pressed)
+        for key_id in changed_key_ids:
+            key = physical_key_id_map[key_id]
+            if is_key_pressed(current_pressed, key_id):
+                # print(f"Pressed PhysicalKey: {key.key_name}")
+                effect_engine.press(key_id)
+                if key_health is not None:
+                    key_health.key_changed(key_id, True, now_ms)
+                if key_recorder is not None:
+                    key_recorder.record(key_id, True, now_ms)
                 key.pressed = True
-                # physical_key_id_map[key.physical_id] = key
-            elif key.pressed == True:
-                key.pressed = False
-                # kbd.release(key.keycode)
+            else:
                 # print(f"Released PhysicalKey: {key.key_name}")
+                effect_engine.release(key_id)
+                if key_health is not None:
+                    key_health.key_changed(key_id, False, now_ms)
+                if key_recorder is not None:
+                    key_recorder.record(key_id, False, now_ms)
+                key.pressed = False
 
-        virtual_key_layer_id = int(fn_key.pressed)  # TODO: light conifg as well
+        layer_start_ns = time.monotonic_ns()
+        hid_ns = 0
+        layer_stack.tick(now_ms)
+        combo_pressed = combo_engine is not None and combo_engine.tick(now_ms)
+
+        for key_id in changed_key_ids:
+            if is_key_pressed(current_pressed, key_id):
+                if combo_engine is None or not combo_engine.press(key_id, now_ms):
+                    press_key(key_id, now_ms)
+            elif combo_engine is None or not combo_engine.release(key_id, now_ms):
+                release_key(key_id, now_ms)
+
+        if changed_key_ids or combo_pressed:
+            send_start_ns = time.monotonic_ns()
+            kbd.commit()
+            hid_ns += time.monotonic_ns() - send_start_ns
+        kbd.poll()
+
+        scan_end_ns = time.monotonic_ns()
+        latency_profiler.record(STAGE_SPI, decode_start_ns - scan_start_ns)
+        latency_profiler.record(STAGE_DECODE, layer_start_ns - decode_start_ns)
+        latency_profiler.record(STAGE_LAYER, scan_end_ns - layer_start_ns - hid_ns)
+        if hid_ns:
+            latency_profiler.record(STAGE_HID, hid_ns)
+            latency_profiler.record(STAGE_SCAN, scan_end_ns - scan_start_ns)
+
+        previous_pressed, current_pressed = current_pressed, previous_pressed
+
+    def apply_keymap(keymap, tables):
+        nonlocal layer_tables, layer_masks
+        # settle layer state first so releasing a pending tap-hold key does not tap it
+        layer_stack.reset()
+        if combo_engine is not None:
+            combo_engine.reset()
+        # release everything held on the old keymap; keys still down stay silent until pressed again
+        for key_id in range(len(held_virtual_keys)):
+            key = held_virtual_keys[key_id]
+            if key is None:
+                continue
+            held_virtual_keys[key_id] = None
+            key.release()
+            if key.pressed_function is None:
+                kbd.release_many(key.keycode)
+        kbd.commit()
+        layer_tables, layer_masks = tables
+        if key_health is not None:
+            key_health.stuck_exempt = build_key_mask(build_hold_key_ids(layer_tables))
+
+    def render_lights(now_ms):
+        if not rgb_io.value:
+            return
+        light_start_ns = time.monotonic_ns()
+        effect_engine.render(light_mode, light_level)
+        latency_profiler.record(STAGE_LIGHT, time.monotonic_ns() - light_start_ns)
+
+    scheduler = Scheduler()
+    scheduler.add("scan", scan_keys, priority=PRIORITY_REALTIME)
+    scheduler.add("macro", macro_engine.step, priority=PRIORITY_REALTIME)
+    scheduler.add("light", render_lights, interval_ms=1000 // light_fps, priority=PRIORITY_BACKGROUND)
+    if key_recorder is not None:
+        scheduler.add("analytics", key_recorder.poll, interval_ms=500, priority=PRIORITY_BACKGROUND)
+    if hot_reload_keymap:
+        # config edits are picked up here instead of restarting code.py
+        supervisor.runtime.autoreload = False
+        keymap_reloader = KeymapReloader(keymap, build_layer_tables, apply_keymap, physical_key_config_path, layers_config_path, fallback_layers_config, keymap_cache_path, keymap_check_interval_ms, SerialConsole(), macros)
+        scheduler.add("keymap", keymap_reloader.step, interval_ms=10, priority=PRIORITY_BACKGROUND)
 
-        for key in virtual_key_layers[virtual_key_layer_id].values():
-            if key.is_pressed():
-                if key.pressed == False:
-                    key.press()
-                    if key.pressed_function is None:  # TODO: refactor
-                        kbd.press(key.keycode)
-                # key.pressed = True
-                key.update_time = time.time()  # TODO: add an update function
-            else:
-                if key.pressed == True:
-                    key.release()
-                    kbd.release(key.keycode)
-                # key.pressed = False
-                key.update_time = time.time()
-
-        light_key_ids = physical_key_ids if light_mode == "random_static" else pressed_key_ids
-        colors = [physical_key_id_map[pressed_key_id].color for pressed_key_id in light_key_ids]
-        light_keys(light_key_ids, colors=colors, refresh=True)
-        time.sleep(scan_interval)
+    while running:
+        now_ms = time.monotonic_ns() // 1000000
+        if power_manager is not None and (macro_engine.playing or camera_service is not None and camera_service.busy):
+            power_manager.touch(now_ms)
+        scheduler.run_once(now_ms)
+        time.sleep(scan_interval if power_manager is None else power_manager.scan_interval)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,131 @@
+import os
+
+LOG_MAGIC = b"KLG1"
+RECORD_SIZE = 3  # (physical id << 1 | pressed), delta ms big endian
+SESSION_ID = 0x7F  # not a key: marks a boot, the next delta starts from zero
+MAX_DELTA_MS = 0xFFFF  # longer gaps are stored as this
+
+RING_RECORDS = 1024
+FLUSH_RECORDS = 512  # a block this big is written once the keyboard is idle
+IDLE_MS = 2000  # no key changes for this long counts as idle
+STALE_MS = 60000  # flush a smaller block too once it is this old
+MAX_LOG_BYTES = 256 * 1024  # then the log moves to <path>.old and starts over
+EROFS = 30  # OSError errno while CIRCUITPY is read-only to code.py
+
+
+class KeyEventRecorder:
+    """Press/release log in a RAM ring, flushed to flash in large blocks while idle.
+
+    record() only packs three bytes into a preallocated bytearray, so it is
+    cheap enough for the scan loop. When the ring is full the oldest records
+    are overwritten and counted in `overwritten`; that happens while flash is
+    not writable. CIRCUITPY is only writable by code.py when boot.py remounted
+    it (a key held at reset); otherwise the first flush finds it read-only,
+    says so once and the log stays in RAM.
+    """
+
+    def __init__(self, path: str, ring_records: int = RING_RECORDS, flush_records: int = FLUSH_RECORDS, idle_ms: int = IDLE_MS, stale_ms: int = STALE_MS, max_log_bytes: int = MAX_LOG_BYTES):
+        self.path = path
+        self.ring_records = ring_records
+        self.flush_records = flush_records
+        self.idle_ms = idle_ms
+        self.stale_ms = stale_ms
+        self.max_log_bytes = max_log_bytes
+        self.ring = bytearray(ring_records * RECORD_SIZE)
+        self.head = 0  # next record to write
+        self.count = 0  # records waiting to be flushed
+        self.last_ms = None
+        self.oldest_ms = 0  # when the oldest unflushed record was made
+        self.recorded = 0
+        self.overwritten = 0
+        self.flushed = 0
+        self.flush_errors = 0
+        self.read_only = False
+        self._put(SESSION_ID, 0, 0)
+
+    def _put(self, key_id: int, pressed: int, delta_ms: int):
+        offset = self.head * RECORD_SIZE
+        ring = self.ring
+        ring[offset] = key_id << 1 | pressed
+        ring[offset + 1] = delta_ms >> 8
+        ring[offset + 2] = delta_ms & 0xFF
+        self.head = (self.head + 1) % self.ring_records
+        if self.count < self.ring_records:
+            self.count += 1
+        else:
+            self.overwritten += 1
+
+    def record(self, key_id: int, pressed: bool, now_ms: int):
+        if self.last_ms is None:
+            delta_ms = 0
+        else:
+            delta_ms = now_ms - self.last_ms
+            if delta_ms > MAX_DELTA_MS:
+                delta_ms = MAX_DELTA_MS
+        if not self.count:
+            self.oldest_ms = now_ms
+        self.last_ms = now_ms
+        self._put(key_id, 1 if pressed else 0, delta_ms)
+        self.recorded += 1
+
+    def poll(self, now_ms: int):
+        """Flush when idle and enough has piled up; call from a background task."""
+        if not self.count or self.read_only:
+            return
+        if self.last_ms is not None and now_ms - self.last_ms < self.idle_ms:
+            return
+        if self.count >= self.flush_records or now_ms - self.oldest_ms >= self.stale_ms:
+            self.flush()
+
+    def flush(self) -> bool:
+        count = self.count
+        if not count:
+            return True
+        start = (self.head - count) % self.ring_records
+        try:
+            size = self._rotate()
+            with open(self.path, "ab") as f:
+                if size == 0:
+                    f.write(LOG_MAGIC)
+                end = start + count
+                if end <= self.ring_records:
+                    f.write(memoryview(self.ring)[start * RECORD_SIZE:end * RECORD_SIZE])
+                else:
+                    f.write(memoryview(self.ring)[start * RECORD_SIZE:])
+                    f.write(memoryview(self.ring)[:(end - self.ring_records) * RECORD_SIZE])
+        except OSError as error:
+            self.flush_errors += 1
+            if error.args and error.args[0] == EROFS:
+                # stays that way until a reset, no point trying again
+                self.read_only = True
+                print("key log kept in RAM: CIRCUITPY is read-only to code.py, hold ESCAPE while resetting to save it")
+            return False
+        self.count = 0
+        self.flushed += count
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "unflushed": self.count,
+            "overwritten": self.overwritten,
+            "flush_errors": self.flush_errors,
+            "read_only": self.read_only,
+        }
+
+    def _rotate(self) -> int:
+        """Move a full log aside; returns the size of the log to append to."""
+        try:
+            size = os.stat(self.path)[6]
+        except OSError:
+            return 0
+        if size < self.max_log_bytes:
+            return size
+        old_path = self.path + ".old"
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+        os.rename(self.path, old_path)
+        return 0
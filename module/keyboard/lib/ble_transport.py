@@ -0,0 +1,154 @@
+import time
+
+from adafruit_ble import BLERadio
+from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
+from adafruit_ble.services.standard.hid import HIDService
+from adafruit_hid.keyboard import Keyboard
+
+from lib.hid_batch import BatchedKeyboard
+from lib.key_buffer import OVERFLOW_NEWEST_WINS
+
+
+class BLETransport:
+    """BLE HID keyboard that sends at most one report per connection event.
+
+    Changes staged between connection events are coalesced into the next
+    report. While disconnected the report state keeps updating and the final
+    state is sent once the host reconnects; advertising restarts on its own.
+    reports_coalesced counts reports that took in edges after a commit() had
+    to hold them back, once per report however many edges it absorbed.
+    """
+
+    def __init__(self, short_name: str = "s68k", complete_name: str = "s68k esp32s3 keyboard", appearance: int = 961, connection_interval_ms: float = 7.5, overflow_policy: str = OVERFLOW_NEWEST_WINS):
+        self.ble = BLERadio()
+        self.hid = HIDService()
+        self.advertisement = ProvideServicesAdvertisement(self.hid)
+        self.advertisement.appearance = appearance
+        self.advertisement.short_name = short_name
+        self.advertisement.complete_name = complete_name
+        self.keyboard = BatchedKeyboard(Keyboard(self.hid.devices), overflow_policy)
+
+        self.requested_interval_ms = connection_interval_ms
+        self.connection_interval_ms = 0.0  # what the host accepted, 0 while disconnected
+        self.active = False
+        self.connected = False
+        self._pending = False
+        self._pending_keycodes = []
+        self._held_back = False  # the pending report was committed but could not go out yet
+        self._absorbing = False  # and edges have since been merged into it
+        self._last_send_ms = 0
+
+        self.reports_sent = 0
+        self.reports_coalesced = 0
+        self.reports_dropped = 0
+        self.disconnects = 0
+        self.connections = 0
+
+    def start(self):
+        self.active = True
+        self.poll()
+
+    def stop(self):
+        self.active = False
+        if self.ble.advertising:
+            self.ble.stop_advertising()
+
+    def press(self, *keycodes: int):
+        self._before_change(keycodes)
+        self.keyboard.press(*keycodes)
+
+    def release(self, *keycodes: int):
+        self._before_change(keycodes)
+        self.keyboard.release(*keycodes)
+
+    def release_all(self):
+        self.keyboard.clear()
+        self._pending = True
+        self._send()
+
+    def _before_change(self, keycodes):
+        # a key changing twice before its report went out needs the first edge sent
+        for keycode in keycodes:
+            if keycode in self._pending_keycodes:
+                self._send()
+                break
+        for keycode in keycodes:
+            self._pending_keycodes.append(keycode)
+        self._pending = True
+        if self._held_back and not self._absorbing:
+            self._absorbing = True
+            self.reports_coalesced += 1
+
+    def ready(self) -> bool:
+        """True when a report staged now would go out on the next commit()."""
+        return self.connected and not self._pending and time.monotonic_ns() // 1000000 - self._last_send_ms >= self.connection_interval_ms
+
+    def commit(self):
+        if not self._pending:
+            return
+        if self.connected and time.monotonic_ns() // 1000000 - self._last_send_ms >= self.connection_interval_ms:
+            self._send()
+        else:
+            self._held_back = True
+
+    def _send(self):
+        if not self.connected:
+            # only the final state is replayed on reconnect
+            self._pending_keycodes.clear()
+            self._held_back = True
+            return
+        try:
+            self.keyboard.commit()
+        except Exception:
+            # the link went away mid-send; the state is replayed on reconnect
+            self.reports_dropped += 1
+            self.keyboard.dirty = True
+            self._held_back = True
+            return
+        self._pending = False
+        self._pending_keycodes.clear()
+        self._held_back = False
+        self._absorbing = False
+        self._last_send_ms = time.monotonic_ns() // 1000000
+        self.reports_sent += 1
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "interval_ms": self.connection_interval_ms,
+            "sent": self.reports_sent,
+            "coalesced": self.reports_coalesced,
+            "dropped": self.reports_dropped,
+            "connections": self.connections,
+            "disconnects": self.disconnects,
+        }
+
+    def poll(self):
+        """Track the link once per scan: re-advertise, tune the interval, flush coalesced reports."""
+        connected = self.ble.connected
+        if connected and not self.connected:
+            self.connected = True
+            self.connections += 1
+            self._on_connect()
+        elif not connected and self.connected:
+            self.connected = False
+            self.disconnects += 1
+            self.connection_interval_ms = 0.0
+        if not self.active:
+            return
+        if not connected:
+            if not self.ble.advertising:
+                self.ble.start_advertising(self.advertisement)
+        elif self._pending:
+            self.commit()
+
+    def _on_connect(self):
+        for connection in self.ble.connections:
+            try:
+                connection.connection_interval = self.requested_interval_ms
+            except Exception:
+                pass
+            self.connection_interval_ms = connection.connection_interval
+        # replay the final state of anything pressed or released while away
+        if self._pending:
+            self._send()
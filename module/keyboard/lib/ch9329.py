@@ -8,11 +8,31 @@ from busio import UART
 
 from adafruit_hid.keycode import Keycode as Keycode
 
+from lib.key_buffer import KeyBuffer, OVERFLOW_NEWEST_WINS
+from lib.scheduler import run_to_completion
+
 HEADER = bytearray([0x57, 0xAB])
+CMD_GET_INFO = 0x01
 CMD_KEY = 0x02
 CMD_MEDIA_KEY = 0x03
 CMD_MOUSE_ABSOLUTE = 0x04
 CMD_MOUSE_RELATIVE = 0x05
+CMD_GET_PARA_CFG = 0x08
+CMD_SET_PARA_CFG = 0x09
+CMD_RESET = 0x0F
+
+RESPONSE_OK = 0x80  # the chip answers command c with c | 0x80
+RESPONSE_ERROR = 0xC0  # or with c | 0xC0 and a status byte
+STATUS_SUCCESS = 0x00
+
+PARA_CFG_LENGTH = 50
+RESET_DELAY_MS = 50  # the chip is deaf for a moment after CMD_RESET
+COMMAND_TIMEOUT_MS = 100
+PARA_CFG_BAUDRATE = 3  # 4 bytes, big endian
+
+KEY_FRAME_LENGTH = 5 + 8 + 1
+MOUSE_FRAME_LENGTH = 5 + 5 + 1
+MAX_FRAME_LENGTH = 5 + PARA_CFG_LENGTH + 1
 
 MODIFIER_KEY_CODE = [
     Keycode.LEFT_CONTROL,
@@ -36,50 +56,106 @@ class MOUSE_BUTTON_KEYCODE:
     MIDDLE_BUTTON = 4
 
 
-class CH9329:  # TODO: Maintaining Key Order
+def _modifier_bit(key_code: int) -> int:
+    if Keycode.LEFT_CONTROL <= key_code <= Keycode.RIGHT_GUI:
+        return 1 << (key_code - Keycode.LEFT_CONTROL)
+    return 0
+
+
+def _checksum(b: bytearray, length: int) -> int:
+    total = 0
+    for i in range(length):
+        total += b[i]
+    return total & 0xFF
+
+
+class CH9329:
     KEYBOARD_KEYCODE = Keycode
     MOUSE_KEYCODE = MOUSE_BUTTON_KEYCODE
 
-    def __init__(self, uart: UART, address: int = 0x00):
+    def __init__(self, uart: UART, address: int = 0x00, ack: bool = False, ack_timeout_ms: int = 20, max_resends: int = 3, overflow_policy: str = OVERFLOW_NEWEST_WINS):
         self._uart = uart
         self._address = address
-        self._pressed_keys: list[int] = list()
-        self._pressed_modifier_keys: list[int] = list()
+        self._keys = KeyBuffer(6, overflow_policy)
+        self._modifiers = 0
         self._pressed_mouse_key_bit: int = 0
+        self._dirty = False
+
+        # frames are built in place, headers are written once
+        self._key_frame = self._new_frame(CMD_KEY, 8)
+        self._mouse_frame = self._new_frame(CMD_MOUSE_RELATIVE, 5)
+        self._mouse_frame[5] = 0x01
+        self._command_frame = bytearray(MAX_FRAME_LENGTH)
+
+        # ACK tracking for key frames
+        self.ack = ack
+        self.ack_timeout_ms = ack_timeout_ms
+        self.max_resends = max_resends
+        self._awaiting_ack = False
+        self._sent_ms = 0
+        self._resends = 0
+        self.frames_sent = 0
+        self.frames_resent = 0
+        self.frames_dropped = 0
+        self._rx = bytearray(MAX_FRAME_LENGTH)
+        self._rx_byte = bytearray(1)
+        self._rx_length = 0
+        self._rx_expected = 0
+        self._response = bytearray(MAX_FRAME_LENGTH)
+        self._response_length = 0
+        self.configuring = False  # key frames wait while negotiate_baudrate_steps() talks to the chip
 
         self.debug = False
 
-    def _parse_modifier_keys(self, keys: list[int]) -> int:
-        b: int = 0
-        for i, modifier_key in enumerate(MODIFIER_KEY_CODE):
-            if modifier_key in keys:
-                b |= 1 << i
+    def _new_frame(self, command: int, length: int) -> bytearray:
+        b = bytearray(5 + length + 1)
+        b[0:2] = HEADER
+        b[2] = self._address
+        b[3] = command
+        b[4] = length
         return b
 
     def keyboard_press(self, *key_codes: int):
-        arg_keys = list(key_codes)
-
-        pressed_keys = self._pressed_keys + [arg_key for arg_key in arg_keys if arg_key not in MODIFIER_KEY_CODE]
-        self._pressed_keys = pressed_keys[-6:]
-
-        pressed_modifier_keys = self._pressed_modifier_keys + [arg_key for arg_key in arg_keys if arg_key in MODIFIER_KEY_CODE]
-        self._pressed_modifier_keys = pressed_modifier_keys[-4:]
-
-        self._send_key()
+        self.keyboard_press_many(*key_codes)
+        self.keyboard_commit()
 
     def keyboard_release(self, *key_codes: int):
-        arg_keys = key_codes
+        self.keyboard_release_many(*key_codes)
+        self.keyboard_commit()
+
+    def keyboard_press_many(self, *key_codes: int):
+        """Update the pressed keys without sending; keyboard_commit() sends them."""
+        for key_code in key_codes:
+            bit = _modifier_bit(key_code)
+            if bit:
+                self._modifiers |= bit
+            else:
+                self._keys.press(key_code)
+        self._dirty = True
+
+    def keyboard_release_many(self, *key_codes: int):
+        for key_code in key_codes:
+            bit = _modifier_bit(key_code)
+            if bit:
+                self._modifiers &= ~bit
+            else:
+                self._keys.release(key_code)
+        self._dirty = True
 
-        self._pressed_keys = [pressed_key for pressed_key in self._pressed_keys if pressed_key not in arg_keys]
-        self._pressed_modifier_keys = [pressed_modifier_key for pressed_modifier_key in self._pressed_modifier_keys if pressed_modifier_key not in arg_keys]
+    def keyboard_release_all(self):
+        self._keys.clear()
+        self._modifiers = 0
 
         self._send_key()
 
-    def keyboard_release_all(self):
-        self._pressed_keys = []
-        self._pressed_modifier_keys = []
+    @property
+    def ready(self) -> bool:
+        """False while a key frame waits for its ACK or the link is being configured."""
+        return not self._awaiting_ack and not self.configuring
 
-        self._send_key()
+    def keyboard_commit(self):
+        if self._dirty:
+            self._send_key()
 
     def keyboard_tap(self, *key_codes: int):
         self.keyboard_press(*key_codes)
@@ -87,23 +163,19 @@ class CH9329:  # TODO: Maintaining Key Order
         self.keyboard_release_all()
 
     def _send_key(self):
-        b = bytearray(5 + 8 + 1)
-        b[0:2] = HEADER
-        b[2] = self._address
-        b[3] = CMD_KEY
-        b[4] = 8
-        b[5] = self._parse_modifier_keys(self._pressed_modifier_keys)
+        if self.configuring:
+            self._dirty = True  # sent once the link is up
+            return
+        self._dirty = False
+        b = self._key_frame
+        b[5] = self._modifiers & 0xFF
         b[6] = 0
-        n = 0
-        for code in self._pressed_keys:
-            b[7 + n] = code
-            n += 1
-
-        self._add_checksum(b)
-
-        if self.debug:
-            print("ch9329 send:", " ".join(map(hex, b)))
-        self._uart.write(b)
+        self._keys.fill(b, 7)
+        self._write_frame(b)
+        if self.ack:
+            self._awaiting_ack = True
+            self._resends = 0
+            self._sent_ms = time.monotonic_ns() // 1000000
 
     def mouse_move(self, x: int, y: int, wheel: int):
         if x < -128 or 127 < x:
@@ -135,23 +207,175 @@ class CH9329:  # TODO: Maintaining Key Order
         self.mouse_release_all()
 
     def _send_mouse(self, x: int, y: int, wheel: int):
-        b = bytearray(5 + 5 + 1)
-        b[0:2] = HEADER
-        b[2] = self._address
-        b[3] = CMD_MOUSE_RELATIVE
-        b[4] = 5
-        b[5] = 0x01
+        b = self._mouse_frame
         b[6] = self._pressed_mouse_key_bit
         b[7] = x & 0xFF
         b[8] = y & 0xFF
         b[9] = wheel & 0xFF
+        self._write_frame(b)
 
-        self._add_checksum(b)
+    def _write_frame(self, b: bytearray, length: int = None):
+        if length is None:
+            length = len(b)
+        b[length - 1] = _checksum(b, length - 1)
 
         if self.debug:
-            print("ch9329 send:", " ".join(map(hex, b)))
-        self._uart.write(b)
+            print("ch9329 send:", " ".join(map(hex, b[:length])))
+        if length == len(b):
+            self._uart.write(b)
+        else:
+            self._uart.write(memoryview(b)[:length])
+        self.frames_sent += 1
 
     @classmethod
     def _add_checksum(cls, b: bytearray):
-        b[-1] = sum(b[:-1]) & 0xFF
+        b[-1] = _checksum(b, len(b) - 1)
+
+    # ACK handling
+
+    def poll(self):
+        """Read the chip's replies without blocking and resend unacknowledged key frames.
+
+        Call once per scan when ack is enabled.
+        """
+        if not self.ack or self.configuring:
+            return
+        while self._uart.in_waiting:
+            command = self._read_response()
+            if command is None:
+                break
+            if command == CMD_KEY | RESPONSE_OK and self._response[5] == STATUS_SUCCESS:
+                self._awaiting_ack = False
+            elif command == CMD_KEY | RESPONSE_ERROR and self._awaiting_ack:
+                self._resend_key()
+        if self._awaiting_ack and time.monotonic_ns() // 1000000 - self._sent_ms >= self.ack_timeout_ms:
+            self._resend_key()
+
+    def _resend_key(self):
+        if self._resends >= self.max_resends:
+            self._awaiting_ack = False
+            self.frames_dropped += 1
+            return
+        self._resends += 1
+        self.frames_resent += 1
+        # key frames carry the full state, so resending the last one is always safe
+        self._write_frame(self._key_frame)
+        self._sent_ms = time.monotonic_ns() // 1000000
+
+    def _read_response(self):
+        """Feed received bytes through the frame parser; return the command of a complete frame."""
+        while self._uart.in_waiting:
+            if not self._uart.readinto(self._rx_byte):
+                return None
+            byte = self._rx_byte[0]
+            n = self._rx_length
+            if (n == 0 and byte != HEADER[0]) or (n == 1 and byte != HEADER[1]):
+                self._rx_length = 0
+                continue
+            self._rx[n] = byte
+            self._rx_length = n + 1
+            if n == 4:
+                self._rx_expected = 5 + byte + 1
+                if self._rx_expected > MAX_FRAME_LENGTH:
+                    self._rx_length = 0
+            elif n >= 4 and self._rx_length == self._rx_expected:
+                self._rx_length = 0
+                if _checksum(self._rx, self._rx_expected - 1) != self._rx[self._rx_expected - 1]:
+                    continue
+                self._response[0:self._rx_expected] = self._rx[0:self._rx_expected]
+                self._response_length = self._rx_expected
+                return self._response[3]
+        return None
+
+    def _command(self, command: int, data=b"", timeout_ms: int = COMMAND_TIMEOUT_MS):
+        """Send a command and block until its reply; returns the reply data or None."""
+        return run_to_completion(self._command_steps(command, data, timeout_ms))
+
+    def _command_steps(self, command: int, data=b"", timeout_ms: int = COMMAND_TIMEOUT_MS):
+        """Generator form of _command(): yields while the reply has not arrived."""
+        b = self._command_frame
+        b[0:2] = HEADER
+        b[2] = self._address
+        b[3] = command
+        b[4] = len(data)
+        b[5:5 + len(data)] = data
+        self._uart.reset_input_buffer()
+        self._rx_length = 0
+        self._write_frame(b, 5 + len(data) + 1)
+        # integer ns: a float monotonic() stops resolving milliseconds after hours of uptime
+        deadline_ns = time.monotonic_ns() + timeout_ms * 1000000
+        while time.monotonic_ns() < deadline_ns:
+            reply = self._read_response()
+            if reply == command | RESPONSE_OK:
+                return self._response[5:self._response_length - 1]
+            if reply == command | RESPONSE_ERROR:
+                return None
+            yield
+        return None
+
+    # parameter configuration
+
+    def get_info(self):
+        return self._command(CMD_GET_INFO)
+
+    def get_parameters(self):
+        return self._command(CMD_GET_PARA_CFG)
+
+    def set_parameters(self, parameters) -> bool:
+        reply = self._command(CMD_SET_PARA_CFG, parameters)
+        return reply is not None and reply[0] == STATUS_SUCCESS
+
+    def reset_chip(self) -> bool:
+        reply = self._command(CMD_RESET)
+        return reply is not None and reply[0] == STATUS_SUCCESS
+
+    def negotiate_baudrate(self, baudrate: int = 115200, default_baudrate: int = 9600) -> int:
+        """Switch the link to baudrate, reconfiguring the chip if it still runs at default_baudrate.
+
+        The chip stores the rate across power cycles. Returns the baud rate in use.
+        """
+        return run_to_completion(self.negotiate_baudrate_steps(baudrate, default_baudrate))
+
+    def negotiate_baudrate_steps(self, baudrate: int = 115200, default_baudrate: int = 9600):
+        """Generator form of negotiate_baudrate(), for stepping between scans.
+
+        Key frames are held back from this call on, and the latest state is
+        sent once the link is settled.
+        """
+        self.configuring = True
+        return self._negotiate_steps(baudrate, default_baudrate)
+
+    def _negotiate_steps(self, baudrate, default_baudrate):
+        try:
+            baudrate = yield from self._negotiate(baudrate, default_baudrate)
+        finally:
+            self.configuring = False
+        self._awaiting_ack = False
+        if self._dirty:
+            self._send_key()
+        return baudrate
+
+    def _negotiate(self, baudrate, default_baudrate):
+        self._uart.baudrate = baudrate
+        if (yield from self._command_steps(CMD_GET_INFO)) is not None:
+            return baudrate
+        self._uart.baudrate = default_baudrate
+        parameters = yield from self._command_steps(CMD_GET_PARA_CFG)
+        if parameters is None:
+            return default_baudrate
+        parameters = bytearray(parameters)
+        parameters[PARA_CFG_BAUDRATE:PARA_CFG_BAUDRATE + 4] = baudrate.to_bytes(4, "big")
+        reply = yield from self._command_steps(CMD_SET_PARA_CFG, parameters)
+        if reply is None or reply[0] != STATUS_SUCCESS:
+            return default_baudrate
+        reply = yield from self._command_steps(CMD_RESET)
+        if reply is None or reply[0] != STATUS_SUCCESS:
+            return default_baudrate
+        deadline_ns = time.monotonic_ns() + RESET_DELAY_MS * 1000000
+        while time.monotonic_ns() < deadline_ns:
+            yield
+        self._uart.baudrate = baudrate
+        if (yield from self._command_steps(CMD_GET_INFO)) is None:
+            self._uart.baudrate = default_baudrate
+            return default_baudrate
+        return baudrate
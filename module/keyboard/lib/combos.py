@@ -0,0 +1,175 @@
+import json
+
+from adafruit_hid.keycode import Keycode
+
+from lib.macros import parse_macro_action
+
+SCAN_BYTES = 9
+
+COMBO_TERM_MS = 30  # keys of one combo must all go down within this window
+MAX_COMBO_KEYS = 30  # distinct keys over all combos; a combo is then a small int bitmask
+MAX_COMBO_SIZE = 8  # keys in one combo; every subset of a combo is indexed
+
+
+def _keycode(key_name: str) -> int:
+    keycode = getattr(Keycode, key_name, None)
+    if not isinstance(keycode, int):
+        raise ValueError(f"unknown key: {key_name}")
+    return keycode
+
+
+def parse_combo_action(value, macros: dict = None):
+    """(keycodes, macro name) for "ESCAPE", ["LEFT_CONTROL", "C"] or "MACRO(name)"."""
+    if isinstance(value, str):
+        macro_name = parse_macro_action(value)
+        if macro_name is not None:
+            if macros is not None and macro_name not in macros:
+                raise ValueError(f"unknown macro: {value}")
+            return (), macro_name
+        value = [value]
+    if not value:
+        raise ValueError("a combo needs an action")
+    return tuple(_keycode(key_name) for key_name in value), None
+
+
+class ComboEngine:
+    """Turns keys pressed together into one action, between physical key edges and the layers.
+
+    Only keys that appear in some combo are held back, for at most term_ms
+    from the first of them; every other key passes straight through, after
+    any held keys are let go in the order they went down. Each combo key owns
+    one bit, and the bits of every combo and of every proper subset of one
+    are indexed when the combos are loaded, so a press costs a couple of dict
+    lookups however many combos there are. A combo fires as soon as its keys
+    are down unless a larger combo could still follow, and its action is
+    released with the first of its keys.
+
+    on_key(key_id, now_ms) presses a key that was held back; on_combo(action,
+    pressed) presses or releases a combo's (keycodes, macro name) action.
+    """
+
+    def __init__(self, combos: list, on_key, on_combo, term_ms: int = COMBO_TERM_MS, key_count: int = SCAN_BYTES * 8) -> None:
+        self.on_key = on_key
+        self.on_combo = on_combo
+        self.term_ms = term_ms
+        self.key_bits = [0] * key_count  # physical id -> its combo bit, 0 for keys in no combo
+        self.combos = {}  # bitmask of a combo's keys -> action
+        self.prefixes = {}  # bitmask of part of a combo -> True, more keys may follow
+        bit_count = 0
+        for key_ids, action in combos:
+            if len(key_ids) < 2 or len(key_ids) > MAX_COMBO_SIZE:
+                raise ValueError(f"a combo takes 2 to {MAX_COMBO_SIZE} keys")
+            mask = 0
+            for key_id in key_ids:
+                if not self.key_bits[key_id]:
+                    if bit_count >= MAX_COMBO_KEYS:
+                        raise ValueError(f"combos use more than {MAX_COMBO_KEYS} keys")
+                    self.key_bits[key_id] = 1 << bit_count
+                    bit_count += 1
+                mask |= self.key_bits[key_id]
+            if mask in self.combos:
+                raise ValueError(f"duplicate combo: {key_ids}")
+            self.combos[mask] = action
+            bits = [self.key_bits[key_id] for key_id in key_ids]
+            for subset in range(1, (1 << len(bits)) - 1):
+                part = 0
+                for index in range(len(bits)):
+                    if subset & (1 << index):
+                        part |= bits[index]
+                self.prefixes[part] = True
+        self.pending = 0  # bits of the keys held back
+        self.pending_ids = []  # in the order they went down
+        self.start_ms = 0
+        self.active = []  # [combo bits, bits still down, action] per fired combo
+        self.fired = 0
+
+    def press(self, key_id: int, now_ms: int) -> bool:
+        """True when the key was taken; False means press it now, as usual."""
+        bit = self.key_bits[key_id]
+        if not bit:
+            if self.pending:
+                self._resolve(now_ms)
+            return False
+        mask = self.pending | bit
+        if mask not in self.prefixes and mask not in self.combos:
+            # this key cannot join the held ones: settle them and start over from it
+            if self.pending:
+                self._resolve(now_ms)
+            mask = bit
+        if not self.pending:
+            self.start_ms = now_ms
+        self.pending = mask
+        self.pending_ids.append(key_id)
+        if mask not in self.prefixes:
+            self._resolve(now_ms)  # a complete combo no larger one extends
+        return True
+
+    def release(self, key_id: int, now_ms: int) -> bool:
+        """True when the release belongs to a fired combo; False means release it as usual."""
+        bit = self.key_bits[key_id]
+        if not bit:
+            return False
+        if self.pending & bit:
+            self._resolve(now_ms)  # let go before the window closed
+        for entry in self.active:
+            if entry[1] & bit:
+                if entry[1] == entry[0]:
+                    self.on_combo(entry[2], False)
+                entry[1] &= ~bit
+                if not entry[1]:
+                    self.active.remove(entry)
+                return True
+        return False
+
+    def tick(self, now_ms: int) -> bool:
+        """Settle held keys whose window has closed; True when that pressed anything."""
+        if self.pending and now_ms - self.start_ms >= self.term_ms:
+            self._resolve(now_ms)
+            return True
+        return False
+
+    def reset(self):
+        """Drop held keys and release fired combos, e.g. before the keymap changes."""
+        self.pending = 0
+        self.pending_ids.clear()
+        for entry in self.active:
+            if entry[1] == entry[0]:
+                self.on_combo(entry[2], False)
+        self.active.clear()
+
+    def _resolve(self, now_ms: int):
+        action = self.combos.get(self.pending)
+        if action is not None:
+            self.active.append([self.pending, self.pending, action])
+            self.fired += 1
+            self.pending = 0
+            self.pending_ids.clear()
+            self.on_combo(action, True)
+            return
+        self.pending = 0
+        for key_id in self.pending_ids:
+            self.on_key(key_id, now_ms)
+        self.pending_ids.clear()
+
+
+def load_combo_engine(path: str, physical_key_name_map: dict, on_key, on_combo, macros: dict = None):
+    """Build a ComboEngine from a json file like config/combos.json; None when there are no combos.
+
+    Each combo lists its "keys" by physical key name and an "action": a key
+    name, a list of key names pressed together, or "MACRO(name)".
+    """
+    try:
+        config = json.load(open(path))
+    except OSError:
+        return None
+    combos = []
+    for combo in config.get("combos", []):
+        key_ids = []
+        for key_name in combo["keys"]:
+            if key_name not in physical_key_name_map:
+                raise ValueError(f"unknown physical key: {key_name}")
+            key_ids.append(physical_key_name_map[key_name])
+        combos.append((key_ids, parse_combo_action(combo["action"], macros)))
+    if not combos:
+        return None
+    return ComboEngine(combos, on_key, on_combo, config.get("term_ms", COMBO_TERM_MS))
@@ -0,0 +1,98 @@
+import json
+
+SCAN_BYTES = 9
+
+DEBOUNCE_EAGER = "eager"  # press at once, release after the key is stable
+DEBOUNCE_DEFER = "defer"  # press and release after the key is stable
+DEBOUNCE_COUNTER = "counter"  # flip after N consecutive scans that disagree
+DEBOUNCE_ALGORITHMS = (DEBOUNCE_EAGER, DEBOUNCE_DEFER, DEBOUNCE_COUNTER)
+
+
+class Debouncer:
+    """Filters raw pressed snapshots into debounced ones, one bit per physical id.
+
+    Thresholds are milliseconds for "eager" and "defer", scan counts for "counter".
+    """
+
+    def __init__(self, algorithm: str = DEBOUNCE_EAGER, default_threshold: int = 5, thresholds: dict = None, size: int = SCAN_BYTES):
+        if algorithm not in DEBOUNCE_ALGORITHMS:
+            raise ValueError(f"unknown debounce algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.size = size
+        self.thresholds = bytearray([default_threshold] * (size * 8))
+        if thresholds:
+            for key_id, threshold in thresholds.items():
+                self.thresholds[key_id] = threshold
+        self.state = bytearray(size)
+        self.pending = bytearray(size)
+        self.deadlines = [0] * (size * 8)
+        self.counters = bytearray(size * 8)
+
+    def reset(self):
+        for i in range(self.size):
+            self.state[i] = 0
+            self.pending[i] = 0
+
+    def update(self, raw_bytes: bytearray, debounced_bytes: bytearray, now_ms: int) -> bytearray:
+        state = self.state
+        pending = self.pending
+        for i in range(self.size):
+            diff = raw_bytes[i] ^ state[i]
+            if diff or pending[i]:
+                base = i << 3
+                for bit in range(8):
+                    mask = 0x80 >> bit
+                    if diff & mask:
+                        self._settle(i, base + bit, mask, raw_bytes[i] & mask, now_ms)
+                    elif pending[i] & mask:
+                        # bounced back to the debounced level before settling
+                        pending[i] &= ~mask
+                        self.counters[base + bit] = 0
+            debounced_bytes[i] = state[i]
+        return debounced_bytes
+
+    def _settle(self, i, key_id, mask, pressed, now_ms):
+        if self.algorithm == DEBOUNCE_COUNTER:
+            count = self.counters[key_id] + 1
+            if count >= self.thresholds[key_id]:
+                self._flip(i, mask)
+                self.counters[key_id] = 0
+            else:
+                self.counters[key_id] = count
+                self.pending[i] |= mask
+        elif pressed and self.algorithm == DEBOUNCE_EAGER:
+            self._flip(i, mask)
+        elif self.pending[i] & mask:
+            if now_ms >= self.deadlines[key_id]:
+                self._flip(i, mask)
+        else:
+            self.pending[i] |= mask
+            self.deadlines[key_id] = now_ms + self.thresholds[key_id]
+            if not self.thresholds[key_id]:
+                self._flip(i, mask)
+
+    def _flip(self, i, mask):
+        self.state[i] ^= mask
+        self.pending[i] &= ~mask
+
+
+def load_debouncer(path: str, physical_key_name_map: dict) -> Debouncer:
+    """Build a Debouncer from a json file like config/debounce.json.
+
+    "thresholds" is keyed by physical key name or by physical id.
+    """
+    try:
+        config = json.load(open(path))
+    except OSError:
+        config = {}
+    thresholds = {}
+    for key, threshold in config.get("thresholds", {}).items():
+        if key in physical_key_name_map:
+            thresholds[physical_key_name_map[key]] = threshold
+        else:
+            thresholds[int(key)] = threshold
+    return Debouncer(
+        algorithm=config.get("algorithm", DEBOUNCE_EAGER),
+        default_threshold=config.get("default_threshold", 5),
+        thresholds=thresholds,
+    )
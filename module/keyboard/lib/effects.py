@@ -0,0 +1,319 @@
+from lib.lighting import NO_PIXEL
+
+EFFECT_ON_PRESS = "on_press"  # pressed keys lit
+EFFECT_RANDOM_STATIC = "random_static"  # every key lit
+EFFECT_FADE = "fade"  # pressed keys lit, fading out after release
+EFFECT_RIPPLE = "ripple"  # rings spreading from each press
+EFFECT_HEATMAP = "heatmap"  # keys warm up with use and cool down slowly
+EFFECTS = (EFFECT_ON_PRESS, EFFECT_RANDOM_STATIC, EFFECT_FADE, EFFECT_RIPPLE, EFFECT_HEATMAP)
+
+MAX_RIPPLES = 4
+RIPPLE_RADIUS = 12  # keys
+RIPPLE_STEP = 255 // RIPPLE_RADIUS  # intensity lost per key of radius
+FADE_STEP = 12  # intensity lost per frame after release, about 0.7 s at 30 fps
+HEAT_STEP = 24  # heat added per press
+HEAT_COOL_FRAMES = 8  # heat drops by one every this many frames
+GAMMA = 2.2
+PALETTE_SIZE = 32  # power of two
+
+
+def _hue(position: int):
+    # position 0..767 around an rgb wheel at full saturation
+    sector, offset = position >> 8, position & 0xFF
+    if sector == 0:
+        return 255 - offset, offset, 0
+    if sector == 1:
+        return 0, 255 - offset, offset
+    return offset, 0, 255 - offset
+
+
+def _build_palette(size: int) -> bytearray:
+    palette = bytearray(size * 3)
+    for index in range(size):
+        palette[index * 3:index * 3 + 3] = bytes(_hue(index * 768 // size))
+    return palette
+
+
+def _build_heat_palette() -> bytearray:
+    # blue through green to red, dark at zero heat
+    palette = bytearray(256 * 3)
+    for heat in range(1, 256):
+        palette[heat * 3:heat * 3 + 3] = bytes(_hue(512 - heat * 2))
+    return palette
+
+
+PALETTE = _build_palette(PALETTE_SIZE)
+HEAT_PALETTE = _build_heat_palette()
+
+
+class EffectEngine:
+    """Reactive lighting drawn straight into a LightRenderer frame.
+
+    Per-LED state (base color, held flag, intensity, heat) lives in flat
+    bytearrays indexed by pixel. press() and release() are O(1) and safe to
+    call from the scan loop; render() draws a whole frame with integer math
+    and a gamma/brightness lookup table, then lets the renderer push only the
+    pixels that changed.
+    """
+
+    def __init__(self, renderer, key_positions: dict = None, max_light_level: int = 255, gamma: float = GAMMA):
+        self.renderer = renderer
+        self.num_pixels = renderer.num_pixels
+        self.max_light_level = max_light_level
+        self.gamma = gamma
+        n = self.num_pixels
+        self.base = bytearray(n * 3)
+        self.held = bytearray(n)
+        self.intensity = bytearray(n)
+        self.heat = bytearray(n)
+        self.lut = bytearray(256)
+        self.light_level = None
+        self.effect = None
+        self.frames = 0
+        self._dirty = True
+        self._animating = False
+        self._seed = 0xACE1
+        for pixel_index in range(n):
+            self._pick_color(pixel_index)
+
+        # ripples: origin pixel, radius in keys, palette color
+        self.ripple_origin = bytearray(MAX_RIPPLES)
+        self.ripple_radius = bytearray([RIPPLE_RADIUS + 1] * MAX_RIPPLES)
+        self.ripple_color = bytearray(MAX_RIPPLES)
+        self._next_ripple = 0
+        self.key_positions = key_positions or {}
+        # ring tables, filled one origin per frame so no frame takes long; see _build_rings()
+        self.ring_pixels = bytearray(n * n)
+        self.ring_starts = bytearray(n * (RIPPLE_RADIUS + 2))
+        self.rings_built = 0  # origin pixels whose rings are in the tables
+        self._ring_builder = self._build_rings()
+
+    def _build_rings(self):
+        """Generator filling the ring tables, half an origin pixel per step.
+
+        ring_pixels[a * n:(a + 1) * n] lists pixels by distance in keys from
+        pixel a; ring_starts[a * (RIPPLE_RADIUS + 2) + d] is the index in that
+        list of the first pixel d or more keys away, so a ring is one slice.
+        Pixels are bucketed by distance (a counting sort), so nothing is
+        allocated per origin.
+        """
+        n = self.num_pixels
+        xs = bytearray(n)
+        ys = bytearray(n)
+        placed = bytearray(n)
+        for key_id, (x, y) in self.key_positions.items():
+            pixel_index = self.renderer.key_2_light[key_id]
+            if pixel_index != NO_PIXEL:
+                xs[pixel_index] = x
+                ys[pixel_index] = y
+                placed[pixel_index] = 1
+        stride = RIPPLE_RADIUS + 2
+        far = stride - 1  # past the last ring, never drawn
+        ring_pixels = self.ring_pixels
+        ring_starts = self.ring_starts
+        distances = bytearray(n)
+        cursors = bytearray(stride)
+        for a in range(n):
+            yield
+            for radius in range(stride):
+                cursors[radius] = 0
+            for b in range(n):
+                if not placed[a] or not placed[b]:
+                    distance = far
+                else:
+                    dx = abs(xs[a] - xs[b])
+                    dy = abs(ys[a] - ys[b])
+                    # octagonal approximation of the euclidean distance
+                    distance = (max(dx, dy) + min(dx, dy) // 2 + 2) // 4
+                    if distance > far:
+                        distance = far
+                distances[b] = distance
+                cursors[distance] += 1
+            yield
+            index = 0
+            for radius in range(stride):
+                count = cursors[radius]
+                ring_starts[a * stride + radius] = index
+                cursors[radius] = index
+                index += count
+            base = a * n
+            for b in range(n):
+                distance = distances[b]
+                ring_pixels[base + cursors[distance]] = b
+                cursors[distance] += 1
+            self.rings_built = a + 1
+
+    def build_rings_step(self) -> bool:
+        """Do one slice of the ring tables; returns whether any is left."""
+        if self._ring_builder is None:
+            return False
+        try:
+            next(self._ring_builder)
+        except StopIteration:
+            self._ring_builder = None
+        return self._ring_builder is not None
+
+    def build_rings(self):
+        while self.build_rings_step():
+            pass
+
+    def set_light_level(self, light_level: int):
+        if light_level == self.light_level:
+            return
+        self.light_level = light_level
+        for value in range(256):
+            self.lut[value] = int((value / 255) ** self.gamma * light_level + 0.5)
+        self._dirty = True
+
+    def _random(self) -> int:
+        # 16-bit xorshift, stays a small int on CircuitPython
+        x = self._seed
+        x ^= (x << 7) & 0xFFFF
+        x ^= x >> 9
+        x ^= (x << 8) & 0xFFFF
+        self._seed = x
+        return x
+
+    def _pick_color(self, pixel_index: int):
+        color = (self._random() & (PALETTE_SIZE - 1)) * 3
+        offset = pixel_index * 3
+        self.base[offset] = PALETTE[color]
+        self.base[offset + 1] = PALETTE[color + 1]
+        self.base[offset + 2] = PALETTE[color + 2]
+
+    def press(self, key_id: int):
+        pixel_index = self.renderer.key_2_light[key_id]
+        if pixel_index == NO_PIXEL:
+            return
+        self._pick_color(pixel_index)
+        self.held[pixel_index] = 1
+        self.intensity[pixel_index] = 255
+        heat = self.heat[pixel_index] + HEAT_STEP
+        self.heat[pixel_index] = heat if heat < 255 else 255
+        ripple = self._next_ripple
+        self._next_ripple = (ripple + 1) % MAX_RIPPLES
+        self.ripple_origin[ripple] = pixel_index
+        self.ripple_radius[ripple] = 0
+        self.ripple_color[ripple] = self._random() & (PALETTE_SIZE - 1)
+        self._dirty = True
+
+    def release(self, key_id: int):
+        pixel_index = self.renderer.key_2_light[key_id]
+        if pixel_index != NO_PIXEL:
+            self.held[pixel_index] = 0
+            self._dirty = True
+
+    def render(self, effect: str, light_level: int = None) -> bool:
+        """Draw one frame of effect and show it; returns whether any pixel changed.
+
+        Frames are only drawn when a key changed or an animation is running,
+        so an idle keyboard costs a comparison per frame.
+        """
+        if light_level is not None:
+            self.set_light_level(light_level)
+        if self._ring_builder is not None:
+            # spread over the first frames after boot, so ripple is ready by the time it is picked
+            self.build_rings_step()
+        if effect != self.effect:
+            self.effect = effect
+            self._dirty = True
+        if not self._dirty and not self._animating:
+            return False
+        self._dirty = False
+        self.frames += 1
+        if effect == EFFECT_HEATMAP:
+            self._animating = self._render_heatmap()
+        elif effect == EFFECT_RIPPLE:
+            self._render_intensity(EFFECT_ON_PRESS)
+            self._animating = self._render_ripples()
+        else:
+            self._animating = self._render_intensity(effect)
+        return self.renderer.show()
+
+    def _render_intensity(self, effect: str) -> bool:
+        """Base colors scaled by per-key intensity; returns whether a key is still fading."""
+        frame = self.renderer.frame
+        base = self.base
+        held = self.held
+        intensity = self.intensity
+        lut = self.lut
+        fade = effect == EFFECT_FADE
+        static = effect == EFFECT_RANDOM_STATIC
+        fading = False
+        offset = 0
+        for i in range(self.num_pixels):
+            if static or held[i]:
+                level = 256
+            elif fade and intensity[i]:
+                level = intensity[i]
+                level = level - FADE_STEP if level > FADE_STEP else 0
+                intensity[i] = level
+                fading = True
+            else:
+                level = 0
+            if level:
+                frame[offset] = lut[base[offset] * level >> 8]
+                frame[offset + 1] = lut[base[offset + 1] * level >> 8]
+                frame[offset + 2] = lut[base[offset + 2] * level >> 8]
+            else:
+                frame[offset] = 0
+                frame[offset + 1] = 0
+                frame[offset + 2] = 0
+            offset += 3
+        return fading
+
+    def _render_ripples(self) -> bool:
+        """Draw the ring of every live ripple; returns whether any is still spreading."""
+        n = self.num_pixels
+        stride = RIPPLE_RADIUS + 2
+        frame = self.renderer.frame
+        ring_pixels = self.ring_pixels
+        ring_starts = self.ring_starts
+        lut = self.lut
+        spreading = False
+        for ripple in range(MAX_RIPPLES):
+            radius = self.ripple_radius[ripple]
+            if radius > RIPPLE_RADIUS:
+                continue
+            spreading = True
+            self.ripple_radius[ripple] = radius + 1
+            level = 256 - radius * RIPPLE_STEP
+            color = self.ripple_color[ripple] * 3
+            r = lut[PALETTE[color] * level >> 8]
+            g = lut[PALETTE[color + 1] * level >> 8]
+            b = lut[PALETTE[color + 2] * level >> 8]
+            origin = self.ripple_origin[ripple]
+            if origin >= self.rings_built:
+                continue  # its rings are not built yet, only in the first seconds after boot
+            starts = origin * stride + radius
+            for index in range(origin * n + ring_starts[starts], origin * n + ring_starts[starts + 1]):
+                offset = ring_pixels[index] * 3
+                if r > frame[offset]:
+                    frame[offset] = r
+                if g > frame[offset + 1]:
+                    frame[offset + 1] = g
+                if b > frame[offset + 2]:
+                    frame[offset + 2] = b
+        return spreading
+
+    def _render_heatmap(self) -> bool:
+        """Heat palette per key, cooling every few frames; returns whether any key is still warm."""
+        frame = self.renderer.frame
+        heat = self.heat
+        lut = self.lut
+        cool = self.frames % HEAT_COOL_FRAMES == 0
+        warm = False
+        offset = 0
+        for i in range(self.num_pixels):
+            value = heat[i]
+            if value:
+                warm = True
+                if cool:
+                    value -= 1
+                    heat[i] = value
+            color = value * 3
+            frame[offset] = lut[HEAT_PALETTE[color]]
+            frame[offset + 1] = lut[HEAT_PALETTE[color + 1]]
+            frame[offset + 2] = lut[HEAT_PALETTE[color + 2]]
+            offset += 3
+        return warm
@@ -0,0 +1,116 @@
+QUEUE_EDGES = 64  # key edges a transport may fall behind by before its oldest reports are merged
+REPORT_EDGES = 16  # room ready() asks for: a report rarely changes more keys than this
+
+EDGE_PRESSED = 1
+EDGE_END = 2  # last edge of a report
+
+
+class SendQueue:
+    """Reports waiting for one transport, so a slow one never holds up the others.
+
+    press() and release() stage key edges and end_report() closes a report;
+    pump() hands whole reports to the transport for as long as ready() says
+    it can take one, and returns without waiting when it cannot. Edges live in
+    a preallocated ring. When the ring is full, the oldest report is applied
+    to the transport without sending it, so it is merged into the next one:
+    the host still ends up with the right keys down, only a quick tap inside
+    the merged reports can be lost. coalesced counts those merges.
+    """
+
+    def __init__(self, name: str, press, release, commit, ready=None, capacity: int = QUEUE_EDGES) -> None:
+        self.name = name
+        self._press = press
+        self._release = release
+        self._commit = commit
+        self._ready = ready
+        self.capacity = capacity
+        self.keycodes = bytearray(capacity)
+        self.flags = bytearray(capacity)
+        self.head = 0  # oldest edge
+        self.length = 0  # edges queued
+        self.open_edges = 0  # edges of the report still being staged
+        self.reports = 0  # closed reports queued
+        self.reports_sent = 0
+        self.coalesced = 0
+        self.max_reports = 0
+
+    def press(self, *keycodes: int):
+        for keycode in keycodes:
+            self._push(keycode, EDGE_PRESSED)
+
+    def release(self, *keycodes: int):
+        for keycode in keycodes:
+            self._push(keycode, 0)
+
+    def _push(self, keycode: int, flags: int):
+        if self.length == self.capacity:
+            self._merge_oldest()
+        index = (self.head + self.length) % self.capacity
+        self.keycodes[index] = keycode
+        self.flags[index] = flags
+        self.length += 1
+        self.open_edges += 1
+
+    def end_report(self):
+        if not self.open_edges:
+            return
+        self.flags[(self.head + self.length - 1) % self.capacity] |= EDGE_END
+        self.open_edges = 0
+        self.reports += 1
+        if self.reports > self.max_reports:
+            self.max_reports = self.reports
+
+    def ready(self) -> bool:
+        """Whether another report fits without merging queued ones."""
+        return self.capacity - self.length >= REPORT_EDGES
+
+    def pump(self):
+        while self.reports and (self._ready is None or self._ready()):
+            self._apply_report()
+            self._commit()
+            self.reports_sent += 1
+
+    def flush(self):
+        """Send everything queued as one report, ready or not, e.g. before the transport is switched away from."""
+        if not self.length:
+            return
+        while self.length:
+            self._apply_report()
+        self._commit()
+        self.reports_sent += 1
+
+    def clear(self):
+        """Forget everything queued, e.g. when the transport is about to release all keys anyway."""
+        self.head = 0
+        self.length = 0
+        self.open_edges = 0
+        self.reports = 0
+
+    def _apply_report(self):
+        # stage the oldest report's edges on the transport, up to and including its last one
+        while self.length:
+            keycode = self.keycodes[self.head]
+            flags = self.flags[self.head]
+            self.head = (self.head + 1) % self.capacity
+            self.length -= 1
+            if flags & EDGE_PRESSED:
+                self._press(keycode)
+            else:
+                self._release(keycode)
+            if flags & EDGE_END:
+                self.reports -= 1
+                return
+        # the report still being staged, when it is all that is queued
+        self.open_edges = 0
+
+    def _merge_oldest(self):
+        self._apply_report()
+        self.coalesced += 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.reports,
+            "max_queued": self.max_reports,
+            "sent": self.reports_sent,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,47 @@
+from lib.key_buffer import KeyBuffer, OVERFLOW_NEWEST_WINS
+
+
+class BatchedKeyboard:
+    """Wraps an adafruit_hid Keyboard so every change staged before commit() goes out in one report.
+
+    Held keys are tracked in a KeyBuffer, so more than six keys no longer
+    raise; the overflow policy picks which six are reported.
+    """
+
+    def __init__(self, keyboard, overflow_policy: str = OVERFLOW_NEWEST_WINS):
+        self.keyboard = keyboard
+        self.key_buffer = KeyBuffer(6, overflow_policy)
+        self.dirty = False
+
+    def press(self, *keycodes: int):
+        for keycode in keycodes:
+            if 0xE0 <= keycode <= 0xE7:
+                self.keyboard.report[0] |= 1 << (keycode - 0xE0)
+            else:
+                self.key_buffer.press(keycode)
+        self.dirty = True
+
+    def release(self, *keycodes: int):
+        for keycode in keycodes:
+            if 0xE0 <= keycode <= 0xE7:
+                self.keyboard.report[0] &= ~(1 << (keycode - 0xE0))
+            else:
+                self.key_buffer.release(keycode)
+        self.dirty = True
+
+    def clear(self):
+        """Stage releasing every key; commit() sends it."""
+        self.key_buffer.clear()
+        self.keyboard.report[0] = 0
+        self.dirty = True
+
+    def release_all(self):
+        self.key_buffer.clear()
+        self.keyboard.release_all()
+        self.dirty = False
+
+    def commit(self):
+        if self.dirty:
+            self.dirty = False
+            self.key_buffer.fill(self.keyboard.report, 2)
+            self.keyboard._keyboard_device.send_report(self.keyboard.report)
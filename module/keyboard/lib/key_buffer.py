@@ -0,0 +1,98 @@
+import time
+
+OVERFLOW_NEWEST_WINS = "newest_wins"  # report the latest presses, older keys wait for a free slot
+OVERFLOW_OLDEST_FIRST = "oldest_first"  # report the earliest presses, later keys wait for a free slot
+OVERFLOW_POLICIES = (OVERFLOW_NEWEST_WINS, OVERFLOW_OLDEST_FIRST)
+
+NO_KEY = 0  # keycode 0 is never sent, so it doubles as the list terminator
+
+
+class KeyBuffer:
+    """Held keycodes in press order, for 6-key boot reports.
+
+    A doubly linked list threaded through bytearrays indexed by keycode, so
+    press and release are O(1) and never rebuild a list. fill() writes the
+    keys the overflow policy selects; a key pushed out of the report comes
+    back as soon as a slot frees up.
+    """
+
+    def __init__(self, report_size: int = 6, policy: str = OVERFLOW_NEWEST_WINS):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy: {policy}")
+        self.report_size = report_size
+        self.policy = policy
+        self._next = bytearray(256)
+        self._prev = bytearray(256)
+        self._held = bytearray(256)
+        self.pressed_ms = [0] * 256
+        self._head = NO_KEY
+        self._tail = NO_KEY
+        self.count = 0
+
+    def __contains__(self, keycode: int) -> bool:
+        return bool(self._held[keycode])
+
+    @property
+    def overflowing(self) -> bool:
+        return self.count > self.report_size
+
+    def press(self, keycode: int, now_ms: int = None) -> bool:
+        if keycode == NO_KEY or self._held[keycode]:
+            return False
+        self._held[keycode] = 1
+        self.pressed_ms[keycode] = time.monotonic_ns() // 1000000 if now_ms is None else now_ms
+        self._prev[keycode] = self._tail
+        self._next[keycode] = NO_KEY
+        if self._tail == NO_KEY:
+            self._head = keycode
+        else:
+            self._next[self._tail] = keycode
+        self._tail = keycode
+        self.count += 1
+        return True
+
+    def release(self, keycode: int) -> bool:
+        if keycode == NO_KEY or not self._held[keycode]:
+            return False
+        self._held[keycode] = 0
+        prev_key = self._prev[keycode]
+        next_key = self._next[keycode]
+        if prev_key == NO_KEY:
+            self._head = next_key
+        else:
+            self._next[prev_key] = next_key
+        if next_key == NO_KEY:
+            self._tail = prev_key
+        else:
+            self._prev[next_key] = prev_key
+        self.count -= 1
+        return True
+
+    def clear(self):
+        keycode = self._head
+        while keycode != NO_KEY:
+            self._held[keycode] = 0
+            keycode = self._next[keycode]
+        self._head = NO_KEY
+        self._tail = NO_KEY
+        self.count = 0
+
+    def keycodes(self) -> list:
+        """Held keycodes, oldest first."""
+        keycodes = []
+        keycode = self._head
+        while keycode != NO_KEY:
+            keycodes.append(keycode)
+            keycode = self._next[keycode]
+        return keycodes
+
+    def fill(self, report, offset: int = 0):
+        """Write the reported keys, oldest first, into report[offset:offset + report_size]."""
+        keycode = self._head
+        if self.policy == OVERFLOW_NEWEST_WINS:
+            for _ in range(self.count - self.report_size):
+                keycode = self._next[keycode]
+        for i in range(self.report_size):
+            report[offset + i] = keycode
+            if keycode != NO_KEY:
+                keycode = self._next[keycode]
@@ -0,0 +1,168 @@
+SCAN_BYTES = 9
+
+FAULT_STUCK = 1  # held longer than stuck_ms
+FAULT_CHATTER = 2  # re-pressed right after release too often
+FAULT_NAMES = {FAULT_STUCK: "stuck", FAULT_CHATTER: "chatter"}
+
+STUCK_MS = None  # off; holding a key for minutes is normal in games and with repeat
+CHATTER_MS = 30  # a press this soon after the release of the same key is chatter
+CHATTER_LIMIT = 3  # chatter presses within CHATTER_WINDOW_MS that mask the key
+CHATTER_WINDOW_MS = 10000
+CHATTER_CLEAR_MS = 3000  # a chattering key is unmasked after its contact has been still this long
+GLITCH_MIN_KEYS = 4  # a register byte reading 0x00 with this many keys going down at once is a glitch
+
+POPCOUNT = bytearray(bin(value).count("1") for value in range(256))
+
+
+class KeyHealthMonitor:
+    """Masks bits of the scan that cannot be trusted, before debouncing.
+
+    filter() looks at each register byte once per scan: a byte that suddenly
+    reads 0x00 with several keys going down together is a shift register
+    glitch and is masked until it reads something else. With stuck_ms set, a
+    key held past it is masked until its contact opens, except the keys in
+    the stuck_exempt bitmask (modifiers and layer keys), and a key that keeps
+    re-pressing within CHATTER_MS of its release (reported through
+    key_changed() with the debounced edges) is masked until its contact has
+    been still for chatter_clear_ms. Timed checks only run when the nearest
+    deadline is due, and a scan where nothing changed is one comparison.
+    """
+
+    def __init__(self, key_mask: bytearray, key_names: dict = None, stuck_ms: int = STUCK_MS, chatter_limit: int = CHATTER_LIMIT, chatter_window_ms: int = CHATTER_WINDOW_MS, chatter_clear_ms: int = CHATTER_CLEAR_MS, glitch_min_keys: int = GLITCH_MIN_KEYS, size: int = SCAN_BYTES, stuck_exempt: bytearray = None) -> None:
+        self.key_mask = key_mask
+        self.key_names = key_names or {}
+        self.stuck_ms = stuck_ms
+        self.stuck_exempt = stuck_exempt if stuck_exempt is not None else bytearray(size)  # keys never masked as stuck
+        self.chatter_limit = chatter_limit
+        self.chatter_window_ms = chatter_window_ms
+        self.chatter_clear_ms = chatter_clear_ms
+        self.glitch_min_keys = glitch_min_keys
+        self.size = size
+        key_count = size * 8
+        self.previous = bytearray(size)  # raw pressed bits of the last trusted scan
+        self.masked = bytearray(size)
+        self.byte_faults = bytearray(size)
+        self.faults = bytearray(key_count)  # FAULT_* per masked key
+        self.edge_ms = [0] * key_count  # last raw edge
+        self.released_ms = [None] * key_count  # last debounced release
+        self.chatter_start_ms = [0] * key_count
+        self.chatter_count = bytearray(key_count)
+        self.next_check_ms = None
+        self.faulty = 0  # masked keys plus bad registers
+        self.glitches = 0
+        self.masked_keys = 0
+
+    def _name(self, key_id: int) -> str:
+        return self.key_names.get(key_id, str(key_id))
+
+    def _deadline(self, deadline_ms: int):
+        if self.next_check_ms is None or deadline_ms < self.next_check_ms:
+            self.next_check_ms = deadline_ms
+
+    def filter(self, register_bytes: bytearray, pressed_bytes: bytearray, now_ms: int) -> bytearray:
+        """Clear the untrusted bits of a decoded snapshot in place."""
+        previous = self.previous
+        if not self.faulty and pressed_bytes == previous:
+            # nothing changed and nothing is masked: the usual scan
+            if self.next_check_ms is not None and now_ms >= self.next_check_ms:
+                self._check(now_ms)
+            return pressed_bytes
+        masked = self.masked
+        for i in range(self.size):
+            pressed = pressed_bytes[i]
+            if register_bytes[i] == 0 and self.key_mask[i]:
+                if not self.byte_faults[i] and POPCOUNT[pressed & ~previous[i]] >= self.glitch_min_keys:
+                    self.byte_faults[i] = 1
+                    self.faulty += 1
+                    self.glitches += 1
+                    print(f"key health: register {i} read 0x00, masked")
+            elif self.byte_faults[i]:
+                self.byte_faults[i] = 0
+                self.faulty -= 1
+                print(f"key health: register {i} recovered")
+            if self.byte_faults[i]:
+                pressed_bytes[i] = 0
+                continue
+            diff = pressed ^ previous[i]
+            if diff:
+                self._edges(i, diff, pressed, now_ms)
+                previous[i] = pressed
+            if masked[i]:
+                pressed_bytes[i] = pressed & ~masked[i]
+        if self.next_check_ms is not None and now_ms >= self.next_check_ms:
+            self._check(now_ms)
+        return pressed_bytes
+
+    def _edges(self, i: int, diff: int, pressed: int, now_ms: int):
+        base = i << 3
+        for bit in range(8):
+            mask = 0x80 >> bit
+            if not diff & mask:
+                continue
+            key_id = base + bit
+            self.edge_ms[key_id] = now_ms
+            if pressed & mask:
+                if self.stuck_ms is not None and not (self.masked[i] | self.stuck_exempt[i]) & mask:
+                    self._deadline(now_ms + self.stuck_ms)
+            elif self.faults[key_id] == FAULT_STUCK:
+                self._unmask(i, mask, key_id)
+            if self.faults[key_id] == FAULT_CHATTER:
+                self._deadline(now_ms + self.chatter_clear_ms)
+
+    def key_changed(self, key_id: int, pressed: bool, now_ms: int):
+        """Feed a debounced edge; counts presses that follow a release too closely."""
+        if not pressed:
+            self.released_ms[key_id] = now_ms
+            return
+        released_ms = self.released_ms[key_id]
+        if released_ms is None or now_ms - released_ms >= CHATTER_MS:
+            return
+        if now_ms - self.chatter_start_ms[key_id] >= self.chatter_window_ms:
+            self.chatter_start_ms[key_id] = now_ms
+            self.chatter_count[key_id] = 0
+        self.chatter_count[key_id] += 1
+        if self.chatter_count[key_id] >= self.chatter_limit and not self.faults[key_id]:
+            self.chatter_count[key_id] = 0
+            self._mask(key_id, FAULT_CHATTER)
+            self._deadline(now_ms + self.chatter_clear_ms)
+
+    def _mask(self, key_id: int, fault: int):
+        self.masked[key_id >> 3] |= 0x80 >> (key_id & 7)
+        self.faults[key_id] = fault
+        self.faulty += 1
+        self.masked_keys += 1
+        print(f"key health: {self._name(key_id)} masked ({FAULT_NAMES[fault]})")
+
+    def _unmask(self, i: int, mask: int, key_id: int):
+        print(f"key health: {self._name(key_id)} unmasked ({FAULT_NAMES[self.faults[key_id]]} cleared)")
+        self.masked[i] &= ~mask
+        self.faults[key_id] = 0
+        self.faulty -= 1
+
+    def _check(self, now_ms: int):
+        # rare: only when a deadline is due; also finds the next one
+        self.next_check_ms = None
+        for key_id in range(self.size * 8):
+            i = key_id >> 3
+            mask = 0x80 >> (key_id & 7)
+            fault = self.faults[key_id]
+            if fault == FAULT_CHATTER:
+                deadline_ms = self.edge_ms[key_id] + self.chatter_clear_ms
+                if now_ms >= deadline_ms:
+                    self._unmask(i, mask, key_id)
+                else:
+                    self._deadline(deadline_ms)
+            elif not fault and self.stuck_ms is not None and self.previous[i] & ~self.stuck_exempt[i] & mask:
+                deadline_ms = self.edge_ms[key_id] + self.stuck_ms
+                if now_ms >= deadline_ms:
+                    self._mask(key_id, FAULT_STUCK)
+                else:
+                    self._deadline(deadline_ms)
+
+    def stats(self) -> dict:
+        return {
+            "masked": [self._name(key_id) for key_id in range(self.size * 8) if self.faults[key_id]],
+            "bad_registers": [i for i in range(self.size) if self.byte_faults[i]],
+            "glitches": self.glitches,
+            "masked_keys": self.masked_keys,
+        }
@@ -0,0 +1,261 @@
+import os
+import json
+
+from adafruit_hid.keycode import Keycode
+
+from lib.layers import parse_layer_action, TRANSPARENT, MAX_LAYERS, LAYER_TAP_HOLD
+from lib.scheduler import run_to_completion
+from lib.macros import parse_macro_action
+
+COMPILE_SLICE_KEYS = 16  # keys compiled between yields of compile_keymap_steps()
+CACHE_MAGIC = b"KMC2"  # bump when the layout or the compile rules change
+FN_LAYER = "fn"  # every keymap needs this layer: the Fn+key functions (transports, lighting, stats) are bound on it
+MISSING = 0xFFFFFFFF  # stamp of a source file that did not exist at compile time
+UNSAVED_NOTICE = "not saved: CIRCUITPY is read-only to code.py; hold ESCAPE while resetting, or run tools/compile_keymap.py on the host"
+
+
+def source_stamp(path: str):
+    """(mtime, size) of a config file, MISSING for both when it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return MISSING, MISSING
+    return int(stat[8]) & 0xFFFFFFFF, int(stat[6]) & 0xFFFFFFFF
+
+
+def default_layers_config(mapping_config_path: str, fn_mapping_config_path: str) -> dict:
+    """The two-layer keymap used when there is no layers config: base with Fn as MO(fn), and fn."""
+    return {
+        "layers": [
+            {"name": "base", "mapping": mapping_config_path, "keys": {"Fn": "MO(fn)"}, "transparent": False},
+            {"name": FN_LAYER, "mapping": fn_mapping_config_path, "transparent": False},
+        ]
+    }
+
+
+def _keycode(key_name: str):
+    keycode = getattr(Keycode, key_name, None)
+    return keycode if isinstance(keycode, int) else None
+
+
+class CompiledKeymap:
+    """Keymap reduced to what main() needs: no json parsing, no Keycode lookups.
+
+    layers[n] is a list of (physical_id, keycode, value) where value is a
+    Keycode name, or a layer action such as "MO(fn)" or a "MACRO(name)"
+    (keycode 0).
+    """
+
+    def __init__(self, physical_key_name_map: dict, layer_names: list, layers: list, sources: list) -> None:
+        self.physical_key_name_map = physical_key_name_map
+        self.layer_names = layer_names
+        self.layers = layers
+        self.sources = sources  # (path, mtime, size) of every file it was compiled from
+
+    def unknown_macro(self, macros: dict):
+        """The first "MACRO(name)" whose name is not in macros, None when they all are."""
+        for layer in self.layers:
+            for physical_id, keycode, value in layer:
+                macro_name = None if keycode else parse_macro_action(value)
+                if macro_name is not None and macro_name not in macros:
+                    return value
+        return None
+
+    def is_fresh(self, physical_key_config_path: str, layers_config_path: str) -> bool:
+        if len(self.sources) < 2 or self.sources[0][0] != physical_key_config_path or self.sources[1][0] != layers_config_path:
+            return False
+        for path, mtime, size in self.sources:
+            if source_stamp(path) != (mtime, size):
+                return False
+        return True
+
+
+def compile_keymap(physical_key_config_path: str, layers_config_path: str, default_layers_config: dict, layers_config: dict = None, macros: dict = None) -> CompiledKeymap:
+    """Parse the json keymaps once; raises ValueError/KeyError on a bad config."""
+    return run_to_completion(compile_keymap_steps(physical_key_config_path, layers_config_path, default_layers_config, layers_config, macros))
+
+
+def compile_keymap_steps(physical_key_config_path: str, layers_config_path: str, default_layers_config: dict, layers_config: dict = None, macros: dict = None):
+    """Generator form of compile_keymap(): yields after every file and every few keys, returns the CompiledKeymap.
+
+    A layers_config given directly (e.g. from the serial console) is used
+    instead of reading layers_config_path; files it names are still read.
+    With macros given, a "MACRO(name)" naming none of them is a ValueError.
+    """
+    sources = []
+
+    def load(path):
+        sources.append((path,) + source_stamp(path))
+        with open(path) as f:
+            return json.load(f)
+
+    physical_key_name_map = load(physical_key_config_path)
+    yield
+    if layers_config is None:
+        try:
+            layers_config = load(layers_config_path)
+        except OSError:
+            layers_config = default_layers_config
+        yield
+    layer_names = [layer_config["name"] for layer_config in layers_config["layers"]]
+    if len(layer_names) > MAX_LAYERS:
+        raise ValueError(f"at most {MAX_LAYERS} layers are supported")
+    if FN_LAYER not in layer_names:
+        raise ValueError(f"no layer named {FN_LAYER}: the Fn functions are bound on it")
+
+    standard_layer = {}
+    for key_name, physical_id in physical_key_name_map.items():
+        keycode = _keycode(key_name)
+        if keycode is not None:
+            standard_layer[physical_id] = (keycode, key_name)
+
+    layers = []
+    for layer_config in layers_config["layers"]:
+        mapping = layer_config.get("mapping", {})
+        if isinstance(mapping, str):
+            mapping = load(mapping)
+            yield
+        else:
+            mapping = dict(mapping)
+        mapping.update(layer_config.get("keys", {}))
+        # a transparent layer only defines its mapped keys, the rest fall through
+        layer = {} if layer_config.get("transparent", True) else dict(standard_layer)
+        compiled = 0
+        for key_name, value in mapping.items():
+            compiled += 1
+            if compiled % COMPILE_SLICE_KEYS == 0:
+                yield
+            if key_name not in physical_key_name_map:
+                raise ValueError(f"unknown physical key: {key_name}")
+            physical_id = physical_key_name_map[key_name]
+            if value == TRANSPARENT:
+                layer.pop(physical_id, None)
+                continue
+            macro_name = parse_macro_action(value)
+            if macro_name is not None:
+                if macros is not None and macro_name not in macros:
+                    raise ValueError(f"unknown macro: {value}")
+                layer[physical_id] = (0, value)
+                continue
+            action = parse_layer_action(value)
+            if action is None:
+                keycode = _keycode(value)
+                if keycode is None:
+                    raise ValueError(f"unknown key: {value}")
+                layer[physical_id] = (keycode, value)
+                continue
+            if action[1] not in layer_names:
+                raise ValueError(f"unknown layer: {value}")
+            if action[0] == LAYER_TAP_HOLD and _keycode(action[2]) is None:
+                raise ValueError(f"unknown key: {value}")
+            layer[physical_id] = (0, value)
+        layers.append([(physical_id, keycode, value) for physical_id, (keycode, value) in layer.items()])
+    return CompiledKeymap(physical_key_name_map, layer_names, layers, sources)
+
+
+def _put_string(buffer: bytearray, value: str):
+    data = value.encode("utf-8")
+    buffer.append(len(data))
+    buffer.extend(data)
+
+
+def encode_keymap(keymap: CompiledKeymap) -> bytearray:
+    buffer = bytearray(CACHE_MAGIC)
+    buffer.append(len(keymap.sources))
+    for path, mtime, size in keymap.sources:
+        _put_string(buffer, path)
+        buffer.extend(mtime.to_bytes(4, "big"))
+        buffer.extend(size.to_bytes(4, "big"))
+    buffer.append(len(keymap.physical_key_name_map))
+    for key_name, physical_id in keymap.physical_key_name_map.items():
+        buffer.append(physical_id)
+        _put_string(buffer, key_name)
+    buffer.append(len(keymap.layers))
+    for layer_name, layer in zip(keymap.layer_names, keymap.layers):
+        _put_string(buffer, layer_name)
+        buffer.append(len(layer))
+        for physical_id, keycode, value in layer:
+            buffer.append(physical_id)
+            buffer.append(keycode)
+            _put_string(buffer, value)
+    return buffer
+
+
+def decode_keymap(data) -> CompiledKeymap:
+    """Inverse of encode_keymap(); raises ValueError or IndexError on a damaged cache."""
+    if data[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        raise ValueError("not a keymap cache")
+    position = len(CACHE_MAGIC)
+
+    def get_byte():
+        nonlocal position
+        position += 1
+        return data[position - 1]
+
+    def get_int():
+        nonlocal position
+        position += 4
+        return int.from_bytes(data[position - 4:position], "big")
+
+    def get_string():
+        nonlocal position
+        length = get_byte()
+        position += length
+        return data[position - length:position].decode("utf-8")
+
+    sources = []
+    for _ in range(get_byte()):
+        path = get_string()
+        mtime = get_int()
+        sources.append((path, mtime, get_int()))
+    physical_key_name_map = {}
+    for _ in range(get_byte()):
+        physical_id = get_byte()
+        physical_key_name_map[get_string()] = physical_id
+    layer_names = []
+    layers = []
+    for _ in range(get_byte()):
+        layer_names.append(get_string())
+        layer = []
+        for _ in range(get_byte()):
+            physical_id = get_byte()
+            keycode = get_byte()
+            layer.append((physical_id, keycode, get_string()))
+        layers.append(layer)
+    if position != len(data):
+        raise ValueError("trailing bytes in keymap cache")
+    return CompiledKeymap(physical_key_name_map, layer_names, layers, sources)
+
+
+def save_keymap_cache(path: str, keymap: CompiledKeymap) -> bool:
+    try:
+        with open(path, "wb") as f:
+            f.write(encode_keymap(keymap))
+    except OSError:
+        # CIRCUITPY is read-only to code.py unless boot.py remounted it
+        return False
+    return True
+
+
+def load_keymap_cache(path: str):
+    try:
+        with open(path, "rb") as f:
+            return decode_keymap(f.read())
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def load_keymap(cache_path: str, physical_key_config_path: str, layers_config_path: str, default_layers_config: dict, macros: dict = None) -> CompiledKeymap:
+    """Load the compiled keymap, recompiling from json when a source changed since the cache was written.
+
+    macros.json is not one of the sources, so a cached keymap naming a macro
+    that is gone is recompiled too, which raises its ValueError.
+    """
+    keymap = load_keymap_cache(cache_path)
+    if keymap is not None and keymap.is_fresh(physical_key_config_path, layers_config_path):
+        if macros is None or keymap.unknown_macro(macros) is None:
+            return keymap
+    keymap = compile_keymap(physical_key_config_path, layers_config_path, default_layers_config, macros=macros)
+    if not save_keymap_cache(cache_path, keymap):
+        print(cache_path, UNSAVED_NOTICE)
+    return keymap
@@ -0,0 +1,158 @@
+import sys
+import json
+
+try:
+    import supervisor
+except ImportError:
+    supervisor = None
+
+from lib.keymap_cache import compile_keymap_steps, save_keymap_cache, source_stamp, UNSAVED_NOTICE
+
+CONSOLE_MAX_LINE = 4096  # longer lines are dropped, a keymap with inline mappings fits easily
+CONSOLE_READ_CHUNK = 64  # characters read per step
+
+
+class SerialConsole:
+    """Line reader for the USB serial console that never waits for input."""
+
+    def __init__(self, max_line: int = CONSOLE_MAX_LINE, chunk: int = CONSOLE_READ_CHUNK) -> None:
+        self.max_line = max_line
+        self.chunk = chunk
+        self._parts = []
+        self._length = 0
+        self._overflow = False
+
+    def read_line(self):
+        """Return a complete line, or None when none has arrived yet."""
+        if supervisor is None:
+            return None
+        for _ in range(self.chunk):
+            if not supervisor.runtime.serial_bytes_available:
+                return None
+            char = sys.stdin.read(1)
+            if char == "\n" or char == "\r":
+                if not self._parts and not self._overflow:
+                    continue
+                line = "".join(self._parts)
+                overflow = self._overflow
+                self._parts = []
+                self._length = 0
+                self._overflow = False
+                if overflow:
+                    print("console line too long, ignored")
+                    return None
+                return line
+            if self._length < self.max_line:
+                self._parts.append(char)
+                self._length += 1
+            else:
+                self._overflow = True
+        return None
+
+
+class KeymapReloader:
+    """Keymap hot reload done in slices, one per step() call between scans.
+
+    Watches the files the running keymap was compiled from, and takes
+    commands from the serial console:
+
+        reload                  recompile from the config files
+        keymap {"layers": ...}  switch to a layers config given inline
+
+    build(keymap) is a generator that turns a CompiledKeymap into whatever
+    apply() swaps in. apply() is only called once compiling and building
+    both succeeded, so a bad config leaves the running keymap untouched.
+    Only the layers are swapped: the key mask, debouncer and key health
+    state are indexed by physical id and built once at boot, so a keymap
+    whose physical key map differs is rejected until the next reboot.
+    """
+
+    def __init__(self, keymap, build, apply, physical_key_config_path: str, layers_config_path: str, default_layers_config: dict, cache_path: str = None, check_interval_ms: int = 1000, console: SerialConsole = None, macros: dict = None) -> None:
+        self.sources = keymap.sources
+        self.physical_key_name_map = keymap.physical_key_name_map
+        self.build = build
+        self.apply = apply
+        self.physical_key_config_path = physical_key_config_path
+        self.layers_config_path = layers_config_path
+        self.default_layers_config = default_layers_config
+        self.cache_path = cache_path
+        self.check_interval_ms = check_interval_ms
+        self.console = console
+        self.macros = macros
+        self._job = None
+        self._next_check_ms = 0
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def busy(self) -> bool:
+        return self._job is not None
+
+    def request(self, layers_config: dict = None):
+        """Start compiling a new keymap, from the config files or from layers_config; replaces one in progress."""
+        self._job = self._reload(layers_config)
+
+    def _reload(self, layers_config):
+        keymap = yield from compile_keymap_steps(self.physical_key_config_path, self.layers_config_path, self.default_layers_config, layers_config, self.macros)
+        if keymap.physical_key_name_map != self.physical_key_name_map:
+            raise ValueError(f"{self.physical_key_config_path} changed: reboot required")
+        built = yield from self.build(keymap)
+        self.apply(keymap, built)
+        self.reloads += 1
+        print("keymap reloaded")
+        if layers_config is None:
+            self.sources = keymap.sources
+            if self.cache_path is not None:
+                yield
+                if not save_keymap_cache(self.cache_path, keymap):
+                    print(self.cache_path, UNSAVED_NOTICE)
+
+    def _sources_changed(self) -> bool:
+        for path, mtime, size in self.sources:
+            if source_stamp(path) != (mtime, size):
+                return True
+        return False
+
+    def _command(self, line: str):
+        parts = line.strip().split(" ", 1)
+        if parts[0] == "reload":
+            self.request()
+        elif parts[0] == "keymap" and len(parts) == 2:
+            try:
+                layers_config = json.loads(parts[1])
+            except ValueError as error:
+                self._reject(error)
+                return
+            self.request(layers_config)
+        else:
+            print("unknown console command:", parts[0])
+
+    def _reject(self, error):
+        self.failures += 1
+        self.last_error = error
+        print("keymap rejected:", repr(error))
+
+    def step(self, now_ms: int):
+        if self._job is not None:
+            try:
+                next(self._job)
+            except StopIteration:
+                self._job = None
+            except Exception as error:
+                self._job = None
+                self._reject(error)
+            return
+
+        if self.console is not None:
+            line = self.console.read_line()
+            if line is not None:
+                self._command(line)
+                return
+
+        if now_ms >= self._next_check_ms:
+            self._next_check_ms = now_ms + self.check_interval_ms
+            if self._sources_changed():
+                # a config that fails to compile is not retried until it changes again
+                self.sources = [(path,) + source_stamp(path) for path, _, _ in self.sources]
+                self.request()
@@ -0,0 +1,135 @@
+MAX_LAYERS = 8  # layer masks are single bytes
+
+TRANSPARENT = "TRNS"
+LAYER_MOMENTARY = "MO"  # MO(layer): active while held
+LAYER_TOGGLE = "TG"  # TG(layer): flips on every press
+LAYER_ONESHOT = "OSL"  # OSL(layer): active for the next key press, or while held
+LAYER_TAP_HOLD = "LT"  # LT(layer,KEY): KEY when tapped, MO(layer) when held
+LAYER_ACTIONS = (LAYER_MOMENTARY, LAYER_TOGGLE, LAYER_ONESHOT, LAYER_TAP_HOLD)
+
+# HIGHEST_BIT[mask] is the index of the highest set bit, the topmost active layer
+HIGHEST_BIT = bytearray(256)
+for _mask in range(2, 256):
+    HIGHEST_BIT[_mask] = HIGHEST_BIT[_mask >> 1] + 1
+
+
+def parse_layer_action(value: str):
+    """Split "LT(nav,ESCAPE)" into ("LT", "nav", "ESCAPE"); None for plain key names."""
+    if not value.endswith(")") or "(" not in value:
+        return None
+    kind, args = value[:-1].split("(", 1)
+    if kind not in LAYER_ACTIONS:
+        raise ValueError(f"unknown layer action: {value}")
+    args = [arg.strip() for arg in args.split(",")]
+    if kind == LAYER_TAP_HOLD:
+        if len(args) != 2:
+            raise ValueError(f"LT needs a layer and a key: {value}")
+        return kind, args[0], args[1]
+    return kind, args[0], None
+
+
+class LayerStack:
+    """Active layer state; layer 0 is always active.
+
+    Time only comes from tick(), called once per scan with the scan clock,
+    so tap-hold decisions never sleep.
+    """
+
+    def __init__(self, keyboard=None, tap_hold_ms: int = 200):
+        self.keyboard = keyboard
+        self.tap_hold_ms = tap_hold_ms
+        self.now_ms = 0
+        self.momentary = 0
+        self.toggled = 0
+        self.oneshot = 0
+        self.oneshot_held = 0
+        self.oneshot_used = 0
+        self.active = 1
+        # pending tap-hold key: physical id, layer bit, tap keycode, press time
+        self.tap_hold_key_id = None
+        self.tap_hold_bit = 0
+        self.tap_hold_keycode = 0
+        self.tap_hold_start_ms = 0
+        self.tap_hold_holding = 0
+
+    def _update(self):
+        self.active = 1 | self.momentary | self.toggled | self.oneshot
+
+    def reset(self):
+        self.momentary = 0
+        self.toggled = 0
+        self.oneshot = 0
+        self.oneshot_held = 0
+        self.oneshot_used = 0
+        self.tap_hold_key_id = None
+        self.tap_hold_holding = 0
+        self._update()
+
+    def resolve(self, layer_mask: int) -> int:
+        return HIGHEST_BIT[layer_mask & self.active]
+
+    def tick(self, now_ms: int):
+        self.now_ms = now_ms
+        if self.tap_hold_key_id is not None and now_ms - self.tap_hold_start_ms >= self.tap_hold_ms:
+            self._tap_hold_to_hold()
+
+    def before_press(self, key_id: int):
+        # another key pressed while a tap-hold key is pending settles it as a hold
+        if self.tap_hold_key_id is not None and self.tap_hold_key_id != key_id:
+            self._tap_hold_to_hold()
+
+    def after_press(self):
+        if self.oneshot:
+            self.oneshot_used |= self.oneshot & self.oneshot_held
+            self.oneshot &= self.oneshot_held
+            self._update()
+
+    def momentary_on(self, layer: int):
+        self.momentary |= 1 << layer
+        self._update()
+
+    def momentary_off(self, layer: int):
+        self.momentary &= ~(1 << layer)
+        self._update()
+
+    def toggle(self, layer: int):
+        self.toggled ^= 1 << layer
+        self._update()
+
+    def oneshot_press(self, layer: int):
+        bit = 1 << layer
+        self.oneshot |= bit
+        self.oneshot_held |= bit
+        self.oneshot_used &= ~bit
+        self._update()
+
+    def oneshot_release(self, layer: int):
+        bit = 1 << layer
+        self.oneshot_held &= ~bit
+        if self.oneshot_used & bit:
+            self.oneshot &= ~bit
+            self.oneshot_used &= ~bit
+            self._update()
+
+    def tap_hold_press(self, key_id: int, layer: int, keycode: int):
+        self.tap_hold_key_id = key_id
+        self.tap_hold_bit = 1 << layer
+        self.tap_hold_keycode = keycode
+        self.tap_hold_start_ms = self.now_ms
+
+    def tap_hold_release(self, key_id: int, layer: int, keycode: int):
+        bit = 1 << layer
+        if self.tap_hold_holding & bit:
+            self.tap_hold_holding &= ~bit
+            self.momentary_off(layer)
+        elif self.tap_hold_key_id == key_id:
+            self.tap_hold_key_id = None
+            if self.keyboard is not None:
+                self.keyboard.press(keycode)
+                self.keyboard.release(keycode)
+
+    def _tap_hold_to_hold(self):
+        self.tap_hold_key_id = None
+        self.tap_hold_holding |= self.tap_hold_bit
+        self.momentary |= self.tap_hold_bit
+        self._update()
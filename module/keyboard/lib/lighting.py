@@ -0,0 +1,63 @@
+NO_PIXEL = 0xFF
+
+
+class LightRenderer:
+    """Frame buffer in front of the NeoPixel strip.
+
+    Frames are drawn into a bytearray and only pixels that differ from the
+    last pushed frame are written, so an unchanged frame never calls show().
+    """
+
+    def __init__(self, pixels, light_2_key: list, max_light_level: int = 255, key_count: int = 72):
+        self.pixels = pixels
+        self.num_pixels = len(light_2_key)
+        self.max_light_level = max_light_level
+        self.key_2_light = bytearray([NO_PIXEL] * key_count)
+        for pixel_index, key_id in enumerate(light_2_key):
+            self.key_2_light[key_id] = pixel_index
+        self.frame = bytearray(self.num_pixels * 3)
+        self.shown = bytearray(self.num_pixels * 3)
+        self.scale = bytearray(256)
+        self.light_level = None
+        self.set_light_level(max_light_level)
+
+    def set_light_level(self, light_level: int):
+        if light_level == self.light_level:
+            return
+        self.light_level = light_level
+        for value in range(256):
+            self.scale[value] = value * light_level // self.max_light_level
+
+    def clear(self):
+        frame = self.frame
+        for i in range(len(frame)):
+            frame[i] = 0
+
+    def set_key(self, key_id: int, color: tuple):
+        pixel_index = self.key_2_light[key_id]
+        if pixel_index == NO_PIXEL:
+            return
+        scale = self.scale
+        offset = pixel_index * 3
+        self.frame[offset] = scale[color[0]]
+        self.frame[offset + 1] = scale[color[1]]
+        self.frame[offset + 2] = scale[color[2]]
+
+    def show(self, force: bool = False) -> bool:
+        frame = self.frame
+        shown = self.shown
+        dirty = force
+        for pixel_index in range(self.num_pixels):
+            offset = pixel_index * 3
+            r = frame[offset]
+            g = frame[offset + 1]
+            b = frame[offset + 2]
+            if force or r != shown[offset] or g != shown[offset + 1] or b != shown[offset + 2]:
+                self.pixels[pixel_index] = (r, g, b)
+                shown[offset] = r
+                shown[offset + 1] = g
+                shown[offset + 2] = b
+                dirty = True
+        if dirty:
+            self.pixels.show()
+        return dirty
@@ -0,0 +1,204 @@
+import json
+
+from adafruit_hid.keycode import Keycode
+
+MACRO_ACTION = "MACRO"  # MACRO(name): play the named macro on press
+
+# a compiled macro is a bytearray of these ops
+OP_PRESS = 1  # keycode
+OP_RELEASE = 2  # keycode
+OP_SEND = 3  # send the staged changes as one report, then wait for the next step
+OP_DELAY = 4  # 16-bit big endian milliseconds
+
+MAX_PROGRAM_LENGTH = 16384  # bytes per compiled macro, repeats included
+MAX_QUEUED = 8  # macros waiting behind the one playing
+
+# US layout: char -> (keycode, shifted)
+ASCII_KEYCODES = {
+    " ": (Keycode.SPACEBAR, False),
+    "\n": (Keycode.ENTER, False),
+    "\t": (Keycode.TAB, False),
+}
+for _i in range(26):
+    ASCII_KEYCODES[chr(ord("a") + _i)] = (Keycode.A + _i, False)
+    ASCII_KEYCODES[chr(ord("A") + _i)] = (Keycode.A + _i, True)
+for _i, (_char, _shifted_char) in enumerate(zip("1234567890", "!@#$%^&*()")):
+    ASCII_KEYCODES[_char] = (Keycode.ONE + _i, False)
+    ASCII_KEYCODES[_shifted_char] = (Keycode.ONE + _i, True)
+for _char, _shifted_char, _keycode in (
+    ("-", "_", Keycode.MINUS),
+    ("=", "+", Keycode.EQUALS),
+    ("[", "{", Keycode.LEFT_BRACKET),
+    ("]", "}", Keycode.RIGHT_BRACKET),
+    ("\\", "|", Keycode.BACKSLASH),
+    (";", ":", Keycode.SEMICOLON),
+    ("'", '"', Keycode.QUOTE),
+    ("`", "~", Keycode.GRAVE_ACCENT),
+    (",", "<", Keycode.COMMA),
+    (".", ">", Keycode.PERIOD),
+    ("/", "?", Keycode.FORWARD_SLASH),
+):
+    ASCII_KEYCODES[_char] = (_keycode, False)
+    ASCII_KEYCODES[_shifted_char] = (_keycode, True)
+
+
+def parse_macro_action(value: str):
+    """The macro name of "MACRO(name)", None for anything else."""
+    if value.startswith(MACRO_ACTION + "(") and value.endswith(")"):
+        return value[len(MACRO_ACTION) + 1:-1].strip()
+    return None
+
+
+def _keycode(key_name: str) -> int:
+    keycode = getattr(Keycode, key_name, None)
+    if not isinstance(keycode, int):
+        raise ValueError(f"unknown key: {key_name}")
+    return keycode
+
+
+def _compile_text(program: bytearray, text: str):
+    # one report per character: the previous key goes up in the same report the next goes down
+    held = 0
+    held_shift = False
+    for char in text:
+        if char not in ASCII_KEYCODES:
+            raise ValueError(f"no key for character {repr(char)}")
+        keycode, shift = ASCII_KEYCODES[char]
+        if held == keycode:
+            program.extend((OP_RELEASE, held, OP_SEND))
+            held = 0
+        if held:
+            program.extend((OP_RELEASE, held))
+        if held_shift and not shift:
+            program.extend((OP_RELEASE, Keycode.LEFT_SHIFT))
+        elif shift and not held_shift:
+            program.extend((OP_PRESS, Keycode.LEFT_SHIFT))
+        program.extend((OP_PRESS, keycode, OP_SEND))
+        held = keycode
+        held_shift = shift
+    if held:
+        program.extend((OP_RELEASE, held))
+    if held_shift:
+        program.extend((OP_RELEASE, Keycode.LEFT_SHIFT))
+    if held or held_shift:
+        program.append(OP_SEND)
+
+
+def _compile_steps(program: bytearray, steps: list):
+    for step in steps:
+        start = len(program)
+        if "text" in step:
+            _compile_text(program, step["text"])
+        elif "chord" in step:
+            keycodes = [_keycode(key_name) for key_name in step["chord"]]
+            for keycode in keycodes:
+                program.extend((OP_PRESS, keycode))
+            program.append(OP_SEND)
+            for keycode in keycodes:
+                program.extend((OP_RELEASE, keycode))
+            program.append(OP_SEND)
+        elif "delay" in step:
+            delay_ms = int(step["delay"])
+            if not 0 <= delay_ms <= 0xFFFF:
+                raise ValueError(f"delay out of range: {delay_ms}")
+            program.extend((OP_DELAY, delay_ms >> 8, delay_ms & 0xFF))
+        elif "steps" in step:
+            _compile_steps(program, step["steps"])
+        else:
+            raise ValueError(f"unknown macro step: {step}")
+        repeat = int(step.get("repeat", 1))
+        body = program[start:]
+        if len(program) + len(body) * (repeat - 1) > MAX_PROGRAM_LENGTH:
+            raise ValueError(f"repeat {repeat} makes the macro longer than {MAX_PROGRAM_LENGTH} bytes")
+        for _ in range(repeat - 1):
+            program.extend(body)
+        if len(program) > MAX_PROGRAM_LENGTH:
+            raise ValueError(f"macro longer than {MAX_PROGRAM_LENGTH} bytes")
+
+
+def compile_macro(steps: list) -> bytearray:
+    """Compile json macro steps into ops.
+
+    A step is {"text": "..."}, {"chord": ["LEFT_CONTROL", "C"]},
+    {"delay": ms} or {"steps": [...]}, each with an optional "repeat".
+    """
+    program = bytearray()
+    _compile_steps(program, steps)
+    return program
+
+
+def load_macros(path: str) -> dict:
+    try:
+        config = json.load(open(path))
+    except OSError:
+        return {}
+    macros = {}
+    for name, steps in config.get("macros", {}).items():
+        try:
+            macros[name] = compile_macro(steps)
+        except ValueError as error:
+            raise ValueError(f"macro {name}: {error}")
+    return macros
+
+
+class MacroEngine:
+    """Plays compiled macros a step at a time from the main loop.
+
+    step() runs once per loop iteration. It sends at most one report per call,
+    and only when the transport can take one (keyboard.ready()), so a long
+    macro never holds up scanning for more than one report.
+    """
+
+    def __init__(self, keyboard, macros: dict = None, max_queued: int = MAX_QUEUED) -> None:
+        self.keyboard = keyboard
+        self.macros = macros if macros is not None else {}
+        self.max_queued = max_queued
+        self._queue = []
+        self._program = None
+        self._position = 0
+        self._resume_ms = 0
+        self.dropped = 0
+
+    @property
+    def playing(self) -> bool:
+        return self._program is not None
+
+    def play(self, name: str):
+        if len(self._queue) >= self.max_queued:
+            self.dropped += 1
+            return None
+        self._queue.append(self.macros[name])
+        return None
+
+    def step(self, now_ms: int):
+        if self._program is None:
+            if not self._queue:
+                return
+            self._program = self._queue.pop(0)
+            self._position = 0
+            self._resume_ms = now_ms
+        if now_ms < self._resume_ms or not self.keyboard.ready():
+            return
+
+        program = self._program
+        position = self._position
+        end = len(program)
+        while position < end:
+            op = program[position]
+            if op == OP_PRESS:
+                self.keyboard.press_many(program[position + 1])
+                position += 2
+            elif op == OP_RELEASE:
+                self.keyboard.release_many(program[position + 1])
+                position += 2
+            elif op == OP_SEND:
+                position += 1
+                self.keyboard.commit()
+                break
+            else:
+                self._resume_ms = now_ms + (program[position + 1] << 8 | program[position + 2])
+                position += 3
+                break
+        self._position = position
+        if position >= end:
+            self._program = None
@@ -0,0 +1,111 @@
+NKRO_REPORT_ID = 4
+NKRO_KEY_BITS = 120  # usages 0x00-0x77, up to F24
+NKRO_REPORT_LENGTH = 1 + NKRO_KEY_BITS // 8  # modifier byte + key bitmap
+
+NKRO_KEYBOARD_DESCRIPTOR = bytes((
+    0x05, 0x01,  # Usage Page (Generic Desktop)
+    0x09, 0x06,  # Usage (Keyboard)
+    0xA1, 0x01,  # Collection (Application)
+    0x85, NKRO_REPORT_ID,  # Report ID
+    0x05, 0x07,  # Usage Page (Keyboard)
+    0x19, 0xE0,  # Usage Minimum (Left Control)
+    0x29, 0xE7,  # Usage Maximum (Right GUI)
+    0x15, 0x00,  # Logical Minimum (0)
+    0x25, 0x01,  # Logical Maximum (1)
+    0x75, 0x01,  # Report Size (1)
+    0x95, 0x08,  # Report Count (8)
+    0x81, 0x02,  # Input (Data, Variable, Absolute), modifier bits
+    0x19, 0x00,  # Usage Minimum (0)
+    0x29, NKRO_KEY_BITS - 1,  # Usage Maximum
+    0x95, NKRO_KEY_BITS,  # Report Count
+    0x81, 0x02,  # Input (Data, Variable, Absolute), key bitmap
+    0x05, 0x08,  # Usage Page (LEDs)
+    0x19, 0x01,  # Usage Minimum (Num Lock)
+    0x29, 0x05,  # Usage Maximum (Kana)
+    0x95, 0x05,  # Report Count (5)
+    0x91, 0x02,  # Output (Data, Variable, Absolute), LED report
+    0x95, 0x01,  # Report Count (1)
+    0x75, 0x03,  # Report Size (3)
+    0x91, 0x01,  # Output (Constant), LED report padding
+    0xC0,  # End Collection
+))
+
+
+def create_nkro_device(usb_hid):
+    """Build the usb_hid.Device to pass to usb_hid.enable() in boot.py."""
+    return usb_hid.Device(
+        report_descriptor=NKRO_KEYBOARD_DESCRIPTOR,
+        usage_page=0x01,
+        usage=0x06,
+        report_ids=(NKRO_REPORT_ID,),
+        in_report_lengths=(NKRO_REPORT_LENGTH,),
+        out_report_lengths=(1,),
+    )
+
+
+def find_nkro_device(devices):
+    for device in devices:
+        if device.usage_page == 0x01 and device.usage == 0x06 and NKRO_REPORT_ID in device.report_ids:
+            return device
+    raise ValueError("NKRO keyboard device not enabled in boot.py")
+
+
+class NKROKeyboard:
+    """Bitmap keyboard report kept in a preallocated bytearray.
+
+    press() and release() only flip bits; commit() sends at most one report
+    per scan. A key that changes twice before a commit (a tap inside one scan)
+    flushes the pending report first so the host sees both edges.
+    """
+
+    def __init__(self, devices):
+        self._device = find_nkro_device(devices)
+        self.report = bytearray(NKRO_REPORT_LENGTH)
+        self._sent = bytearray(NKRO_REPORT_LENGTH)
+        self._dirty = False
+        self.reports_sent = 0
+        self.release_all()
+        self.commit()
+
+    @staticmethod
+    def _locate(keycode: int):
+        if 0xE0 <= keycode <= 0xE7:
+            return 0, 1 << (keycode - 0xE0)
+        if keycode < NKRO_KEY_BITS:
+            return 1 + (keycode >> 3), 1 << (keycode & 7)
+        raise ValueError(f"keycode out of NKRO range: {keycode}")
+
+    def _set(self, keycode: int, pressed: bool):
+        index, mask = self._locate(keycode)
+        if bool(self.report[index] & mask) == pressed:
+            return
+        if self._dirty and (self.report[index] ^ self._sent[index]) & mask:
+            self.commit()
+        if pressed:
+            self.report[index] |= mask
+        else:
+            self.report[index] &= ~mask
+        self._dirty = True
+
+    def press(self, *keycodes: int):
+        for keycode in keycodes:
+            self._set(keycode, True)
+
+    def release(self, *keycodes: int):
+        for keycode in keycodes:
+            self._set(keycode, False)
+
+    def release_all(self):
+        for i in range(NKRO_REPORT_LENGTH):
+            if self.report[i]:
+                self.report[i] = 0
+                self._dirty = True
+
+    def commit(self):
+        if not self._dirty:
+            return
+        self._device.send_report(self.report, NKRO_REPORT_ID)
+        for i in range(NKRO_REPORT_LENGTH):
+            self._sent[i] = self.report[i]
+        self._dirty = False
+        self.reports_sent += 1
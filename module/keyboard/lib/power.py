@@ -0,0 +1,70 @@
+POWER_ACTIVE = "active"  # full scan rate, lights on
+POWER_IDLE = "idle"  # slower scan, lights off
+POWER_SLEEP = "sleep"  # slowest scan that still catches a quick tap
+POWER_STATES = (POWER_ACTIVE, POWER_IDLE, POWER_SLEEP)
+
+IDLE_AFTER_MS = 30000
+SLEEP_AFTER_MS = 300000
+# a tap holds a switch down for 30 ms or more, so even the sleep rate sees every press
+SCAN_INTERVALS = {POWER_ACTIVE: 0.001, POWER_IDLE: 0.01, POWER_SLEEP: 0.02}  # seconds between scans
+
+
+class PowerManager:
+    """Active/idle/sleep state machine driven by how long the keys have been untouched.
+
+    scan() is called with every raw scan: any key down counts as activity, so
+    the first changed bit wakes the keyboard in the same scan that reports it
+    and a held key never lets it doze off. on_change(state) is called on every
+    transition to switch rails and lights.
+    """
+
+    def __init__(self, on_change=None, idle_after_ms: int = IDLE_AFTER_MS, sleep_after_ms: int = SLEEP_AFTER_MS, scan_intervals: dict = None) -> None:
+        self.on_change = on_change
+        self.idle_after_ms = idle_after_ms
+        self.sleep_after_ms = sleep_after_ms
+        self.scan_intervals = dict(SCAN_INTERVALS)
+        if scan_intervals:
+            self.scan_intervals.update(scan_intervals)
+        self.state = POWER_ACTIVE
+        self.scan_interval = self.scan_intervals[POWER_ACTIVE]
+        self.last_activity_ms = None
+        self.state_since_ms = None
+        self.state_ms = {state: 0 for state in POWER_STATES}  # time spent in each state
+        self.wakeups = 0
+
+    def scan(self, raw_bytes: bytearray, now_ms: int):
+        for byte in raw_bytes:
+            if byte:
+                self.touch(now_ms)
+                return
+        self.step(now_ms)
+
+    def touch(self, now_ms: int):
+        """Record activity, e.g. a key down or a macro playing."""
+        self.last_activity_ms = now_ms
+        if self.state != POWER_ACTIVE:
+            self.wakeups += 1
+            self._set_state(POWER_ACTIVE, now_ms)
+
+    def step(self, now_ms: int):
+        if self.last_activity_ms is None:
+            self.last_activity_ms = now_ms
+            self.state_since_ms = now_ms
+        quiet_ms = now_ms - self.last_activity_ms
+        if quiet_ms >= self.sleep_after_ms:
+            state = POWER_SLEEP
+        elif quiet_ms >= self.idle_after_ms:
+            state = POWER_IDLE
+        else:
+            state = POWER_ACTIVE
+        if state != self.state:
+            self._set_state(state, now_ms)
+
+    def _set_state(self, state: str, now_ms: int):
+        if self.state_since_ms is not None:
+            self.state_ms[self.state] += now_ms - self.state_since_ms
+        self.state_since_ms = now_ms
+        self.state = state
+        self.scan_interval = self.scan_intervals[state]
+        if self.on_change is not None:
+            self.on_change(state)
@@ -0,0 +1,71 @@
+from array import array
+
+STAGE_SPI = 0
+STAGE_DECODE = 1
+STAGE_LAYER = 2
+STAGE_HID = 3
+STAGE_LIGHT = 4
+STAGE_SCAN = 5  # SPI read to the end of HID reporting, the scan-to-report latency
+STAGE_NAMES = ("spi", "decode", "layer", "hid", "light", "scan")
+
+HISTOGRAM_BUCKETS = 16  # bucket n counts durations below 2**n us, the last one is open-ended
+COUNTER_LIMIT = 0x3FFFFFFF  # largest CircuitPython small int; counters stay below it so recording never allocates
+
+
+class LatencyProfiler:
+    """Per-stage duration histograms held in preallocated arrays.
+
+    Durations are in nanoseconds from time.monotonic_ns(), bucketed by powers
+    of two of microseconds so recording never allocates. A stage whose count
+    or total would pass COUNTER_LIMIT starts over from zero, histogram
+    included, so its mean and buckets always describe the same scans.
+    """
+
+    def __init__(self, stage_names: tuple = STAGE_NAMES, buckets: int = HISTOGRAM_BUCKETS):
+        self.stage_names = stage_names
+        self.buckets = buckets
+        stages = len(stage_names)
+        self.histograms = array("L", [0] * (stages * buckets))
+        self.counts = array("L", [0] * stages)
+        self.totals_us = array("L", [0] * stages)
+        self.max_us = array("L", [0] * stages)
+
+    def reset(self):
+        for stage in range(len(self.counts)):
+            self._restart(stage)
+
+    def _restart(self, stage: int):
+        offset = stage * self.buckets
+        for i in range(offset, offset + self.buckets):
+            self.histograms[i] = 0
+        self.counts[stage] = 0
+        self.totals_us[stage] = 0
+        self.max_us[stage] = 0
+
+    def record(self, stage: int, duration_ns: int):
+        duration_us = duration_ns // 1000
+        if duration_us > COUNTER_LIMIT:
+            duration_us = COUNTER_LIMIT
+        if self.counts[stage] >= COUNTER_LIMIT or self.totals_us[stage] > COUNTER_LIMIT - duration_us:
+            self._restart(stage)
+        bucket = 0
+        value = duration_us
+        while value and bucket < self.buckets - 1:
+            value >>= 1
+            bucket += 1
+        self.histograms[stage * self.buckets + bucket] += 1
+        self.counts[stage] += 1
+        self.totals_us[stage] += duration_us
+        if duration_us > self.max_us[stage]:
+            self.max_us[stage] = duration_us
+
+    def dump(self):
+        print("stage   count   mean_us  max_us  histogram(<1us,<2us,<4us,...)")
+        for stage, name in enumerate(self.stage_names):
+            count = self.counts[stage]
+            if not count:
+                continue
+            offset = stage * self.buckets
+            histogram = ",".join(str(self.histograms[offset + i]) for i in range(self.buckets))
+            print(f"{name:<7} {count:<7} {self.totals_us[stage] // count:<8} {self.max_us[stage]:<7} {histogram}")
+        return None
@@ -0,0 +1,71 @@
+PRIORITY_REALTIME = 0
+PRIORITY_BACKGROUND = 1
+
+
+class Task:
+    def __init__(self, name: str, function, interval_ms: int = 0, priority: int = PRIORITY_REALTIME):
+        self.name = name
+        self.function = function
+        self.interval_ms = interval_ms
+        self.priority = priority
+        self.next_run_ms = 0
+        self.runs = 0
+        self.dropped = 0
+
+
+class Scheduler:
+    """Cooperative tick-based task list driven by the scan clock.
+
+    Realtime tasks run on every tick. Background tasks run when their interval
+    is due, at most one per tick, and missed intervals are counted as dropped
+    instead of being caught up, so they never delay the next scan.
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, name: str, function, interval_ms: int = 0, priority: int = PRIORITY_REALTIME) -> Task:
+        task = Task(name, function, interval_ms, priority)
+        index = 0
+        while index < len(self.tasks) and self.tasks[index].priority <= priority:
+            index += 1
+        self.tasks.insert(index, task)
+        return task
+
+    def get(self, name: str) -> Task:
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def set_interval(self, name: str, interval_ms: int):
+        self.get(name).interval_ms = interval_ms
+
+    def run_once(self, now_ms: int):
+        background_ran = False
+        for task in self.tasks:
+            if now_ms < task.next_run_ms:
+                continue
+            if task.priority != PRIORITY_REALTIME:
+                if background_ran:
+                    continue
+                background_ran = True
+            if task.interval_ms:
+                late = now_ms - task.next_run_ms
+                if not task.runs or late >= task.interval_ms:
+                    if task.runs:
+                        task.dropped += late // task.interval_ms
+                    task.next_run_ms = now_ms + task.interval_ms
+                else:
+                    task.next_run_ms += task.interval_ms
+            task.function(now_ms)
+            task.runs += 1
+
+
+def run_to_completion(steps):
+    """Drive a generator that does its work in slices to the end; returns its return value."""
+    try:
+        while True:
+            next(steps)
+    except StopIteration as stop:
+        return stop.value
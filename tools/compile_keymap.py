@@ -0,0 +1,44 @@
+"""Compile the keyboard's json keymaps into config/keymap.bin on the host.
+
+    python tools/compile_keymap.py [KEYBOARD_DIR]
+
+Point it at the mounted CIRCUITPY drive after editing the keymaps there, so
+the keyboard does not parse json on its next boot. The keyboard recompiles
+by itself whenever a source file's mtime or size no longer matches the cache.
+The paths default to the ones set at the top of code.py.
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEYBOARD_DIR = os.path.join(ROOT, "module", "keyboard")
+# a pip-installed adafruit_hid wins over the simulator's copy
+sys.path.append(os.path.join(ROOT, "tools", "sim"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("keyboard_dir", nargs="?", default=KEYBOARD_DIR, help="directory holding code.py and config/")
+    parser.add_argument("--physical-keys", default="config/physical_key_name_map.json")
+    parser.add_argument("--layers", default="config/layers.json")
+    parser.add_argument("--mapping", default="config/mapping.json", help="base layer when there is no layers config")
+    parser.add_argument("--fn-mapping", default="config/fn_mapping.json", help="fn layer when there is no layers config")
+    parser.add_argument("--macros", default="config/macros.json", help="MACRO(name) keys must name one of these")
+    parser.add_argument("--output", default="config/keymap.bin")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.keyboard_dir))
+    os.chdir(args.keyboard_dir)  # the cache records paths relative to code.py, as on the board
+    from lib.keymap_cache import compile_keymap, save_keymap_cache, default_layers_config
+    from lib.macros import load_macros
+
+    keymap = compile_keymap(args.physical_keys, args.layers, default_layers_config(args.mapping, args.fn_mapping), macros=load_macros(args.macros))
+    if not save_keymap_cache(args.output, keymap):
+        sys.exit(f"could not write {args.output}")
+    print(f"{args.output}: {len(keymap.layers)} layers from {', '.join(path for path, _, _ in keymap.sources)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Summarize the keyboard's press/release log (analytics.bin) on the host.
+
+    python tools/decode_keylog.py [LOG ...] [--json]
+
+Reports per-key press counts, a histogram of the time between consecutive
+presses, and chatter: a key pressed again within --chatter-ms of being
+released, which usually means a worn switch or a debounce time set too low.
+LOG defaults to analytics.bin.old and analytics.bin in the keyboard dir.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KEYBOARD_DIR = os.path.join(ROOT, "module", "keyboard")
+sys.path.insert(0, KEYBOARD_DIR)
+
+from lib.analytics import LOG_MAGIC, RECORD_SIZE, SESSION_ID, MAX_DELTA_MS  # noqa: E402
+
+CHATTER_MS = 30
+HISTOGRAM_BUCKETS = 16  # power of two buckets: <1 ms, 1 ms, 2-3 ms, 4-7 ms ... 16 s and longer
+
+
+def read_records(path: str):
+    """Yield (key_id, pressed, time_ms) from one log; time restarts at each boot."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(LOG_MAGIC)] != LOG_MAGIC:
+        raise ValueError(f"{path}: not a key event log")
+    now_ms = 0
+    end = len(data) - (len(data) - len(LOG_MAGIC)) % RECORD_SIZE  # a flush cut short leaves a partial record
+    for offset in range(len(LOG_MAGIC), end, RECORD_SIZE):
+        key_id = data[offset] >> 1
+        pressed = data[offset] & 1
+        delta_ms = data[offset + 1] << 8 | data[offset + 2]
+        if key_id == SESSION_ID:
+            yield SESSION_ID, 0, None
+            now_ms = 0
+            continue
+        now_ms += delta_ms
+        yield key_id, pressed, now_ms
+
+
+def bucket(interval_ms: int) -> int:
+    return min(interval_ms.bit_length(), HISTOGRAM_BUCKETS - 1)
+
+
+def bucket_label(index: int) -> str:
+    if index == 0:
+        return "<1ms"
+    if index == HISTOGRAM_BUCKETS - 1:
+        return f">={1 << (index - 1)}ms"
+    return f"{1 << (index - 1)}-{(1 << index) - 1}ms"
+
+
+def summarize(paths: list, key_names: dict, chatter_ms: int = CHATTER_MS) -> dict:
+    presses = {}
+    chatter = {}
+    histogram = [0] * HISTOGRAM_BUCKETS
+    sessions = 0
+    events = 0
+    released_ms = {}
+    last_press_ms = None
+    for path in paths:
+        for key_id, pressed, now_ms in read_records(path):
+            if key_id == SESSION_ID:
+                sessions += 1
+                released_ms.clear()
+                last_press_ms = None
+                continue
+            events += 1
+            name = key_names.get(key_id, str(key_id))
+            if not pressed:
+                released_ms[key_id] = now_ms
+                continue
+            presses[name] = presses.get(name, 0) + 1
+            if key_id in released_ms and now_ms - released_ms[key_id] < chatter_ms:
+                chatter[name] = chatter.get(name, 0) + 1
+            # a saturated delta means the real gap is unknown, leave it out
+            if last_press_ms is not None and now_ms - last_press_ms < MAX_DELTA_MS:
+                histogram[bucket(now_ms - last_press_ms)] += 1
+            last_press_ms = now_ms
+    return {
+        "sessions": sessions,
+        "events": events,
+        "presses": dict(sorted(presses.items(), key=lambda item: -item[1])),
+        "press_interval_histogram": {bucket_label(index): count for index, count in enumerate(histogram)},
+        "chatter": dict(sorted(chatter.items(), key=lambda item: -item[1])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("logs", nargs="*", help="log files, oldest first")
+    parser.add_argument("--physical-keys", default=os.path.join(KEYBOARD_DIR, "config", "physical_key_name_map.json"))
+    parser.add_argument("--chatter-ms", type=int, default=CHATTER_MS)
+    parser.add_argument("--json", action="store_true", help="print the summary as json")
+    args = parser.parse_args()
+
+    paths = args.logs
+    if not paths:
+        paths = [path for path in (os.path.join(KEYBOARD_DIR, "analytics.bin.old"), os.path.join(KEYBOARD_DIR, "analytics.bin")) if os.path.exists(path)]
+        if not paths:
+            sys.exit("no log given and no analytics.bin in the keyboard dir")
+    with open(args.physical_keys) as f:
+        key_names = {physical_id: key_name for key_name, physical_id in json.load(f).items()}
+    try:
+        summary = summarize(paths, key_names, args.chatter_ms)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{summary['events']} events in {summary['sessions']} sessions")
+    print("presses:")
+    for name, count in summary["presses"].items():
+        print(f"  {name:>16} {count}")
+    print("time between presses:")
+    for label, count in summary["press_interval_histogram"].items():
+        if count:
+            print(f"  {label:>16} {count}")
+    print(f"chatter (re-pressed within {args.chatter_ms}ms of release):")
+    for name, count in summary["chatter"].items():
+        print(f"  {name:>16} {count}")
+    if not summary["chatter"]:
+        print("  none")
+
+
+if __name__ == "__main__":
+    main()
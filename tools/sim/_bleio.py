@@ -0,0 +1,22 @@
+"""Stand-in for the CircuitPython ``_bleio`` module."""
+
+
+class Address:
+    def __init__(self, address=b"\x68\x4b\x00\x5e\x5c\x11"):
+        self.address_bytes = address
+
+    def __repr__(self):
+        return "<Address " + ":".join("%02x" % b for b in reversed(self.address_bytes)) + ">"
+
+
+class Adapter:
+    def __init__(self):
+        self.enabled = False
+        self.address = Address()
+        self.bonding_erased = 0
+
+    def erase_bonding(self):
+        self.bonding_erased += 1
+
+
+adapter = Adapter()
@@ -0,0 +1,45 @@
+"""Stand-in for the ``adafruit_ble`` library. A peer is connected as soon as advertising starts."""
+
+import simulator
+
+
+class BLEConnection:
+    def __init__(self):
+        self.connected = True
+        self._connection_interval = 30.0
+
+    @property
+    def connection_interval(self):
+        return self._connection_interval
+
+    @connection_interval.setter
+    def connection_interval(self, value):
+        # like a real central, grant no shorter interval than the host allows
+        self._connection_interval = max(float(value), simulator.hardware.ble_min_interval_ms)
+
+    def disconnect(self):
+        self.connected = False
+        simulator.hardware.ble_connections.remove(self)
+
+
+class BLERadio:
+    def __init__(self, adapter=None):
+        self.advertising = False
+        self.name = "CIRCUITPY"
+
+    def start_advertising(self, advertisement, scan_response=None, interval=0.1, timeout=None):
+        self.advertising = True
+        if simulator.hardware.ble_auto_connect and not simulator.hardware.ble_connections:
+            simulator.hardware.ble_connections.append(BLEConnection())
+            self.advertising = False
+
+    def stop_advertising(self):
+        self.advertising = False
+
+    @property
+    def connected(self):
+        return bool(simulator.hardware.ble_connections)
+
+    @property
+    def connections(self):
+        return tuple(simulator.hardware.ble_connections)
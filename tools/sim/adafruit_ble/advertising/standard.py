@@ -0,0 +1,6 @@
+class ProvideServicesAdvertisement:
+    def __init__(self, *services):
+        self.services = services
+        self.appearance = 0
+        self.short_name = None
+        self.complete_name = None
@@ -0,0 +1,21 @@
+import simulator
+
+
+class ReportOut:
+    def __init__(self, usage_page=0x01, usage=0x06):
+        self.usage_page = usage_page
+        self.usage = usage
+
+    def send_report(self, report, report_id=None):
+        if simulator.hardware.ble_connections:
+            simulator.hardware.record("bluetooth", bytes(report), report_id)
+        else:
+            simulator.hardware.record("bluetooth_dropped", bytes(report), report_id)
+
+    def get_last_received_report(self, report_id=None):
+        return None
+
+
+class HIDService:
+    def __init__(self, hid_descriptor=None):
+        self.devices = [ReportOut(0x01, 0x06), ReportOut(0x01, 0x02), ReportOut(0x0C, 0x01)]
@@ -0,0 +1,386 @@
+"""Benchmark the keyboard firmware's hot path on CPython against stored baselines.
+
+    python tools/sim/bench.py             # compare with bench_baseline.json, exit 1 on a regression
+    python tools/sim/bench.py --update    # store the current numbers as the baseline
+
+Two kinds of numbers are taken, each with the firmware loaded on the
+simulated hardware:
+
+- stages: single functions called in a tight loop (shift register read,
+  snapshot decoding, a frame of each lighting effect, a slice of the ripple
+  ring tables, a CH9329 key frame), time and peak bytes allocated per call;
+- scenarios: main() replaying a trace (idle, typing, rollover mash, Fn-layer
+  churn), CPU time per scan, peak bytes allocated by a scan that sent a
+  report (any scan for idle), and reports sent per trace event.
+
+Times are gated in units of a fixed pure-Python loop (time_loops,
+cpu_per_scan_loops). Passes of that loop are interleaved with the measured
+work, between slices of a stage's calls and every few scans of a scenario
+(hidden from the simulated clock), so a host that is slower or faster as a
+whole, or for a while, cancels out. The median over REPEATS runs is kept,
+so neither a stalled run nor an odd fast one moves the result.
+Microseconds are printed alongside for reading only.
+
+Allocations are portable; CPython allocates where CircuitPython may not
+(ints above 256, for one), so they are for spotting changes, not absolute
+counts. Reports per event must match the baseline exactly, fewer as much
+as more: a change in how edges become reports is a behaviour change to
+look at, not noise.
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import simulator  # noqa: E402
+
+BASELINE_PATH = os.path.join(simulator.SIM_DIR, "bench_baseline.json")
+TIME_TOLERANCE = 1.5  # a time may grow to this multiple of its baseline
+ALLOC_TOLERANCE_BYTES = 64  # CPython's own allocations wobble a little between runs
+STAGE_CALLS = 2000
+REPEATS = 7  # the median of these runs is kept for times
+STAGE_SLICES = 20  # a stage's calls are split into this many slices, each after CALIBRATION_ROUNDS passes
+CALIBRATION_ROUNDS = 3  # passes of calibration_loop() per slice or per CALIBRATE_EVERY_SCANS scans
+CALIBRATE_EVERY_SCANS = 10
+
+HOME_ROW = ("A", "S", "D", "F", "G", "H", "J", "K", "L", "SEMICOLON")
+
+
+def mash_events(bursts=20, period_ms=200):
+    """Ten keys down within a few tens of ms, held, and released again, over and over.
+
+    Events are a few scans apart so every run sees each one in its own scan
+    and reports_per_event does not depend on host speed.
+    """
+    events = []
+    for burst in range(bursts):
+        start = 20 + burst * period_ms
+        for index, key in enumerate(HOME_ROW):
+            events.append((start + index * 4, key, True))
+            events.append((start + 100 + index * 4, key, False))
+    return events
+
+
+def scenarios():
+    key_map = simulator.load_physical_key_name_map()
+    return {
+        "idle": None,
+        "typing": simulator.load_trace("typing.json", key_map),
+        "rollover": simulator.load_trace("rollover.json", key_map),
+        "mash10": [(time_ms, key_map[key], pressed) for time_ms, key, pressed in mash_events()],
+        "fn_churn": simulator.load_trace("fn_churn.json", key_map),
+    }
+
+
+class AllocationSampler:
+    """Peak bytes traced by tracemalloc between consecutive SPI reads, i.e. per scan.
+
+    Scans that sent a report are kept apart from the others: in a trace most
+    scans see no change, and a percentile over all of them lands on one kind
+    or the other depending on how the scans fell.
+    """
+
+    def __init__(self, hardware):
+        self.hardware = hardware
+        self.samples = []
+        self.report_samples = []
+        self.baseline = None
+        self.records = 0
+
+    def __call__(self):
+        current, peak = tracemalloc.get_traced_memory()
+        records = self.hardware.records
+        reported = False
+        while self.records < len(records):
+            reported = reported or records[self.records][1] in simulator.REPORT_CHANNELS
+            self.records += 1
+        if self.baseline is not None:
+            (self.report_samples if reported else self.samples).append(peak - self.baseline)
+        tracemalloc.reset_peak()
+        self.baseline = tracemalloc.get_traced_memory()[0]
+
+    def result(self):
+        """Median bytes of a scan that sent a report, or of any scan when none did."""
+        # the first scans build caches and warm up the lighting
+        samples = self.report_samples or self.samples[len(self.samples) // 10:] or self.samples
+        samples = sorted(samples)
+        return samples[len(samples) // 2] if samples else 0
+
+
+def run_scenario(events, trace_alloc=False):
+    source = simulator.IdleSource(duration_ms=300) if events is None else simulator.TraceSource(events, tail_ms=100)
+    firmware = simulator.load_firmware(simulator.KEYBOARD_DIR, source)
+    hardware = simulator.hardware
+    sampler = AllocationSampler(hardware) if trace_alloc else None
+    calibration = None if trace_alloc else Calibration()
+    first_read_ns = []
+    read_registers = hardware.read_registers
+
+    def timed_read(buffer):
+        # main()'s startup is not part of the hot loop, time from the first scan
+        if not first_read_ns:
+            first_read_ns.append(time.perf_counter_ns())
+        if sampler is not None:
+            sampler()
+        if calibration is not None and hardware.spi_reads % CALIBRATE_EVERY_SCANS == 0:
+            hardware.clock.hide(calibration.run())
+        read_registers(buffer)
+
+    hardware.read_registers = timed_read
+    if trace_alloc:
+        tracemalloc.start()
+    try:
+        simulator.run_firmware(firmware)
+    finally:
+        if trace_alloc:
+            tracemalloc.stop()
+    cpu_ns = time.perf_counter_ns() - first_read_ns[0]
+    if calibration is not None:
+        cpu_ns -= calibration.elapsed_ns
+    result = {
+        "scans": hardware.spi_reads,
+        "cpu_per_scan_ns": cpu_ns / hardware.spi_reads,
+        "reports_per_event": len(hardware.reports()) / len(events) if events else len(hardware.reports()),
+    }
+    if calibration is not None:
+        result["cpu_per_scan_loops"] = cpu_ns / hardware.spi_reads / calibration.loop_ns()
+    if sampler is not None:
+        result["alloc_bytes_per_scan"] = sampler.result()
+    return result
+
+
+def bench_scenarios():
+    results = {}
+    for name, events in scenarios().items():
+        runs = [run_scenario(events) for _ in range(REPEATS)]
+        allocations = run_scenario(events, trace_alloc=True)
+        results[name] = {
+            "cpu_per_scan_us": median([run["cpu_per_scan_ns"] for run in runs]) / 1e3,
+            "cpu_per_scan_loops": median([run["cpu_per_scan_loops"] for run in runs]),
+            "alloc_bytes_per_scan": allocations["alloc_bytes_per_scan"],
+            # the simulated clock follows the host's, so a stall can merge edges into fewer reports, never more
+            "reports_per_event": max(run["reports_per_event"] for run in runs),
+        }
+    return results
+
+
+class NullUART:
+    """Takes CH9329 frames without recording them, so only the driver's own work is timed."""
+
+    baudrate = 9600
+    in_waiting = 0
+
+    def write(self, buffer):
+        return len(buffer)
+
+    def read(self, nbytes=None):
+        return None
+
+
+def stage_functions(firmware):
+    """(name, function) pairs, each set up against the loaded firmware."""
+    key_map = simulator.load_physical_key_name_map()
+    key_mask = firmware.build_key_mask(key_map.values())
+    typing_snapshot = bytearray(firmware.SCAN_BYTES)
+    mash_snapshot = bytearray(firmware.SCAN_BYTES)
+    for key in HOME_ROW:
+        key_id = key_map[key]
+        mash_snapshot[key_id >> 3] |= 0x80 >> (key_id & 7)
+    key_id = key_map["A"]
+    typing_snapshot[key_id >> 3] |= 0x80 >> (key_id & 7)
+    registers = bytearray(~byte & 0xFF for byte in mash_snapshot)
+    pressed = bytearray(firmware.SCAN_BYTES)
+    lit_keys = [key_map[key] for key in HOME_ROW]
+
+    from lib.ch9329 import CH9329
+    from adafruit_hid.keycode import Keycode
+    ch9329 = CH9329(NullUART())
+    ch9329.keyboard_press_many(Keycode.A, Keycode.S, Keycode.LEFT_SHIFT)
+
+    from lib.effects import EffectEngine, EFFECTS
+    engine = EffectEngine(firmware.light_renderer, firmware.build_key_positions(key_map), firmware.max_light_level)
+    engine.build_rings()
+    presses = [0]
+
+    def render(effect):
+        # a frame drawn right after a key edge, the case render() cannot skip
+        def stage():
+            key_id = lit_keys[presses[0] % len(lit_keys)]
+            presses[0] += 1
+            engine.press(key_id)
+            engine.release(key_id)
+            engine.render(effect)
+        return stage
+
+    ring_builder = [None]
+
+    def build_rings_step():
+        # one slice of the tables render() builds after boot, starting over when they are done
+        if ring_builder[0] is None:
+            ring_builder[0] = engine._build_rings()
+        try:
+            next(ring_builder[0])
+        except StopIteration:
+            ring_builder[0] = None
+
+    return (
+        ("read_shift_registers", firmware.read_shift_registers),
+        ("decode_pressed", lambda: firmware.decode_pressed(registers, key_mask, pressed)),
+        ("get_changed_key_ids_idle", lambda: firmware.get_changed_key_ids(typing_snapshot, typing_snapshot)),
+        ("get_changed_key_ids_mash", lambda: firmware.get_changed_key_ids(typing_snapshot, mash_snapshot)),
+        ("get_pressed_key_ids_mash", lambda: firmware.get_pressed_key_ids(mash_snapshot)),
+        ("ripple_build_rings_step", build_rings_step),
+        ("ch9329_send_key", ch9329._send_key),
+    ) + tuple(("effect_render_" + effect, render(effect)) for effect in EFFECTS)
+
+
+def calibration_loop(data=bytearray(range(256))):
+    # the kind of work the firmware does: byte indexing, small int math, branches
+    total = 0
+    for value in data:
+        if value & 1:
+            total += data[value ^ 0x55] >> 1
+        else:
+            total ^= value
+    return total
+
+
+class Calibration:
+    """Passes of calibration_loop() run in between the measured work, so both see the same host."""
+
+    def __init__(self):
+        self.passes = 0
+        self.elapsed_ns = 0
+
+    def run(self, rounds=CALIBRATION_ROUNDS):
+        """Run rounds passes; returns the nanoseconds they took."""
+        started_ns = time.perf_counter_ns()
+        for _ in range(rounds):
+            calibration_loop()
+        elapsed_ns = time.perf_counter_ns() - started_ns
+        self.passes += rounds
+        self.elapsed_ns += elapsed_ns
+        return elapsed_ns
+
+    def loop_ns(self):
+        return self.elapsed_ns / self.passes
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def bench_stages():
+    firmware = simulator.load_firmware(simulator.KEYBOARD_DIR, simulator.IdleSource())
+    results = {}
+    for name, function in stage_functions(firmware):
+        times_ns = []
+        loops = []
+        for _ in range(REPEATS):
+            # stages that send keep appending to the recorded traffic; start every run empty
+            simulator.hardware.records.clear()
+            calibration = Calibration()
+            elapsed_ns = 0
+            gc.disable()  # as timeit does, a collection landing in one run is not the stage's cost
+            for _ in range(STAGE_SLICES):
+                calibration.run()
+                started_ns = time.perf_counter_ns()
+                for _ in range(STAGE_CALLS // STAGE_SLICES):
+                    function()
+                elapsed_ns += time.perf_counter_ns() - started_ns
+            gc.enable()
+            calls = STAGE_CALLS // STAGE_SLICES * STAGE_SLICES
+            times_ns.append(elapsed_ns / calls)
+            loops.append(elapsed_ns / calls / calibration.loop_ns())
+        simulator.hardware.records.clear()
+        function()  # first call may build caches
+        tracemalloc.start()
+        peak = 0
+        for _ in range(100):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            function()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+        results[name] = {"time_us": median(times_ns) / 1e3, "time_loops": median(loops), "alloc_bytes": peak}
+        simulator.hardware.records.clear()
+    return results
+
+
+def compare(results, baseline, time_tolerance):
+    """Lines describing every metric that got worse than its baseline allows.
+
+    A metric missing from the baseline is a failure too, so nothing goes
+    unchecked until the baseline is updated.
+    """
+    failures = []
+    for group, limits in (
+        ("stages", {"time_loops": None, "alloc_bytes": ALLOC_TOLERANCE_BYTES}),
+        ("scenarios", {"cpu_per_scan_loops": None, "alloc_bytes_per_scan": ALLOC_TOLERANCE_BYTES, "reports_per_event": None}),
+    ):
+        for name, metrics in results[group].items():
+            expected = baseline.get(group, {}).get(name, {})
+            for metric, slack in limits.items():
+                if metric not in expected:
+                    failures.append(f"{group}/{name}/{metric}: not in the baseline, run with --update")
+                    continue
+                if metric == "reports_per_event":
+                    if metrics[metric] != expected[metric]:
+                        failures.append(f"{group}/{name}/{metric}: {metrics[metric]:.3f} != baseline {expected[metric]:.3f}")
+                    continue
+                limit = expected[metric] * time_tolerance if slack is None else expected[metric] + slack
+                if metrics[metric] > limit + 1e-9:
+                    failures.append(f"{group}/{name}/{metric}: {metrics[metric]:.3f} > {limit:.3f} (baseline {expected[metric]:.3f})")
+    return failures
+
+
+def print_results(results):
+    for group, rows in results.items():
+        print(group)
+        for name, metrics in rows.items():
+            values = "  ".join(f"{metric}={value:.3f}" if isinstance(value, float) else f"{metric}={value}" for metric, value in metrics.items())
+            print(f"    {name:<28} {values}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--time-tolerance", type=float, default=TIME_TOLERANCE, help="allowed slowdown factor, in calibration loops")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = {"stages": bench_stages(), "scenarios": bench_scenarios()}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        sys.exit(f"no baseline at {args.baseline}, run with --update first")
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failures = compare(results, baseline, args.time_tolerance)
+    if failures:
+        print("REGRESSIONS:")
+        for failure in failures:
+            print("    " + failure)
+        sys.exit(1)
+    print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
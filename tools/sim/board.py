@@ -0,0 +1,20 @@
+"""Stand-in for the CircuitPython ``board`` module: every pin name resolves to a Pin."""
+
+
+class Pin:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self):
+        return f"board.{self.name}"
+
+
+_pins = {}
+
+
+def __getattr__(name):
+    if name.startswith("__"):
+        raise AttributeError(name)
+    if name not in _pins:
+        _pins[name] = Pin(name)
+    return _pins[name]
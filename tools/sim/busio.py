@@ -0,0 +1,78 @@
+"""Stand-in for the CircuitPython ``busio`` module.
+
+SPI reads come from the scripted shift-register source installed in
+``simulator.hardware``; UART writes are captured with their timestamps.
+"""
+
+import simulator
+
+
+class SPI:
+    def __init__(self, clock, MOSI=None, MISO=None):
+        self.clock = clock
+        self._locked = False
+
+    def try_lock(self):
+        if self._locked:
+            return False
+        self._locked = True
+        return True
+
+    def unlock(self):
+        self._locked = False
+
+    def configure(self, baudrate=100000, polarity=0, phase=0, bits=8):
+        pass
+
+    def readinto(self, buffer, start=0, end=None, write_value=0):
+        simulator.hardware.read_registers(buffer)
+
+    def deinit(self):
+        pass
+
+
+class UART:
+    def __init__(self, tx, rx, baudrate=9600, timeout=1, receiver_buffer_size=64):
+        self.tx = tx
+        self.rx = rx
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self._rx = bytearray()
+        simulator.hardware.uarts.append(self)
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, buffer):
+        data = bytes(buffer)
+        simulator.hardware.record("uart", data)
+        if simulator.hardware.uart_peer is not None:
+            simulator.hardware.uart_peer.receive(self, data)
+        return len(buffer)
+
+    def read(self, nbytes=None):
+        if not self._rx:
+            return None
+        if nbytes is None:
+            nbytes = len(self._rx)
+        data = bytes(self._rx[:nbytes])
+        del self._rx[:nbytes]
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        if data is None:
+            return None
+        buffer[:len(data)] = data
+        return len(data)
+
+    def reset_input_buffer(self):
+        self._rx = bytearray()
+
+    def feed(self, data):
+        """Queue bytes as if the peer had sent them."""
+        self._rx.extend(data)
+
+    def deinit(self):
+        pass
@@ -0,0 +1,50 @@
+"""Stand-in for the ``neopixel`` library that records every frame pushed with show()."""
+
+import simulator
+
+RGB = "RGB"
+GRB = "GRB"
+RGBW = "RGBW"
+GRBW = "GRBW"
+
+
+class NeoPixel:
+    def __init__(self, pin, n, *, bpp=3, brightness=1.0, auto_write=True, pixel_order=None):
+        self.pin = pin
+        self.n = n
+        self.brightness = brightness
+        self.auto_write = auto_write
+        self.pixel_order = pixel_order
+        self._pixels = [(0, 0, 0)] * n
+        self.writes = 0
+        self.shows = 0
+        simulator.hardware.pixels.append(self)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        return self._pixels[index]
+
+    def __setitem__(self, index, color):
+        if isinstance(index, slice):
+            for i, value in zip(range(*index.indices(self.n)), color):
+                self._pixels[i] = tuple(value)
+            self.writes += 1
+        else:
+            self._pixels[index] = tuple(color)
+            self.writes += 1
+        if self.auto_write:
+            self.show()
+
+    def fill(self, color):
+        self._pixels = [tuple(color)] * self.n
+        if self.auto_write:
+            self.show()
+
+    def show(self):
+        self.shows += 1
+        simulator.hardware.record("neopixel", tuple(self._pixels))
+
+    def deinit(self):
+        pass
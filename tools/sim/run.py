@@ -0,0 +1,31 @@
+"""Run the keyboard firmware on CPython against a recorded key trace.
+
+    python tools/sim/run.py typing.json
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import simulator  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("traces", nargs="+", help="trace json files, absolute or relative to tools/sim/traces")
+    parser.add_argument("--tail-ms", type=int, default=100, help="keep scanning this long after the last event")
+    args = parser.parse_args()
+
+    for trace in args.traces:
+        result = simulator.run_trace(trace, tail_ms=args.tail_ms)
+        print(trace)
+        for key, value in result.items():
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            print(f"    {key:<20} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+"""Host-side hardware simulator for module/keyboard/code.py.
+
+The modules in this directory stand in for ``board``, ``busio``, ``digitalio``,
+``usb_hid``, ``_bleio``, ``neopixel`` and the adafruit HID/BLE libraries. They
+all talk to the shared ``hardware`` object below: SPI reads are served from a
+scripted shift-register source, and every HID report, UART frame and NeoPixel
+frame is recorded with a timestamp from the simulated clock.
+
+The clock follows real CPU time but ``time.sleep`` only advances a virtual
+offset, so a trace runs as fast as the host can execute the firmware while
+still reporting latencies as the firmware would see them.
+"""
+
+import importlib.util
+import json
+import os
+import runpy
+import sys
+import time
+
+SIM_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(SIM_DIR))
+KEYBOARD_DIR = os.path.join(REPO_DIR, "module", "keyboard")
+TRACE_DIR = os.path.join(SIM_DIR, "traces")
+
+SCAN_BYTES = 9
+REPORT_CHANNELS = ("usb_hid", "uart", "bluetooth")
+CH9329_KEY_FRAME = b"\x57\xab\x00\x02"
+
+
+class StopSimulation(Exception):
+    pass
+
+
+class SimClock:
+    """Replacement for the ``time`` module inside the firmware."""
+
+    def __init__(self):
+        self._start_ns = time.perf_counter_ns()
+        self._offset_ns = 0
+
+    def monotonic_ns(self):
+        return time.perf_counter_ns() - self._start_ns + self._offset_ns
+
+    def monotonic(self):
+        return self.monotonic_ns() / 1e9
+
+    def time(self):
+        return 946684800 + self.monotonic_ns() // 1000000000
+
+    def sleep(self, seconds):
+        self._offset_ns += int(seconds * 1e9)
+
+    def hide(self, ns):
+        """Take ns of host time out of the firmware's clock, e.g. time spent by the bench between scans."""
+        self._offset_ns -= ns
+
+
+class IdleSource:
+    """No key is ever pressed; stops after ``duration_ms`` if given."""
+
+    def __init__(self, duration_ms=None):
+        self.duration_ms = duration_ms
+        self.start_ns = None
+
+    def fill(self, buffer, now_ns):
+        if self.start_ns is None:
+            self.start_ns = now_ns
+        if self.duration_ms is not None and now_ns - self.start_ns > self.duration_ms * 1000000:
+            raise StopSimulation()
+        for i in range(len(buffer)):
+            buffer[i] = 0xFF
+
+
+class TraceSource:
+    """Replays ``(time_ms, physical_id, pressed)`` events as shift-register bits.
+
+    Trace time 0 is the first SPI read, so startup cost is not counted as latency.
+    """
+
+    def __init__(self, events, tail_ms=100):
+        self.events = sorted(events, key=lambda event: event[0])
+        self.tail_ms = tail_ms
+        self.pressed = bytearray(SCAN_BYTES)
+        self.index = 0
+        self.start_ns = None
+        self.end_ms = self.events[-1][0] if self.events else 0
+
+    def event_time_ns(self, event):
+        return self.start_ns + int(event[0] * 1000000)
+
+    def fill(self, buffer, now_ns):
+        if self.start_ns is None:
+            self.start_ns = now_ns
+        now_ms = (now_ns - self.start_ns) / 1e6
+        events = self.events
+        while self.index < len(events) and events[self.index][0] <= now_ms:
+            _, key_id, pressed = events[self.index]
+            if pressed:
+                self.pressed[key_id >> 3] |= 0x80 >> (key_id & 7)
+            else:
+                self.pressed[key_id >> 3] &= ~(0x80 >> (key_id & 7))
+            self.index += 1
+        if self.index == len(events) and now_ms > self.end_ms + self.tail_ms:
+            raise StopSimulation()
+        for i in range(len(buffer)):
+            buffer[i] = ~self.pressed[i] & 0xFF
+
+
+class CH9329Peer:
+    """Answers UART frames the way a CH9329 does.
+
+    It only understands frames sent at its current baud rate, stores the
+    parameter block, applies a new baud rate on reset, and acknowledges key
+    frames, optionally ignoring every ``drop_every``-th one.
+    """
+
+    def __init__(self, baudrate=9600, drop_every=0):
+        self.baudrate = baudrate
+        self.parameters = bytearray(50)
+        self.parameters[3:7] = baudrate.to_bytes(4, "big")
+        self.drop_every = drop_every
+        self.key_frames = 0
+
+    def receive(self, uart, data):
+        if uart.baudrate != self.baudrate or len(data) < 6 or data[0:2] != b"\x57\xab":
+            return
+        if sum(data[:-1]) & 0xFF != data[-1]:
+            self.reply(uart, data, 0xC0, b"\xe4")
+            return
+        command = data[3]
+        payload = data[5:-1]
+        if command == 0x01:
+            self.reply(uart, data, 0x80, b"\x30\x01\x00\x00\x00\x00\x00\x00")
+        elif command == 0x02:
+            self.key_frames += 1
+            if self.drop_every and self.key_frames % self.drop_every == 0:
+                return
+            self.reply(uart, data, 0x80, b"\x00")
+        elif command == 0x08:
+            self.reply(uart, data, 0x80, bytes(self.parameters))
+        elif command == 0x09:
+            self.parameters[:] = payload
+            self.reply(uart, data, 0x80, b"\x00")
+        elif command == 0x0F:
+            self.reply(uart, data, 0x80, b"\x00")
+            self.baudrate = int.from_bytes(self.parameters[3:7], "big")
+        else:
+            self.reply(uart, data, 0x80, b"\x00")
+
+    def reply(self, uart, request, flag, payload):
+        frame = bytearray(b"\x57\xab")
+        frame += bytes((request[2], request[3] | flag, len(payload)))
+        frame += payload
+        frame.append(sum(frame) & 0xFF)
+        uart.feed(frame)
+
+
+class Hardware:
+    def __init__(self):
+        self.clock = SimClock()
+        self.register_source = IdleSource()
+        self.records = []
+        self.uarts = []
+        self.uart_peer = CH9329Peer()
+        self.pixels = []
+        self.ble_connections = []
+        self.ble_auto_connect = True
+        self.ble_min_interval_ms = 7.5
+        self.spi_reads = 0
+        self.code_writable = False  # CIRCUITPY as code.py sees it, set by boot.py through storage.remount()
+
+    def read_registers(self, buffer):
+        self.spi_reads += 1
+        self.register_source.fill(buffer, self.clock.monotonic_ns())
+
+    def record(self, channel, data, report_id=None):
+        self.records.append((self.clock.monotonic_ns(), channel, data, report_id))
+
+    def reports(self, channels=REPORT_CHANNELS):
+        # CH9329 configuration traffic is not a key report
+        return [
+            record for record in self.records
+            if record[1] in channels and (record[1] != "uart" or record[2].startswith(CH9329_KEY_FRAME))
+        ]
+
+
+hardware = Hardware()
+
+
+def reset():
+    global hardware
+    hardware = Hardware()
+    return hardware
+
+
+def load_physical_key_name_map(keyboard_dir=KEYBOARD_DIR):
+    with open(os.path.join(keyboard_dir, "config", "physical_key_name_map.json")) as f:
+        return json.load(f)
+
+
+def load_trace(path, physical_key_name_map=None):
+    """Load a json trace: ``{"events": [[time_ms, key, pressed], ...]}``.
+
+    ``key`` is a physical key name or a physical id.
+    """
+    if physical_key_name_map is None:
+        physical_key_name_map = load_physical_key_name_map()
+    if not os.path.exists(path):
+        path = os.path.join(TRACE_DIR, path)
+    with open(path) as f:
+        trace = json.load(f)
+    events = []
+    for time_ms, key, pressed in trace["events"]:
+        key_id = physical_key_name_map[key] if isinstance(key, str) else key
+        events.append((time_ms, key_id, bool(pressed)))
+    return events
+
+
+def _install_clock(keyboard_dir):
+    for module in list(sys.modules.values()):
+        path = getattr(module, "__file__", None) or ""
+        if path.startswith(keyboard_dir) and getattr(module, "time", None) is time:
+            module.time = hardware.clock
+
+
+def load_firmware(keyboard_dir=KEYBOARD_DIR, source=None, boot_source=None):
+    """Import code.py against the simulated hardware and return the module.
+
+    boot.py runs first, as on the board, reading the keys from boot_source
+    (none held by default). The module is loaded under the name
+    ``firmware`` so it does not collide with the standard library ``code``
+    module, and its ``main()`` is not run.
+    """
+    reset()
+    for path in (keyboard_dir, SIM_DIR):
+        if path in sys.path:
+            sys.path.remove(path)
+        sys.path.insert(0, path)
+    os.chdir(keyboard_dir)
+    importlib.import_module("usb_hid").reset()
+    boot_path = os.path.join(keyboard_dir, "boot.py")
+    if os.path.exists(boot_path):
+        # boot.py reads the keys too; keep that read out of the trace and the scan count
+        hardware.register_source = boot_source if boot_source is not None else IdleSource()
+        runpy.run_path(boot_path)
+        hardware.spi_reads = 0
+    hardware.register_source = source if source is not None else IdleSource()
+    spec = importlib.util.spec_from_file_location("firmware", os.path.join(keyboard_dir, "code.py"))
+    firmware = importlib.util.module_from_spec(spec)
+    sys.modules["firmware"] = firmware
+    spec.loader.exec_module(firmware)
+    # code.py imports some of lib/ only when first needed; load them now so they get the clock too
+    for name in sorted(os.listdir(os.path.join(keyboard_dir, "lib"))):
+        if name.endswith(".py"):
+            importlib.import_module("lib." + name[:-3])
+    _install_clock(keyboard_dir)
+    return firmware
+
+
+def run_firmware(firmware):
+    try:
+        firmware.main()
+    except StopSimulation:
+        pass
+    return hardware
+
+
+def event_latencies_ns(source, records):
+    """Time from each trace event to the first report sent after it."""
+    latencies = []
+    record_index = 0
+    for event in source.events:
+        event_ns = source.event_time_ns(event)
+        while record_index < len(records) and records[record_index][0] < event_ns:
+            record_index += 1
+        if record_index < len(records):
+            latencies.append(records[record_index][0] - event_ns)
+        else:
+            latencies.append(None)
+    return latencies
+
+
+def run_trace(trace, keyboard_dir=KEYBOARD_DIR, tail_ms=100):
+    """Run main() over a trace file (or event list) and return a summary dict."""
+    events = load_trace(trace) if isinstance(trace, str) else trace
+    source = TraceSource(events, tail_ms=tail_ms)
+    firmware = load_firmware(keyboard_dir, source)
+    started_ns = time.perf_counter_ns()
+    run_firmware(firmware)
+    cpu_ns = time.perf_counter_ns() - started_ns
+    reports = hardware.reports()
+    latencies = [latency for latency in event_latencies_ns(source, reports) if latency is not None]
+    duration_ns = hardware.clock.monotonic_ns() - (source.start_ns or 0)
+    return {
+        "events": len(events),
+        "scans": hardware.spi_reads,
+        "duration_ms": duration_ns / 1e6,
+        "scan_rate_hz": hardware.spi_reads / (duration_ns / 1e9) if duration_ns else 0,
+        "cpu_per_scan_us": cpu_ns / hardware.spi_reads / 1e3 if hardware.spi_reads else 0,
+        "reports": len(reports),
+        "pixel_shows": sum(pixels.shows for pixels in hardware.pixels),
+        "latency_mean_ms": sum(latencies) / len(latencies) / 1e6 if latencies else None,
+        "latency_max_ms": max(latencies) / 1e6 if latencies else None,
+        "unanswered_events": len(events) - len(latencies),
+    }
@@ -0,0 +1,11 @@
+"""Stand-in for CircuitPython's ``storage`` module, as far as boot.py uses it.
+
+The host filesystem is not made read-only; remount() only records what
+boot.py asked for in ``simulator.hardware.code_writable``.
+"""
+
+import simulator
+
+
+def remount(mount_path, readonly=False, disable_concurrent_write_protection=False):
+    simulator.hardware.code_writable = not readonly
@@ -0,0 +1,10 @@
+"""Stand-in for CircuitPython's ``supervisor`` module."""
+
+
+class Runtime:
+    def __init__(self):
+        self.autoreload = True
+        self.serial_bytes_available = False
+
+
+runtime = Runtime()
@@ -0,0 +1,43 @@
+"""Stand-in for the CircuitPython ``usb_hid`` module with report-capturing devices."""
+
+import simulator
+
+
+class Device:
+    def __init__(self, *, report_descriptor=b"", usage_page=0x01, usage=0x06, report_ids=(0,), in_report_lengths=(8,), out_report_lengths=(1,)):
+        self.report_descriptor = report_descriptor
+        self.usage_page = usage_page
+        self.usage = usage
+        self.report_ids = tuple(report_ids)
+        self.in_report_lengths = tuple(in_report_lengths)
+        self.out_report_lengths = tuple(out_report_lengths)
+        self.last_received_report = None
+
+    def send_report(self, report, report_id=None):
+        simulator.hardware.record("usb_hid", bytes(report), report_id)
+
+    def get_last_received_report(self, report_id=None):
+        return self.last_received_report
+
+
+Device.KEYBOARD = Device(usage_page=0x01, usage=0x06, report_ids=(1,), in_report_lengths=(8,))
+Device.MOUSE = Device(usage_page=0x01, usage=0x02, report_ids=(2,), in_report_lengths=(4,))
+Device.CONSUMER_CONTROL = Device(usage_page=0x0C, usage=0x01, report_ids=(3,), in_report_lengths=(2,))
+
+devices = [Device.KEYBOARD, Device.MOUSE, Device.CONSUMER_CONTROL]
+
+
+def reset():
+    """Back to the devices CircuitPython enables when boot.py does not call enable()."""
+    global devices
+    devices = [Device.KEYBOARD, Device.MOUSE, Device.CONSUMER_CONTROL]
+
+
+def enable(requested_devices, boot_device=0):
+    global devices
+    devices = list(requested_devices)
+
+
+def disable():
+    global devices
+    devices = []